@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+import mimetypes
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+from .i18n import _
+from ._session import SessionPool
+from ._utils import parse_size
+
+# Attachments downloaded at the same time
+DOWNLOAD_WORKERS = 4
+# Most downloads (responses and files) open at the same time
+DOWNLOAD_MAX_FILES = 8
+# Most bytes being downloaded at the same time
+DOWNLOAD_MAX_BYTES = "64MB"
+# Bytes accounted for downloads which don't announce their size
+UNKNOWN_SIZE = 2 ** 20
+# Bytes written at a time
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+class AttachmentTooLarge(Exception):
+    """Raised when an attachment is larger than the size limit, before (or
+    while) downloading it
+    """
+
+    def __init__(self, url: str, size: int = None, estimated: bool = False):
+        self.url = url
+        self.size = size
+        self.estimated = estimated
+        super().__init__(
+            _("Attachment too large: {}").format(url)
+        )
+
+
+class DownloadPool(object):
+    """
+    Downloads attachments with a few workers at the same time, capping how
+    many downloads are open at once and how many bytes they add up to, so
+    media-heavy accounts don't spend most of the run waiting on the CDN one
+    file at a time.
+
+    A download larger than the bytes cap waits for the rest to finish and
+    then goes on its own.
+    """
+
+    def __init__(
+        self,
+        session_pool: SessionPool,
+        workers: int = DOWNLOAD_WORKERS,
+        max_files: int = DOWNLOAD_MAX_FILES,
+        max_bytes: int = parse_size(DOWNLOAD_MAX_BYTES),
+    ):
+        self.session_pool = session_pool
+        self.workers = workers
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._files = threading.BoundedSemaphore(max_files)
+        self._bytes = threading.Condition()
+        self._bytes_in_flight = 0
+
+    @classmethod
+    def from_config(cls, cfg: dict, session_pool: SessionPool):
+        """Builds a DownloadPool using the limits defined in the config
+
+        :param cfg: Parsed config.yml
+        :type cfg: dict
+        :param session_pool: HTTP sessions to download the attachments with
+        :type session_pool: SessionPool
+        :returns: DownloadPool limited as configured (or with the defaults)
+        :rtype: DownloadPool
+        """
+        kwargs = {}
+        for attribute in ("download_workers", "download_max_files"):
+            if attribute in cfg:
+                kwargs[attribute[len("download_"):]] = int(cfg[attribute])
+        if "download_max_bytes" in cfg:
+            kwargs["max_bytes"] = parse_size(str(cfg["download_max_bytes"]))
+        return cls(session_pool, **kwargs)
+
+    def download_all(self, downloads: list, executor=None):
+        """Downloads the files provided concurrently
+
+        :param downloads: tuples with the arguments of each download (URL,
+            path of the file without its extension and optionally its size
+            limit and expected size)
+        :type downloads: list
+        :param executor: Executor running the downloads of other files too,
+            otherwise they run in their own one with up to 'workers' threads
+        :type executor: concurrent.futures.Executor
+        :returns: generator of the futures of each download (resolving to the
+            path of the file written) in the same order as provided. Closing
+            it cancels the downloads which haven't started yet
+        """
+        if not downloads:
+            return
+        shared = executor is not None
+        if not shared:
+            workers = min(self.workers, len(downloads))
+            executor = ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        try:
+            for download in downloads:
+                futures.append(executor.submit(self.download, *download))
+            for future in futures:
+                yield future
+        finally:
+            for future in futures:
+                future.cancel()
+            if not shared:
+                executor.shutdown(wait=True)
+
+    def download(
+        self,
+        url: str,
+        path: str,
+        max_size: int = None,
+        expected_size: int = None,
+    ) -> str:
+        """Downloads a single file, unless it's larger than the limit. The
+        transfer is aborted as soon as it goes over the limit
+
+        :param url: URL of the file
+        :type url: str
+        :param path: Path of the file to write without its extension
+        :type path: str
+        :param max_size: Size limit of the file in bytes
+        :type max_size: int
+        :param expected_size: Estimated size of the file in bytes, used when
+            the response doesn't announce it
+        :type expected_size: int
+        :returns: path of the file written
+        :rtype: str
+        """
+        start = time.time()
+        with self.open(url, max_size, expected_size) as response:
+            file_path = path + mimetypes.guess_extension(
+                response.headers["Content-Type"]
+            )
+            # Written aside and moved into place once complete, so a file
+            # left behind (which may be linked to the media cache) is never
+            # truncated or left half written
+            temp_path = f"{file_path}.{os.getpid()}.part"
+            try:
+                with open(temp_path, "wb") as outfile:
+                    for chunk in iter_chunks(response.raw, url, max_size):
+                        outfile.write(chunk)
+                os.replace(temp_path, file_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        elapsed = max(time.time() - start, 1e-6)
+        size_mb = os.stat(file_path).st_size / 2 ** 20
+        logger.debug(
+            _("Downloaded {file} ({size}MB in {secs}s, {rate}MB/s)").format(
+                file=file_path,
+                size=round(size_mb, 2),
+                secs=round(elapsed, 2),
+                rate=round(size_mb / elapsed, 2),
+            )
+        )
+        return file_path
+
+    @contextmanager
+    def open(
+        self, url: str, max_size: int = None, expected_size: int = None
+    ):
+        """Opens the download of a file, counting it towards the limits of
+        the pool until it's closed. Its size is checked before transferring
+        it with the Content-Length of the response (or the size expected
+        otherwise)
+
+        :param url: URL of the file
+        :type url: str
+        :param max_size: Size limit of the file in bytes
+        :type max_size: int
+        :param expected_size: Estimated size of the file in bytes, used when
+            the response doesn't announce it
+        :type expected_size: int
+        :returns: context manager of the streamed response
+        """
+        with self._files:
+            response = self.session_pool.get(url, stream=True)
+            try:
+                if not response.ok:
+                    response.raise_for_status()
+                try:
+                    size = int(response.headers["Content-Length"])
+                    estimated = False
+                except (KeyError, ValueError):
+                    size = expected_size
+                    estimated = True
+                if max_size is not None and size and size > max_size:
+                    raise AttachmentTooLarge(url, size, estimated)
+                reserved = self._reserve(size or UNKNOWN_SIZE)
+                try:
+                    response.raw.decode_content = True
+                    yield response
+                finally:
+                    self._release(reserved)
+            finally:
+                response.close()
+
+    def _reserve(self, size: int) -> int:
+        reserved = min(size, self.max_bytes)
+        with self._bytes:
+            while self._bytes_in_flight + reserved > self.max_bytes:
+                self._bytes.wait()
+            self._bytes_in_flight += reserved
+        return reserved
+
+    def _release(self, reserved: int):
+        with self._bytes:
+            self._bytes_in_flight -= reserved
+            self._bytes.notify_all()
+
+
+def iter_chunks(raw, url: str, max_size: int = None):
+    """Reads a stream in chunks, stopping as soon as it goes over the limit
+
+    :param raw: Stream to read
+    :param url: URL the stream comes from
+    :type url: str
+    :param max_size: Size limit of the stream in bytes
+    :type max_size: int
+    :returns: generator of the chunks read
+    """
+    read = 0
+    while True:
+        chunk = raw.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        read += len(chunk)
+        if max_size is not None and read > max_size:
+            raise AttachmentTooLarge(url)
+        yield chunk
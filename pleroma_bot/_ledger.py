@@ -0,0 +1,84 @@
+import time
+import sqlite3
+import threading
+
+# Seconds to wait for other processes writing to the ledger
+LEDGER_TIMEOUT = 30
+
+
+class Ledger(object):
+    """
+    Keeps track of every tweet mirrored and the Fediverse status it was
+    posted as, in a SQLite database shared by every user and process of the
+    run (and the following runs).
+
+    A run that died halfway through can then skip the tweets it already
+    posted, no matter where the cursor of the user was left.
+    """
+
+    def __init__(self, path: str, timeout: float = LEDGER_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, check_same_thread=False
+            )
+            # Readers don't block the writer (and the other way around)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "account TEXT NOT NULL, "
+                "tweet_id TEXT NOT NULL, "
+                "status_id TEXT NOT NULL, "
+                "posted_at REAL NOT NULL, "
+                "PRIMARY KEY (account, tweet_id))"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get(self, account: str, tweet_id: str) -> str:
+        """Returns the status the tweet was posted as
+
+        :param account: Fediverse account the tweet was posted to
+        :type account: str
+        :param tweet_id: ID of the tweet
+        :type tweet_id: str
+        :returns: ID of the status or None if it wasn't posted
+        :rtype: str
+        """
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT status_id FROM posts "
+                "WHERE account = ? AND tweet_id = ?",
+                (account, tweet_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, account: str, tweet_id: str, status_id: str):
+        """Records a tweet as posted
+
+        :param account: Fediverse account the tweet was posted to
+        :type account: str
+        :param tweet_id: ID of the tweet
+        :type tweet_id: str
+        :param status_id: ID of the status it was posted as
+        :type status_id: str
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)",
+                    (account, tweet_id, status_id, time.time()),
+                )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,185 @@
+import json
+
+from . import logger
+from .i18n import _
+from ._session import SessionPool
+
+# Twitter's user lookup endpoints take up to 100 users per request
+LOOKUP_BATCH_SIZE = 100
+
+# Users defining any of these get their own credentials or API, so they are
+# looked up individually when their User is created
+PER_USER_ATTRIBUTES = (
+    "twitter_token",
+    "twitter_base_url",
+    "twitter_base_url_v2",
+    "consumer_key",
+    "consumer_secret",
+    "access_token_key",
+    "access_token_secret",
+)
+
+
+class UserLookup(object):
+    """
+    Resolves the Twitter profile, ID and pinned tweet of every user in the
+    run with batched requests at startup, along with the info of every
+    Fediverse instance involved, so creating each User doesn't need its own
+    round of requests.
+
+    Anything the batches couldn't resolve is left out, and the User looks
+    it up on its own as usual.
+    """
+
+    def __init__(self):
+        self.twitter_users = {}
+        self.instances = {}
+
+    @classmethod
+    def resolve(
+        cls, user_dict: list, config: dict, session_pool: SessionPool
+    ):
+        """Looks up every user of the config
+
+        :param user_dict: Expanded list of users from the config
+        :type user_dict: list
+        :param config: Parsed config.yml
+        :type config: dict
+        :param session_pool: HTTP sessions shared by every user in the run
+        :type session_pool: SessionPool
+        :returns: the results of the lookup
+        :rtype: UserLookup
+        """
+        lookup = cls()
+        lookup.refresh(user_dict, config, session_pool)
+        instance_urls = {
+            user_item.get("pleroma_base_url", config.get("pleroma_base_url"))
+            for user_item in user_dict
+        }
+        for instance_url in instance_urls:
+            if instance_url:
+                lookup._lookup_instance(instance_url, session_pool)
+        return lookup
+
+    def refresh(
+        self, user_dict: list, config: dict, session_pool: SessionPool
+    ):
+        """Looks up the Twitter profile, ID and pinned tweet of every user
+        again, keeping the info of the instances
+
+        :param user_dict: Expanded list of users from the config
+        :type user_dict: list
+        :param config: Parsed config.yml
+        :type config: dict
+        :param session_pool: HTTP sessions shared by every user in the run
+        :type session_pool: SessionPool
+        """
+        self.twitter_users = {}
+        usernames = []
+        for user_item in user_dict:
+            if any(attr in user_item for attr in PER_USER_ATTRIBUTES):
+                continue
+            username = user_item["twitter_username"]
+            if username.lower() not in map(str.lower, usernames):
+                usernames.append(username)
+        base_url = config.get(
+            "twitter_base_url", "https://api.twitter.com/1.1"
+        )
+        base_url_v2 = config.get(
+            "twitter_base_url_v2", "https://api.twitter.com/2"
+        )
+        headers = {"Authorization": f"Bearer {config['twitter_token']}"}
+        for idx in range(0, len(usernames), LOOKUP_BATCH_SIZE):
+            batch = usernames[idx:idx + LOOKUP_BATCH_SIZE]
+            try:
+                self._lookup_profiles(batch, base_url, headers, session_pool)
+                self._lookup_ids(batch, base_url_v2, headers, session_pool)
+            except Exception:
+                logger.warning(
+                    _(
+                        "Batched lookup of Twitter users failed, they will "
+                        "be looked up individually"
+                    ),
+                    exc_info=True,
+                )
+
+    def _lookup_profiles(
+        self, usernames, base_url, headers, session_pool
+    ):
+        response = session_pool.get(
+            f"{base_url}/users/lookup.json",
+            headers=headers,
+            params={"screen_name": ",".join(usernames)},
+        )
+        # Twitter answers 404 when none of the users were found
+        if response.status_code == 404:
+            return
+        if not response.ok:
+            response.raise_for_status()
+        for user_twitter in json.loads(response.text):
+            self._twitter_user(user_twitter["screen_name"]).update(
+                {"info": user_twitter}
+            )
+
+    def _lookup_ids(self, usernames, base_url_v2, headers, session_pool):
+        params = {
+            "usernames": ",".join(usernames),
+            "user.fields": "pinned_tweet_id",
+            "expansions": "pinned_tweet_id",
+            "tweet.fields": "entities",
+        }
+        response = session_pool.get(
+            f"{base_url_v2}/users/by", headers=headers, params=params
+        )
+        if not response.ok:
+            response.raise_for_status()
+        content = json.loads(response.text)
+        pinned_tweets = {
+            tweet["id"]
+            for tweet in content.get("includes", {}).get("tweets", [])
+        }
+        for user_twitter in content.get("data", []):
+            pinned_tweet_id = user_twitter.get("pinned_tweet_id")
+            # Same as when looking it up for a single user, the pinned tweet
+            # only counts if Twitter returns it
+            if pinned_tweet_id not in pinned_tweets:
+                pinned_tweet_id = None
+            self._twitter_user(user_twitter["username"]).update(
+                {"id": user_twitter["id"], "pinned_tweet_id": pinned_tweet_id}
+            )
+
+    def _lookup_instance(self, instance_url, session_pool):
+        try:
+            response = session_pool.get(f"{instance_url}/api/v1/instance")
+            if response.ok:
+                self.instances[instance_url] = json.loads(response.text)
+        except Exception:
+            logger.debug(
+                _("Unable to look up instance {}").format(instance_url),
+                exc_info=True,
+            )
+
+    def _twitter_user(self, username: str) -> dict:
+        return self.twitter_users.setdefault(username.lower(), {})
+
+    def get_twitter_user(self, username: str) -> dict:
+        """Returns what the batches resolved for the Twitter user, which may
+        contain its profile ('info'), its ID ('id') and its pinned tweet
+        ('pinned_tweet_id')
+
+        :param username: Twitter username
+        :type username: str
+        :returns: resolved data of the user (empty if nothing was resolved)
+        :rtype: dict
+        """
+        return self.twitter_users.get(username.lower(), {})
+
+    def get_instance(self, instance_url: str) -> dict:
+        """Returns the info of the instance if it was looked up
+
+        :param instance_url: Base URL of the Fediverse instance
+        :type instance_url: str
+        :returns: info of the instance or None
+        :rtype: dict
+        """
+        return self.instances.get(instance_url)
@@ -0,0 +1,137 @@
+import os
+import shutil
+import hashlib
+
+from . import logger
+from .i18n import _
+from ._utils import file_sha256
+
+
+class MediaCache(object):
+    """
+    Content-addressed store of the attachments downloaded, so media showing
+    up again (in other mirrored accounts, or in later runs) is copied from
+    disk instead of being downloaded again.
+
+    Each attachment is stored once, named after the SHA-256 of its content,
+    and found through its media_key (or its URL). The store lives entirely
+    on disk, so every user and process of a run share it without any
+    coordination: the least recently used attachments are evicted once it
+    grows over its size limit.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.objects_path = os.path.join(path, "objects")
+        self.keys_path = os.path.join(path, "keys")
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.keys_path, exist_ok=True)
+
+    def _key_path(self, key: str) -> str:
+        key_hash = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.keys_path, key_hash)
+
+    def get(self, key: str, path: str) -> str:
+        """Copies the attachment from the store, if it's there
+
+        :param key: media_key (or URL) of the attachment
+        :type key: str
+        :param path: Path of the file to write without its extension
+        :type path: str
+        :returns: path of the file written or None if the attachment isn't
+            in the store
+        :rtype: str
+        """
+        try:
+            with open(self._key_path(key), "r") as file:
+                object_name = file.read().strip()
+            object_path = os.path.join(self.objects_path, object_name)
+            file_path = path + os.path.splitext(object_name)[1]
+            # A run that crashed may have left the file behind
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            _link(object_path, file_path)
+            # Keep track of when it was last used for evicting it
+            os.utime(object_path)
+        except OSError:
+            return None
+        logger.debug(
+            _("Attachment {key} found in the media cache").format(key=key)
+        )
+        return file_path
+
+    def put(self, key: str, file_path: str):
+        """Adds an attachment to the store
+
+        :param key: media_key (or URL) of the attachment
+        :type key: str
+        :param file_path: Path of the attachment downloaded
+        :type file_path: str
+        """
+        object_name = (
+            file_sha256(file_path) + os.path.splitext(file_path)[1]
+        )
+        object_path = os.path.join(self.objects_path, object_name)
+        try:
+            try:
+                _link(file_path, object_path)
+            except FileExistsError:
+                os.utime(object_path)
+            key_path = self._key_path(key)
+            temp_path = f"{key_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as file:
+                file.write(object_name)
+            os.replace(temp_path, key_path)
+        except OSError:
+            logger.debug(
+                _("Unable to add {key} to the media cache").format(key=key),
+                exc_info=True,
+            )
+
+    def evict(self):
+        """Removes the least recently used attachments until the store fits
+        in its size limit, along with the keys pointing to them
+        """
+        objects = []
+        total_size = 0
+        for entry in os.scandir(self.objects_path):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, entry.name))
+            total_size += stat.st_size
+        if total_size <= self.max_size:
+            return
+        evicted = set()
+        for _mtime, size, name in sorted(objects):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.objects_path, name))
+            except OSError:
+                pass
+            evicted.add(name)
+            total_size -= size
+        for entry in os.scandir(self.keys_path):
+            try:
+                with open(entry.path, "r") as file:
+                    if file.read().strip() in evicted:
+                        os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def _link(source: str, destination: str):
+    # Hard links cost no space, copy the file if they aren't supported
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        if not os.path.isfile(source):
+            raise
+        shutil.copyfile(source, destination)
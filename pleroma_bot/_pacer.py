@@ -0,0 +1,125 @@
+import time
+import threading
+
+from datetime import datetime, timezone
+
+from . import logger
+from .i18n import _
+
+# Seconds to wait between posts when the instance doesn't report its rate
+# limits and no delay_post is configured
+DEFAULT_DELAY = 0.5
+# Share of the budget (requests left before the reset) below which requests
+# are spread until the reset instead of going as fast as possible
+RESERVE = 0.1
+
+
+class Pacer(object):
+    """
+    Paces the requests to the Fediverse instance (posts and media uploads)
+    with the rate limits it reports through the 'X-RateLimit-*' headers of
+    its responses.
+
+    Requests go as fast as the budget allows while there's plenty of it
+    left. Once it runs low, the remaining requests are spread until the
+    window resets, so we never get a 429. 'delay_post' (if configured) is
+    the minimum time between requests, and the delay used when the instance
+    doesn't report its rate limits.
+    """
+
+    def __init__(
+        self,
+        floor: float = None,
+        reserve: float = RESERVE,
+        sleep=time.sleep,
+    ):
+        self.floor = floor
+        self.reserve = reserve
+        self.windows = {}
+        self._next = {}
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def update(self, key: str, headers) -> bool:
+        """Updates the window of the kind of request with the rate limit
+        headers of a response
+
+        :param key: Kind of request (e.g. 'statuses' or 'media')
+        :type key: str
+        :param headers: Headers of the response
+        :returns: True if the response had rate limit headers
+        :rtype: bool
+        """
+        try:
+            window = {
+                "limit": int(headers["X-RateLimit-Limit"]),
+                "remaining": int(headers["X-RateLimit-Remaining"]),
+                "reset": _parse_reset(headers["X-RateLimit-Reset"]),
+            }
+        except (KeyError, TypeError, ValueError):
+            return False
+        with self._lock:
+            self.windows[key] = window
+        return True
+
+    def wait(self, key: str, use_floor: bool = True):
+        """Waits until the next request of its kind can be sent
+
+        :param key: Kind of request (e.g. 'statuses' or 'media')
+        :type key: str
+        :param use_floor: Whether the minimum time between requests applies
+            to this kind of request, or only the rate limits
+        :type use_floor: bool
+        """
+        with self._lock:
+            now = time.time()
+            ready = max(now, self._next.get(key, now))
+            window = self.windows.get(key)
+            delay = (self.floor or 0) if use_floor else 0
+            if window is None:
+                if use_floor and self.floor is None:
+                    delay = DEFAULT_DELAY
+            elif window["reset"] > ready:
+                if window["remaining"] <= 0:
+                    # Nothing left until the window resets
+                    ready = window["reset"]
+                else:
+                    if window["remaining"] <= window["limit"] * self.reserve:
+                        delay = max(
+                            delay,
+                            (window["reset"] - ready) / window["remaining"],
+                        )
+                    # Account for the request until a response tells us
+                    window["remaining"] -= 1
+            # Book the slot, so requests sent at the same time are paced too
+            self._next[key] = ready + delay
+            wait = ready - now
+        if wait > 0:
+            if wait > 60:
+                logger.warning(
+                    _(
+                        "Fediverse instance rate limit almost reached, "
+                        "waiting {wait}s before the next request..."
+                    ).format(wait=round(wait))
+                )
+            self._sleep(wait)
+
+
+def _parse_reset(reset) -> float:
+    """Returns the timestamp when the window resets. Mastodon reports it as
+    an ISO 8601 date, other instances as a timestamp or seconds left
+    """
+    try:
+        reset = float(reset)
+    except ValueError:
+        for date_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+            try:
+                date = datetime.strptime(reset, date_format)
+            except ValueError:
+                continue
+            return date.replace(tzinfo=timezone.utc).timestamp()
+        raise
+    # Anything lower than a year is the seconds left until the reset
+    if reset < 365 * 24 * 60 * 60:
+        reset += time.time()
+    return reset
@@ -21,7 +21,9 @@ def pin_pleroma(self, id_post):
     self.unpin_pleroma(pinned_file)
 
     pin_url = f"{self.pleroma_base_url}/api/v1/statuses/{id_post}/pin"
-    response = requests.post(pin_url, headers=self.header_pleroma)
+    response = self.session_pool.post(
+        pin_url, headers=self.header_pleroma
+    )
     logger.info(_("Pinning post:\t{}").format(str(response.text)))
     try:
         pin_id = json.loads(response.text)["id"]
@@ -50,7 +52,9 @@ def unpin_pleroma(self, pinned_file):
             f"{self.pleroma_base_url}/api/v1/statuses/"
             f"{previous_pinned_post_id}/unpin"
         )
-        response = requests.post(unpin_url, headers=self.header_pleroma)
+        response = self.session_pool.post(
+            unpin_url, headers=self.header_pleroma
+        )
         if not response.ok:
             response.raise_for_status()
         logger.info(_("Unpinning previous:\t{}").format(response.text))
@@ -90,7 +94,9 @@ def _find_pinned(self, pinned_file):
             statuses_url = headers_page_url
         else:
             statuses_url = pleroma_posts_url
-        response = requests.get(statuses_url, headers=self.header_pleroma)
+        response = self.session_pool.get(
+            statuses_url, headers=self.header_pleroma
+        )
         if not response.ok:
             response.raise_for_status()
         posts = json.loads(response.text)
@@ -120,7 +126,7 @@ def _get_pinned_tweet_id(self):
         "expansions": "pinned_tweet_id",
         "tweet.fields": "entities",
     }
-    response = requests.get(
+    response = self.session_pool.get(
         url, headers=self.header_twitter, params=params, auth=self.auth
     )
     if not response.ok:
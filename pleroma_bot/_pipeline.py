@@ -0,0 +1,211 @@
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+from .i18n import _
+
+# Items each stage can get ahead of the next one
+STAGE_QUEUE_SIZE = 4
+# Seconds to wait on a queue before checking if the pipeline was closed
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class _Error(object):
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Pipeline(object):
+    """
+    Runs a chain of stages, each in its own thread, connected by bounded
+    queues. Every stage takes the items of the previous one in order and
+    yields its own, so later stages start working on the first items while
+    earlier ones are still busy with the next ones, and the output keeps the
+    order of the source.
+
+    An exception in any stage is raised when iterating the pipeline, once
+    the items that went through before it are consumed.
+    """
+
+    def __init__(
+        self,
+        source,
+        stages: list,
+        maxsize: int = STAGE_QUEUE_SIZE,
+        executors: list = None,
+    ):
+        # Executors the stages hand their work to, shut down along with them
+        self._executors = executors or []
+        self._stop = threading.Event()
+        self._queues = [queue.Queue(maxsize) for _stage in stages]
+        self._queues.append(queue.Queue(maxsize))
+        self._threads = [
+            threading.Thread(
+                target=self._run_source, args=(source, self._queues[0])
+            )
+        ]
+        for idx, stage in enumerate(stages):
+            self._threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, self._queues[idx], self._queues[idx + 1]),
+                )
+            )
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if item is _END:
+                    return
+                if isinstance(item, _Error):
+                    raise item.error
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops every stage and waits for their threads to finish"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+
+    def _run_source(self, source, outbox):
+        try:
+            for item in source:
+                if not self._put(outbox, item):
+                    return
+        except BaseException as e:
+            self._put(outbox, _Error(e))
+            return
+        self._put(outbox, _END)
+
+    def _run_stage(self, stage, inbox, outbox):
+        while True:
+            item = self._get(inbox)
+            if item is None or item is _END or isinstance(item, _Error):
+                if item is not None:
+                    self._put(outbox, item)
+                return
+            try:
+                for output in stage(item):
+                    if not self._put(outbox, output):
+                        return
+            except BaseException as e:
+                self._put(outbox, _Error(e))
+                return
+
+    def _put(self, outbox, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, inbox):
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+
+def post_pipeline(self, pages):
+    """Processes the pages of tweets provided, downloads and uploads the
+    attachments of each tweet in stages that overlap, so the first tweet can
+    be posted as soon as it's ready instead of waiting for the whole page
+
+    :param pages: Pages of tweets, in the order they will be posted
+    :returns: Pipeline yielding tuples of ('tweet', tweet, tweets in the
+        page, future of the IDs of its media) for each tweet to post, in
+        order, and ('page', meta of the page) after the tweets of each page
+    :rtype: Pipeline
+    """
+    # The attachments of every tweet are downloaded by the same workers,
+    # each tweet waits for its own in a thread of the fetch executor
+    fetch_executor = ThreadPoolExecutor(
+        max_workers=self.download_pool.workers
+    )
+    download_executor = ThreadPoolExecutor(
+        max_workers=self.download_pool.workers
+    )
+    upload_executor = ThreadPoolExecutor(
+        max_workers=max(1, int(self.upload_workers))
+    )
+
+    def process(tweets):
+        logger.debug(f"tweets: \t {tweets}")
+
+        if 'meta' not in tweets:
+            error_msg = _(
+                "Unable to retrieve tweets. Is the account protected?"
+                " If so, you need to provide the following OAuth 1.0a"
+                " fields in the user config:\n - consumer_key \n "
+                "- consumer_secret \n - access_token_key \n "
+                "- access_token_secret"
+            )
+            logger.error(error_msg)
+
+        if tweets["meta"]["result_count"] > 0:
+            logger.info(
+                _("tweet count: \t {}").format(len(tweets['data']))
+            )
+            if self.poll_state is not None:
+                self.poll_state.observe(tweets["data"])
+            # Skip the tweets already posted, e.g. by a run that died
+            for tweet in tweets["data"][:]:
+                status_id = self.ledger.get(self.ledger_account, tweet["id"])
+                if status_id is not None:
+                    logger.info(
+                        _(
+                            "Tweet {tweet_id} already posted as {status_id}, "
+                            "skipping it"
+                        ).format(tweet_id=tweet["id"], status_id=status_id)
+                    )
+                    tweets["data"].remove(tweet)
+            # Put oldest first to iterate them and post them in order
+            tweets["data"].reverse()
+            tweets_to_post = self.process_tweets(tweets, download_media=False)
+            logger.debug(f"tweets_processed: \t {tweets_to_post['data']}")
+            for tweet in tweets_to_post["data"]:
+                yield "tweet", tweet, len(tweets_to_post["data"])
+        yield "page", tweets["meta"]
+
+    def download(item):
+        if item[0] == "tweet" and self.media_upload:
+            tweet = item[1]
+            media = self.pending_media.pop(tweet["id"], [])
+            item = (*item, fetch_executor.submit(
+                self._fetch_tweets_media, [(media, tweet)], download_executor
+            ))
+        yield item
+
+    def upload(item):
+        if item[0] == "tweet":
+            if self.media_upload:
+                # Raises here if the download failed, after the tweets
+                # before it went through
+                item[3].result()
+            tweet = item[1]
+            item = (*item[:3], upload_executor.submit(
+                self._upload_tweet_media, tweet["id"]
+            ))
+        yield item
+
+    return Pipeline(
+        pages,
+        [process, download, upload],
+        executors=[fetch_executor, download_executor, upload_executor],
+    )
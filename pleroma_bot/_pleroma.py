@@ -4,7 +4,9 @@ from json.decoder import JSONDecodeError
 import re
 import json
 import shutil
+import hashlib
 import requests
+import itertools
 import mimetypes
 from datetime import datetime, timedelta
 
@@ -17,7 +19,10 @@ except ImportError:
 
 from . import logger
 from .i18n import _
-from ._utils import random_string, guess_type
+from ._utils import random_string, guess_type, file_sha256
+from ._utils import guess_type_buffer
+from ._download import AttachmentTooLarge, iter_chunks
+from ._processing import _log_too_large, _log_not_found
 
 
 def get_date_last_pleroma_post(self):
@@ -30,7 +35,9 @@ def get_date_last_pleroma_post(self):
         f"{self.pleroma_base_url}/api/v1/accounts/"
         f"{self.pleroma_username}/statuses"
     )
-    response = requests.get(pleroma_posts_url, headers=self.header_pleroma)
+    response = self.session_pool.get(
+        pleroma_posts_url, headers=self.header_pleroma
+    )
     if not response.ok:
         response.raise_for_status()
     posts = json.loads(response.text)
@@ -52,7 +59,9 @@ def get_date_last_pleroma_post(self):
     return date_pleroma
 
 
-def post_pleroma(self, tweet: tuple, poll: dict, sensitive: bool) -> str:
+def post_pleroma(
+    self, tweet: tuple, poll: dict, sensitive: bool, media_ids: list = None
+) -> str:
     """Post the given text to the Pleroma instance associated with the
     User object
 
@@ -64,61 +73,20 @@ def post_pleroma(self, tweet: tuple, poll: dict, sensitive: bool) -> str:
     :type poll: dict
     :param sensitive: if tweet is possibly sensitive or not
     :type sensitive: bool
+    :param media_ids: IDs of the media of the tweet if they were already
+        uploaded, otherwise they are uploaded before posting it
+    :type media_ids: list
     :returns: id of post
     :rtype: str
     """
     # TODO: transform twitter links to nitter links, if self.nitter
     #  'true' in resolved shortened urls
     pleroma_post_url = f"{self.pleroma_base_url}/api/v1/statuses"
-    pleroma_media_url = f"{self.pleroma_base_url}/api/v1/media"
 
     tweet_id = tweet[0]
     tweet_text = tweet[1]
-    tweet_folder = os.path.join(self.tweets_temp_path, tweet_id)
-    media_files = os.listdir(tweet_folder)
-    media_ids = []
-    if self.media_upload:
-        for file in media_files:
-            media_file = open(os.path.join(tweet_folder, file), "rb")
-            file_size = os.stat(os.path.join(tweet_folder, file)).st_size
-            mime_type = guess_type(os.path.join(tweet_folder, file))
-            timestamp = str(datetime.now().timestamp())
-            file_name = (
-                f"pleromapyupload_"
-                f"{timestamp}"
-                f"_"
-                f"{random_string(10)}"
-                f"{mimetypes.guess_extension(mime_type)}"
-            )
-            file_description = (file_name, media_file, mime_type)
-            files = {"file": file_description}
-            response = requests.post(
-                pleroma_media_url, headers=self.header_pleroma, files=files
-            )
-            try:
-                if not response.ok:
-                    response.raise_for_status()
-            except requests.exceptions.HTTPError:
-                if response.status_code == 413:
-                    size_msg = _(
-                        "Exception occurred"
-                        "\nMedia size too large:"
-                        "\nFilename: {file}"
-                        "\nSize: {size}MB"
-                        "\nConsider increasing the attachment"
-                        "\n size limit of your instance"
-                    ).format(file=file, size=round(file_size / 1048576, 2))
-                    logger.error(size_msg)
-                    pass
-                else:
-                    response.raise_for_status()
-            try:
-                media_ids.append(json.loads(response.text)["id"])
-            except (KeyError, JSONDecodeError):
-                logger.warning(
-                    _("Error uploading media:\t{}").format(str(response.text))
-                )
-                pass
+    if media_ids is None:
+        media_ids = _upload_tweet_media(self, tweet_id)
 
     if self.signature:
         signature = f"\n\n 🐦🔗: {self.twitter_url}/status/{tweet_id}"
@@ -146,16 +114,216 @@ def post_pleroma(self, tweet: tuple, poll: dict, sensitive: bool) -> str:
     if hasattr(self, "rich_text"):
         if self.rich_text:
             data.update({"content_type": self.content_type})
-    response = requests.post(
-        pleroma_post_url, data, headers=self.header_pleroma
+    # If the same tweet is posted again (e.g. retrying after a crash), the
+    # instance returns the status already created instead of a new one.
+    # Instances don't scope the key to the account posting, so it has to
+    # tell apart the same tweet mirrored to different accounts
+    headers = dict(self.header_pleroma)
+    headers["Idempotency-Key"] = _idempotency_key(self, tweet_id)
+    self.pacer.wait("statuses")
+    response = self.session_pool.post(
+        pleroma_post_url, data, headers=headers
     )
+    self.pacer.update("statuses", response.headers)
     if not response.ok:
         response.raise_for_status()
     logger.info(_("Post in Pleroma:\t{}").format(str(response)))
     post_id = json.loads(response.text)["id"]
+    self.ledger.add(self.ledger_account, tweet_id, post_id)
     return post_id
 
 
+def _idempotency_key(self, tweet_id: str) -> str:
+    account_tweet = f"{self.ledger_account}/{tweet_id}"
+    return f"pleroma-bot-{hashlib.sha256(account_tweet.encode()).hexdigest()}"
+
+
+def _upload_tweet_media(self, tweet_id: str) -> list:
+    """Uploads the attachments of a tweet to the Fediverse instance
+
+    :param tweet_id: ID of the tweet
+    :type tweet_id: str
+    :returns: IDs of the media uploaded
+    :rtype: list
+    """
+    tweet_folder = os.path.join(self.tweets_temp_path, tweet_id)
+    media_files = sorted(os.listdir(tweet_folder))
+    media_ids = []
+    if self.media_upload:
+        media_streams = self.media_streams.pop(tweet_id, None)
+        if media_streams is not None:
+            for download in media_streams:
+                try:
+                    media_id = _stream_media(self, *download)
+                except AttachmentTooLarge as e:
+                    _log_too_large(self, e)
+                    continue
+                except requests.exceptions.HTTPError as e:
+                    if e.response is None or e.response.status_code != 404:
+                        raise
+                    # Same as when downloading them, the attachments after a
+                    # missing one are ignored
+                    _log_not_found(tweet_id, download[0])
+                    break
+                if media_id:
+                    media_ids.append(media_id)
+        else:
+            for file in media_files:
+                media_id = _upload_media(
+                    self, os.path.join(tweet_folder, file)
+                )
+                if media_id:
+                    media_ids.append(media_id)
+    return media_ids
+
+
+def _upload_media(self, file_path: str) -> str:
+    """Uploads a file to the Fediverse instance
+
+    :param file_path: Path of the file to upload
+    :type file_path: str
+    :returns: ID of the media uploaded or None if it couldn't be uploaded
+    :rtype: str
+    """
+    pleroma_media_url = f"{self.pleroma_base_url}/api/v1/media"
+    file_size = os.stat(file_path).st_size
+    mime_type = guess_type(file_path)
+    with open(file_path, "rb") as media_file:
+        files = {"file": (_upload_name(mime_type), media_file, mime_type)}
+        self.pacer.wait("media", use_floor=False)
+        response = self.session_pool.post(
+            pleroma_media_url, headers=self.header_pleroma, files=files
+        )
+        self.pacer.update("media", response.headers)
+    return _media_id(response, os.path.basename(file_path), file_size)
+
+
+def _stream_media(
+    self,
+    media_url: str,
+    path: str,
+    max_size: int = None,
+    expected_size: int = None,
+) -> str:
+    """Uploads an attachment to the Fediverse instance while downloading it,
+    without writing it to disk. If the upload fails, the attachment is
+    downloaded to disk and uploaded again from there
+
+    :param media_url: URL of the attachment
+    :type media_url: str
+    :param path: Path of the file to write without its extension, if the
+        upload needs to be retried
+    :type path: str
+    :param max_size: Size limit of the attachment in bytes
+    :type max_size: int
+    :param expected_size: Estimated size of the attachment in bytes
+    :type expected_size: int
+    :returns: ID of the media uploaded or None if it couldn't be uploaded
+    :rtype: str
+    """
+    pleroma_media_url = f"{self.pleroma_base_url}/api/v1/media"
+    uploaded = [0]
+    try:
+        with self.download_pool.open(
+            media_url, max_size, expected_size
+        ) as download:
+            chunks = iter_chunks(download.raw, media_url, max_size)
+            head = next(chunks, b"")
+            # Sniff the MIME type from the first bytes of the attachment
+            mime_type = guess_type_buffer(
+                head, download.headers.get("Content-Type")
+            )
+            boundary = random_string(32)
+            headers = dict(self.header_pleroma)
+            headers["Content-Type"] = (
+                f"multipart/form-data; boundary={boundary}"
+            )
+            body = _multipart_stream(
+                boundary,
+                _upload_name(mime_type),
+                mime_type,
+                itertools.chain([head], chunks),
+                uploaded,
+            )
+            self.pacer.wait("media", use_floor=False)
+            response = self.session_pool.post(
+                pleroma_media_url, data=body, headers=headers
+            )
+            self.pacer.update("media", response.headers)
+        if response.status_code < 500:
+            return _media_id(response, media_url, uploaded[0])
+        error = response.status_code
+    except (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.ChunkedEncodingError,
+    ) as e:
+        error = e
+    logger.warning(
+        _(
+            "Unable to stream {url} to the instance ({error}), downloading "
+            "it to upload it again..."
+        ).format(url=media_url, error=error)
+    )
+    file_path = self.download_pool.download(
+        media_url, path, max_size, expected_size
+    )
+    try:
+        return _upload_media(self, file_path)
+    finally:
+        os.remove(file_path)
+
+
+def _multipart_stream(boundary, file_name, mime_type, chunks, uploaded):
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; '
+        f'filename="{file_name}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode()
+    for chunk in chunks:
+        uploaded[0] += len(chunk)
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def _upload_name(mime_type: str) -> str:
+    timestamp = str(datetime.now().timestamp())
+    return (
+        f"pleromapyupload_"
+        f"{timestamp}"
+        f"_"
+        f"{random_string(10)}"
+        f"{mimetypes.guess_extension(mime_type)}"
+    )
+
+
+def _media_id(response, file: str, file_size: int) -> str:
+    try:
+        if not response.ok:
+            response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        if response.status_code == 413:
+            size_msg = _(
+                "Exception occurred"
+                "\nMedia size too large:"
+                "\nFilename: {file}"
+                "\nSize: {size}MB"
+                "\nConsider increasing the attachment"
+                "\n size limit of your instance"
+            ).format(file=file, size=round(file_size / 1048576, 2))
+            logger.error(size_msg)
+            pass
+        else:
+            response.raise_for_status()
+    try:
+        return json.loads(response.text)["id"]
+    except (KeyError, JSONDecodeError):
+        logger.warning(
+            _("Error uploading media:\t{}").format(str(response.text))
+        )
+        return None
+
+
 def update_pleroma(self):
     """Update the Pleroma user info with the one retrieved from Twitter
     when the User object was instantiated.
@@ -167,43 +335,16 @@ def update_pleroma(self):
     * Screen name
     * Additional metadata fields
 
+    Only the parts that changed since the last update (according to the
+    profile fingerprint stored in the user folder) are downloaded and sent.
+
     :returns: None
     """
-    # Get the biggest resolution for the profile picture (400x400)
-    # instead of 'normal'
-    if self.profile_image_url:
-        profile_img_big = re.sub(r"normal", "400x400", self.profile_image_url)
-        response = requests.get(profile_img_big, stream=True)
-        if not response.ok:
-            response.raise_for_status()
-        response.raw.decode_content = True
-        with open(self.avatar_path, "wb") as outfile:
-            shutil.copyfileobj(response.raw, outfile)
-
-    if self.profile_banner_url:
-        response = requests.get(self.profile_banner_url, stream=True)
-        if not response.ok:
-            response.raise_for_status()
-        response.raw.decode_content = True
-        with open(self.header_path, "wb") as outfile:
-            shutil.copyfileobj(response.raw, outfile)
-
-    # Set it on Pleroma
-    cred_url = f"{self.pleroma_base_url}/api/v1/accounts/update_credentials"
-
     # Construct fields
     fields = []
     for field_item in self.fields:
         field = (field_item["name"], field_item["value"])
         fields.append(field)
-    data = {"note": self.bio_text, "display_name": self.display_name}
-
-    if self.profile_image_url:
-        data.update({"avatar": self.avatar_path})
-
-    if self.profile_banner_url:
-        data.update({"header": self.header_path})
-
     if len(fields) > 4:
         raise Exception(
             _(
@@ -211,37 +352,75 @@ def update_pleroma(self):
                 "\nProvided: {}. Exiting..."
             ).format(len(fields))
         )
-    for idx, (field_name, field_value) in enumerate(fields):
-        data[f'fields_attributes["{str(idx)}"][name]'] = field_name
-        data[f'fields_attributes["{str(idx)}"][value]'] = field_value
 
-    files = {}
-    timestamp = str(datetime.now().timestamp())
+    previous = _load_profile_fingerprint(self)
+    fingerprint = {
+        "note": self.bio_text,
+        "display_name": self.display_name,
+        "fields": [list(field) for field in fields],
+    }
+    # Get the biggest resolution for the profile picture (400x400)
+    # instead of 'normal'
     if self.profile_image_url:
-        avatar = open(self.avatar_path, "rb")
-        avatar_mime_type = guess_type(self.avatar_path)
-        avatar_file_name = (
-            f"pleromapyupload_{timestamp}_"
-            f"{random_string(10)}"
-            f"{mimetypes.guess_extension(avatar_mime_type)}"
+        profile_img_big = re.sub(r"normal", "400x400", self.profile_image_url)
+        fingerprint.update(
+            _fingerprint_image(
+                self, "avatar", profile_img_big, self.avatar_path, previous
+            )
         )
-        files.update({"avatar": (avatar_file_name, avatar, avatar_mime_type)})
     if self.profile_banner_url:
-        header = open(self.header_path, "rb")
-        header_mime_type = guess_type(self.header_path)
-        header_file_name = (
+        fingerprint.update(
+            _fingerprint_image(
+                self,
+                "header",
+                self.profile_banner_url,
+                self.header_path,
+                previous,
+            )
+        )
+
+    # Set it on Pleroma
+    cred_url = f"{self.pleroma_base_url}/api/v1/accounts/update_credentials"
+
+    data = {}
+    for attribute in ("note", "display_name"):
+        if fingerprint[attribute] != previous.get(attribute):
+            data[attribute] = fingerprint[attribute]
+    if fingerprint["fields"] != previous.get("fields"):
+        for idx, (field_name, field_value) in enumerate(fields):
+            data[f'fields_attributes["{str(idx)}"][name]'] = field_name
+            data[f'fields_attributes["{str(idx)}"][value]'] = field_value
+
+    files = {}
+    timestamp = str(datetime.now().timestamp())
+    for image, image_path in (
+        ("avatar", self.avatar_path),
+        ("header", self.header_path),
+    ):
+        image_hash = fingerprint.get(f"{image}_sha256")
+        if image_hash is None or image_hash == previous.get(f"{image}_sha256"):
+            continue
+        data.update({image: image_path})
+        image_file = open(image_path, "rb")
+        image_mime_type = guess_type(image_path)
+        image_file_name = (
             f"pleromapyupload_{timestamp}_"
             f"{random_string(10)}"
-            f"{mimetypes.guess_extension(header_mime_type)}"
+            f"{mimetypes.guess_extension(image_mime_type)}"
         )
-        files.update({"header": (header_file_name, header, header_mime_type)})
+        files.update({image: (image_file_name, image_file, image_mime_type)})
+
+    if not data:
+        logger.info(_("Profile unchanged, skipping update"))
+        return
 
-    response = requests.patch(
+    response = self.session_pool.patch(
         cred_url, data, headers=self.header_pleroma, files=files
     )
     try:
         if not response.ok:
             response.raise_for_status()
+        _save_profile_fingerprint(self, fingerprint)
     except requests.exceptions.HTTPError:
         if response.status_code == 422:
             bio_msg = _(
@@ -257,3 +436,44 @@ def update_pleroma(self):
             response.raise_for_status()
     logger.info(_("Updating profile:\t {}").format(str(response)))
     return
+
+
+def _fingerprint_image(self, image, url, image_path, previous):
+    """Downloads the profile image to 'image_path' unless it's the same URL
+    we downloaded last time and the file is still there
+
+    :param image: Name of the image in the fingerprint ('avatar', 'header')
+    :param url: URL of the image on Twitter
+    :param image_path: Where to store the image
+    :param previous: Profile fingerprint of the last update
+    :returns: fingerprint entries for the image (URL and content hash)
+    :rtype: dict
+    """
+    if (
+        url != previous.get(f"{image}_url")
+        or not os.path.isfile(image_path)
+        or previous.get(f"{image}_sha256") is None
+    ):
+        response = self.session_pool.get(url, stream=True)
+        if not response.ok:
+            response.raise_for_status()
+        response.raw.decode_content = True
+        with open(image_path, "wb") as outfile:
+            shutil.copyfileobj(response.raw, outfile)
+        image_hash = file_sha256(image_path)
+    else:
+        image_hash = previous[f"{image}_sha256"]
+    return {f"{image}_url": url, f"{image}_sha256": image_hash}
+
+
+def _load_profile_fingerprint(self):
+    try:
+        with open(self.profile_fingerprint_path, "r") as file:
+            return json.load(file)
+    except (OSError, JSONDecodeError):
+        return {}
+
+
+def _save_profile_fingerprint(self, fingerprint):
+    with open(self.profile_fingerprint_path, "w") as file:
+        json.dump(fingerprint, file)
@@ -0,0 +1,177 @@
+import json
+import time
+
+from datetime import datetime, timezone
+from json.decoder import JSONDecodeError
+
+from .i18n import _
+
+# Bounds of the polling interval (in seconds) of each user in daemon mode
+POLL_INTERVAL_MIN = 60
+POLL_INTERVAL_MAX = 6 * 60 * 60
+# Interval of a user we know nothing about yet
+POLL_INTERVAL_START = 5 * 60
+# Weight of the latest gap between tweets in their moving average
+GAP_WEIGHT = 0.3
+# Share of the average gap between tweets to wait between polls, so we poll
+# a couple of times for each tweet we expect
+GAP_SHARE = 0.5
+# How much longer to wait after each poll without new tweets
+IDLE_BACKOFF = 2
+
+
+class PollState(object):
+    """
+    Adaptive polling interval of a user, built from the time between the
+    tweets it retrieves: accounts tweeting often are polled often, and the
+    interval grows exponentially while an account has nothing new, always
+    within the configured bounds.
+
+    Only the daemon keeps track of it (runs launched by cron leave it
+    alone). The state lives in the user folder, so it survives restarts of
+    the daemon.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        min_interval: float = POLL_INTERVAL_MIN,
+        max_interval: float = POLL_INTERVAL_MAX,
+    ):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(
+                _(
+                    "poll_interval_min must be positive and lower than "
+                    "poll_interval_max. poll_interval_min: {min}, "
+                    "poll_interval_max: {max}"
+                ).format(min=min_interval, max=max_interval)
+            )
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = self._clamp(POLL_INTERVAL_START)
+        # Moving average of the seconds between tweets
+        self.mean_gap = None
+        self.last_tweet_at = None
+        self.polled_at = None
+        self._observed = []
+        self.load()
+
+    @classmethod
+    def from_config(cls, path: str, user_cfg: dict, cfg: dict):
+        """Builds the PollState of a user with the bounds defined in the
+        config, for the user or globally
+
+        :param path: Path of the file where the state is kept
+        :type path: str
+        :param user_cfg: User mapping from the config
+        :type user_cfg: dict
+        :param cfg: Parsed config.yml
+        :type cfg: dict
+        :returns: PollState bounded as configured (or with the defaults)
+        :rtype: PollState
+        """
+        kwargs = {}
+        for attribute in ("poll_interval_min", "poll_interval_max"):
+            value = user_cfg.get(attribute, cfg.get(attribute))
+            if value is not None:
+                kwargs[attribute[len("poll_interval_"):] + "_interval"] = (
+                    float(value)
+                )
+        return cls(path, **kwargs)
+
+    def load(self):
+        """Loads the state saved by previous runs"""
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            self.interval = self._clamp(float(state["interval"]))
+            self.mean_gap = state.get("mean_gap")
+            self.last_tweet_at = state.get("last_tweet_at")
+            self.polled_at = state.get("polled_at")
+        except (OSError, JSONDecodeError, KeyError, TypeError, ValueError):
+            pass
+
+    def save(self):
+        state = {
+            "interval": self.interval,
+            "mean_gap": self.mean_gap,
+            "last_tweet_at": self.last_tweet_at,
+            "polled_at": self.polled_at,
+        }
+        with open(self.path, "w") as file:
+            json.dump(state, file)
+
+    def observe(self, tweets: list):
+        """Takes note of when the tweets retrieved were posted
+
+        :param tweets: Tweets retrieved, with their 'created_at' date
+        :type tweets: list
+        """
+        for tweet in tweets:
+            try:
+                self._observed.append(_parse_date(tweet["created_at"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    def update(self, now: float = None) -> float:
+        """Adapts the interval to the tweets observed since the last poll
+        and saves the state
+
+        :param now: Timestamp of the poll (the current time by default)
+        :type now: float
+        :returns: seconds to wait until the next poll
+        :rtype: float
+        """
+        if now is None:
+            now = time.time()
+        new_tweets = sorted(
+            posted_at
+            for posted_at in set(self._observed)
+            if self.last_tweet_at is None or posted_at > self.last_tweet_at
+        )
+        self._observed = []
+        if new_tweets:
+            previous = self.last_tweet_at
+            for posted_at in new_tweets:
+                if previous is not None:
+                    gap = posted_at - previous
+                    if self.mean_gap is None:
+                        self.mean_gap = gap
+                    else:
+                        self.mean_gap = (
+                            GAP_WEIGHT * gap
+                            + (1 - GAP_WEIGHT) * self.mean_gap
+                        )
+                previous = posted_at
+            self.last_tweet_at = new_tweets[-1]
+            if self.mean_gap is not None:
+                self.interval = self._clamp(self.mean_gap * GAP_SHARE)
+        else:
+            self.interval = self._clamp(self.interval * IDLE_BACKOFF)
+        self.polled_at = now
+        self.save()
+        return self.interval
+
+    def next_poll(self) -> float:
+        """Returns when the user is due to be polled again
+
+        :returns: timestamp of the next poll or None if it was never polled
+        :rtype: float
+        """
+        if self.polled_at is None:
+            return None
+        return self.polled_at + self.interval
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+
+def _parse_date(date: str) -> float:
+    for date_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            parsed = datetime.strptime(date, date_format)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=timezone.utc).timestamp()
+    raise ValueError(date)
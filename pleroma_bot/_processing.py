@@ -2,11 +2,11 @@ import os
 import re
 import json
 import html
-import shutil
 import requests
-import mimetypes
 
 from ._utils import spinner
+from ._timeline import Timeline
+from ._download import AttachmentTooLarge
 
 # Try to import libmagic
 # if it fails just use mimetypes
@@ -18,15 +18,33 @@ except ImportError:
 from . import logger
 from .i18n import _
 
+# Twitter's tweets lookups take up to 100 IDs per request
+POLLS_BATCH_SIZE = 100
+VIDEOS_BATCH_SIZE = 100
+# Prefix of the v2 media_key for each type of v1.1 media
+MEDIA_KEY_PREFIXES = {"photo": "3", "video": "7", "animated_gif": "16"}
+
+# Used to find links in tweets without URL entities
+URI_REGEX = re.compile(
+    r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]"
+    r"{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*"
+    r"\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{}"
+    r';:\'".,<>?«»“”‘’]))'
+)
+
 
 @spinner(_("Processing tweets... "))
-def process_tweets(self, tweets_to_post):
+def process_tweets(self, tweets_to_post, download_media: bool = True):
     """Transforms tweets for posting them to Pleroma
     Expands shortened URLs
     Downloads tweet related media and prepares them for upload
 
     :param tweets_to_post: Dict of tweet objects to be processed
     :type tweets_to_post: dict
+    :param download_media: Whether to download the media of the tweets now
+        or leave it in 'pending_media' to be downloaded later, tweet by
+        tweet, with _fetch_tweets_media
+    :type download_media: bool
     :returns: Tweets ready to be published
     :rtype: list
     """
@@ -65,6 +83,33 @@ def process_tweets(self, tweets_to_post):
                 tweets_to_post["data"].remove(tweet)
                 pass
 
+    # Includes indexed by ID, to find what each tweet references directly
+    timeline = tweets_to_post
+    if not isinstance(timeline, Timeline):
+        timeline = Timeline(tweets_to_post)
+
+    # Resolve the links of every tweet without URL entities at once
+    links = [
+        match.group()
+        for tweet in tweets_to_post["data"]
+        if "urls" not in tweet.get("entities", {})
+        for match in _find_links(tweet["text"])
+    ]
+    if links:
+        self.url_resolver.resolve_all(links)
+
+    # Polls missing from the includes are retrieved all at once
+    _get_polls(self, tweets_to_post["data"], timeline)
+
+    # And so are the variants of the videos
+    _get_videos(self, [
+        (tweet["id"], timeline.get_media(media_key))
+        for tweet in tweets_to_post["data"]
+        for media_key in tweet.get("attachments", {}).get("media_keys", [])
+        if _is_video(timeline.get_media(media_key))
+    ])
+
+    tweets_media = []
     for tweet in tweets_to_post["data"]:
         media = []
         tweet["text"] = _expand_urls(self, tweet)
@@ -79,46 +124,71 @@ def process_tweets(self, tweets_to_post):
             pass
         try:
             for item in tweet["attachments"]["media_keys"]:
-                for media_include in tweets_to_post["includes"]["media"]:
-                    media_url = _get_media_url(
-                        self, item, media_include, tweet
-                    )
-                    if media_url:
-                        media.extend(media_url)
+                media_include = timeline.get_media(item)
+                if media_include is None:
+                    continue
+                media_url = _get_media_url(self, item, media_include, tweet)
+                if media_url:
+                    media.extend(media_url)
         except KeyError:
             pass
         # Create folder to store attachments related to the tweet ID
         tweet_path = os.path.join(self.tweets_temp_path, tweet["id"])
         os.makedirs(tweet_path, exist_ok=True)
-        # Download media only if we plan to upload it later
-        if self.media_upload:
-            _download_media(self, media, tweet)
+        tweets_media.append((media, tweet))
         # Process poll if exists and no media is used
-        tweet["polls"] = _process_polls(self, tweet, media)
+        tweet["polls"] = _process_polls(self, tweet, media, timeline)
+
+    # Download media only if we plan to upload it later, all the attachments
+    # of the page at once
+    if self.media_upload:
+        if download_media:
+            _fetch_tweets_media(self, tweets_media)
+        else:
+            for media, tweet in tweets_media:
+                self.pending_media[tweet["id"]] = media
 
     return tweets_to_post
 
 
-def _process_polls(self, tweet, media):
+def _fetch_tweets_media(self, tweets_media, executor=None):
+    """Downloads the attachments of the tweets, or prepares them to be
+    streamed to the Fediverse instance if 'stream_media' is enabled
+
+    :param tweets_media: tuples of (attachments, tweet)
+    :type tweets_media: list
+    :param executor: Executor to run the downloads in, if they are shared
+        with other tweets
+    :type executor: concurrent.futures.Executor
+    """
+    if self.stream_media:
+        _stream_tweets_media(self, tweets_media)
+    else:
+        _download_tweets_media(self, tweets_media, executor)
+
+
+def _process_polls(self, tweet, media, timeline=None):
+    """Converts the poll of the tweet (if it has one and no media is
+    attached) to a Pleroma poll
+
+    :param tweet: Tweet object
+    :type tweet: dict
+    :param media: Media attached to the tweet
+    :type media: list
+    :param timeline: Tweets the tweet belongs to, whose includes should
+        have the poll. If they don't, the poll is retrieved from Twitter
+    :type timeline: Timeline
+    :returns: Pleroma poll or None
+    :rtype: dict
+    """
     try:
         if tweet["attachments"]["poll_ids"] and not media:
-
-            # tweet_poll = tweet['includes']['polls']
-            poll_url = f"{self.twitter_base_url_v2}/tweets"
-
-            params = {
-                "ids": tweet["id"],
-                "expansions": "attachments.poll_ids",
-                "poll.fields": "duration_minutes," "options",
-            }
-
-            response = requests.get(
-                poll_url, headers=self.header_twitter, params=params
-            )
-            if not response.ok:
-                response.raise_for_status()
-            response_content = json.loads(response.content)
-            tweet_poll = response_content["includes"]["polls"][0]
+            if timeline is None:
+                timeline = Timeline()
+            poll_id = tweet["attachments"]["poll_ids"][0]
+            if timeline.get_poll(poll_id) is None:
+                _get_polls(self, [tweet], timeline)
+            tweet_poll = timeline.get_poll(poll_id)
 
             pleroma_poll = {
                 "options": [
@@ -132,78 +202,241 @@ def _process_polls(self, tweet, media):
 
         else:
             tweet["polls"] = None
-    except KeyError:
+    except (KeyError, TypeError):
         tweet["polls"] = None
         pass
 
     return tweet["polls"]
 
 
+def _get_polls(self, tweets, timeline):
+    """Retrieves the polls of the tweets provided which are missing from
+    the includes of the timeline, up to 100 tweets per request, and adds
+    them to it
+
+    :param tweets: Tweet objects
+    :type tweets: list
+    :param timeline: Timeline to add the polls to
+    :type timeline: Timeline
+    """
+    missing = [
+        tweet["id"]
+        for tweet in tweets
+        if any(
+            timeline.get_poll(poll_id) is None
+            for poll_id in tweet.get("attachments", {}).get("poll_ids", [])
+        )
+    ]
+    for idx in range(0, len(missing), POLLS_BATCH_SIZE):
+        poll_url = f"{self.twitter_base_url_v2}/tweets"
+        params = {
+            "ids": ",".join(missing[idx:idx + POLLS_BATCH_SIZE]),
+            "expansions": "attachments.poll_ids",
+            "poll.fields": "duration_minutes," "options",
+        }
+        response = self.session_pool.get(
+            poll_url, headers=self.header_twitter, params=params
+        )
+        if not response.ok:
+            response.raise_for_status()
+        response_content = json.loads(response.content)
+        timeline.merge({"includes": response_content.get("includes", {})})
+
+
 def _download_media(self, media, tweet):
-    for idx, item in enumerate(media):
-        if item["type"] != "video" and item["type"] != "animated_gif":
-            media_url = item["url"]
-        else:
-            media_url = _get_best_bitrate_video(self, item)
+    """Downloads the attachments of a tweet into its folder
+
+    :param media: Attachments of the tweet
+    :type media: list
+    :param tweet: Tweet the attachments belong to
+    :type tweet: dict
+    """
+    _download_tweets_media(self, [(media, tweet)])
 
-        if media_url:
-            response = requests.get(media_url, stream=True)
+
+def _download_tweets_media(self, tweets_media, executor=None):
+    """Downloads the attachments of several tweets concurrently through the
+    DownloadPool, naming them after their position in the tweet. If an
+    attachment isn't found (404) it's ignored, along with the ones after it
+    in the same tweet
+
+    :param tweets_media: tuples of (attachments, tweet)
+    :type tweets_media: list
+    :param executor: Executor to run the downloads in, if they are shared
+        with other tweets
+    :type executor: concurrent.futures.Executor
+    """
+    downloads = _media_downloads(self, tweets_media)
+    # Attachments already in the media cache aren't downloaded again
+    cached = {}
+    if self.media_cache is not None:
+        for idx, (tweet, cache_key, media_url, path, *_args) in enumerate(
+            downloads
+        ):
+            file_path = self.media_cache.get(cache_key, path)
+            if file_path:
+                cached[idx] = file_path
+    skipped = set()
+    futures = self.download_pool.download_all(
+        [
+            download[2:] for idx, download in enumerate(downloads)
+            if idx not in cached
+        ],
+        executor,
+    )
+    try:
+        for idx, download in enumerate(downloads):
+            tweet, cache_key, media_url, path, max_size = download[:5]
+            future = None if idx in cached else next(futures)
+            if id(tweet) in skipped:
+                # Already downloaded (or downloading) when the previous
+                # attachment turned out to be missing
+                if future is None:
+                    os.remove(cached[idx])
+                elif not future.cancel():
+                    try:
+                        os.remove(future.result())
+                    except Exception:
+                        pass
+                continue
             try:
-                if not response.ok:
-                    response.raise_for_status()
-            except requests.exceptions.HTTPError:
-                if response.status_code == 404:
-                    att_not_found = _(
-                        "Exception occurred"
-                        "\nMedia not found (404)"
-                        "\n{tweet} - {media_url}"
-                        "\nIgnoring attachment and continuing..."
-                    ).format(tweet=tweet, media_url=media_url)
-                    logger.warning(att_not_found)
-                    return
-                else:
-                    response.raise_for_status()
-            response.raw.decode_content = True
-            filename = str(idx) + mimetypes.guess_extension(
-                response.headers["Content-Type"]
+                if future is None:
+                    file_path = cached[idx]
+                    file_size = os.stat(file_path).st_size
+                    # Limits may differ between users sharing the cache
+                    if max_size is not None and file_size > max_size:
+                        os.remove(file_path)
+                        raise AttachmentTooLarge(media_url, file_size)
+                    continue
+                file_path = future.result()
+            except AttachmentTooLarge as e:
+                _log_too_large(self, e)
+                continue
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                _log_not_found(tweet, media_url)
+                skipped.add(id(tweet))
+                continue
+            if self.media_cache is not None:
+                self.media_cache.put(cache_key, file_path)
+    finally:
+        futures.close()
+        if self.media_cache is not None:
+            self.media_cache.evict()
+
+
+def _stream_tweets_media(self, tweets_media):
+    """Keeps the attachments of several tweets to be streamed straight to
+    the Fediverse instance when posting them, instead of downloading them
+
+    :param tweets_media: tuples of (attachments, tweet)
+    :type tweets_media: list
+    """
+    media_streams = {}
+    for tweet, _key, *download in _media_downloads(self, tweets_media):
+        media_streams.setdefault(tweet["id"], []).append(download)
+    self.media_streams.update(media_streams)
+
+
+def _media_downloads(self, tweets_media):
+    """Returns what's needed to download each attachment of the tweets
+
+    :param tweets_media: tuples of (attachments, tweet)
+    :type tweets_media: list
+    :returns: tuples of (tweet, key in the media cache, URL, path of the
+        file without its extension, size limit, expected size) for each
+        attachment
+    :rtype: list
+    """
+    max_size = getattr(self, "file_max_size_bytes", None)
+    downloads = []
+    for media, tweet in tweets_media:
+        if tweet is not None:
+            tweet_path = os.path.join(self.tweets_temp_path, tweet["id"])
+        else:
+            tweet_path = self.tweets_temp_path
+        for idx, item in enumerate(media):
+            expected_size = None
+            if item["type"] != "video" and item["type"] != "animated_gif":
+                media_url = item["url"]
+            else:
+                media_url = _get_best_bitrate_video(self, item)
+                expected_size = _get_video_size(item, media_url)
+            if media_url:
+                path = os.path.join(tweet_path, str(idx))
+                downloads.append((
+                    tweet,
+                    _cache_key(item, media_url),
+                    media_url,
+                    path,
+                    max_size,
+                    expected_size,
+                ))
+    return downloads
+
+
+def _cache_key(item, media_url):
+    if "media_key" in item:
+        return item["media_key"]
+    if "id_str" in item:
+        return _media_key(item)
+    return media_url
+
+
+def _log_too_large(self, error):
+    logger.error(
+        _(
+            "Attachment exceeded config file size limit ({})"
+        ).format(self.file_max_size)
+    )
+    if error.size is None:
+        logger.error(
+            _("File size: over {}MB").format(
+                round(self.file_max_size_bytes / 2 ** 20, 2)
             )
-            file_path = os.path.join(
-                self.tweets_temp_path, tweet["id"], filename
+        )
+    elif error.estimated:
+        logger.error(
+            _("File size: {}MB (estimated)").format(
+                round(error.size / 2 ** 20, 2)
             )
-            with open(file_path, "wb") as outfile:
-                shutil.copyfileobj(response.raw, outfile)
-            # Remove attachment if exceeds the limit
-            if hasattr(self, "file_max_size"):
-                file_size_bytes = os.stat(file_path).st_size
-                max_file_size_bytes = parse_size(self.file_max_size)
-                if file_size_bytes > max_file_size_bytes:
-                    logger.error(
-                        _(
-                            "Attachment exceeded config file size limit ({})"
-                        ).format(self.file_max_size)
-                    )
-                    logger.error(
-                        _(
-                            "File size: {}MB"
-                        ).format(round(file_size_bytes / 2 ** 20, 2))
-                    )
-                    logger.error(_("Ignoring attachment and continuing..."))
-                    os.remove(file_path)
-
-
-def parse_size(size):
-    units = {
-        "B": 1,
-        "KB": 2 ** 10,
-        "MB": 2 ** 20,
-        "GB": 2 ** 30,
-        "TB": 2 ** 40,
-    }
-    size = size.upper()
-    if not re.match(r" ", size):
-        size = re.sub(r"([KMGT]?B)", r" \1", size)
-    number, unit = [string.strip() for string in size.split()]
-    return int(float(number) * units[unit])
+        )
+    else:
+        logger.error(
+            _("File size: {}MB").format(round(error.size / 2 ** 20, 2))
+        )
+    logger.error(_("Ignoring attachment and continuing..."))
+
+
+def _log_not_found(tweet, media_url):
+    att_not_found = _(
+        "Exception occurred"
+        "\nMedia not found (404)"
+        "\n{tweet} - {media_url}"
+        "\nIgnoring attachment and continuing..."
+    ).format(tweet=tweet, media_url=media_url)
+    logger.warning(att_not_found)
+
+
+def _get_video_size(item, media_url):
+    """Estimates the size of a video variant from its bitrate and the
+    duration of the video
+
+    :param item: Video (or GIF) as returned by Twitter's v1.1 API
+    :type item: dict
+    :param media_url: URL of the variant to download
+    :type media_url: str
+    :returns: estimated size in bytes or None if it can't be estimated
+    :rtype: int
+    """
+    video_info = item.get("video_info", {})
+    duration = video_info.get("duration_millis")
+    for variant in video_info.get("variants", []):
+        if variant["url"] == media_url and variant.get("bitrate"):
+            if duration:
+                return int(variant["bitrate"] / 8 * duration / 1000)
+    return None
 
 
 def _replace_nitter(self, tweet):
@@ -223,59 +456,163 @@ def _replace_mentions(self, tweet):
 
 
 def _expand_urls(self, tweet):
-    # Replace shortened links
+    """Replaces the shortened links of the tweet with the URLs they point to
+
+    The URL entities of the tweet are spliced in at their offsets in a
+    single pass. Tweets without entities have their links found by URI_REGEX
+    and resolved by following their redirects.
+
+    :param tweet: Tweet object
+    :type tweet: dict
+    :returns: text of the tweet with the links expanded
+    :rtype: str
+    """
+    text = tweet["text"]
     try:
-        for url_entity in tweet["entities"]["urls"]:
-            matching_pattern = url_entity["url"]
-            matches = re.findall(matching_pattern, tweet["text"])
-            for match in matches:
-                tweet["text"] = re.sub(
-                    match, url_entity["expanded_url"], tweet["text"]
-                )
+        url_entities = tweet["entities"]["urls"]
     except KeyError:
-        # URI regex
-        matching_pattern = (
-            r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]"
-            r"{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*"
-            r"\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{}"
-            r';:\'".,<>?«»“”‘’]))'
-        )
-        matches = re.finditer(matching_pattern, tweet["text"])
-        for matchNum, match in enumerate(matches, start=1):
-            # don't be brave trying to unwound an URL when it gets
-            # cut off
-            if not match.group().__contains__("…"):
-                session = requests.Session()  # so connections are
-                # recycled
-                response = session.head(match.group(), allow_redirects=True)
-                if not response.ok:
-                    response.raise_for_status()
-                expanded_url = response.url
-                tweet["text"] = re.sub(
-                    match.group(), expanded_url, tweet["text"]
-                )
-    return tweet["text"]
+        return _expand_urls_regex(self, text)
+    chunks = []
+    position = 0
+    for url_entity in sorted(
+        url_entities, key=lambda entity: entity.get("start", 0)
+    ):
+        url = url_entity["url"]
+        start = url_entity.get("start", -1)
+        end = url_entity.get("end", start + len(url))
+        if start < position or text[start:end] != url:
+            # Offsets don't always match the text we get (e.g. they are
+            # off after some emojis), look for the URL itself then
+            start = text.find(url, position)
+            if start == -1:
+                continue
+            end = start + len(url)
+        chunks.append(text[position:start])
+        chunks.append(url_entity["expanded_url"])
+        position = end
+    chunks.append(text[position:])
+    return "".join(chunks)
+
+
+def _expand_urls_regex(self, text):
+    matches = _find_links(text)
+    resolved = self.url_resolver.resolve_all(
+        [match.group() for match in matches]
+    )
+    chunks = []
+    position = 0
+    for match in matches:
+        expanded_url = resolved[match.group()]
+        if expanded_url is None:
+            continue
+        chunks.append(text[position:match.start()])
+        chunks.append(expanded_url)
+        position = match.end()
+    chunks.append(text[position:])
+    return "".join(chunks)
+
+
+def _find_links(text):
+    # don't be brave trying to unwound an URL when it gets
+    # cut off
+    return [
+        match for match in URI_REGEX.finditer(text)
+        if "…" not in match.group()
+    ]
 
 
 def _get_media_url(self, item, media_include, tweet):
     media_urls = []
     if item == media_include["media_key"]:
-        # Video download not implemented in v2 yet
-        # fallback to v1.1
-        if (
-            media_include["type"] == "video"
-            or media_include["type"] == "animated_gif"
-        ):
-            tweet_video = self._get_tweets("v1.1", tweet["id"])
-            xmd = tweet_video["extended_entities"]["media"]
-            for extended_media in xmd:
-                media_urls.append(extended_media)
+        if _is_video(media_include):
+            if item not in self.video_media:
+                _get_videos(self, [(tweet["id"], media_include)])
+            media_urls.extend(self.video_media.get(item, []))
             return media_urls
         else:
             media_urls.append(media_include)
             return media_urls
 
 
+def _is_video(media_include):
+    return media_include is not None and media_include["type"] in (
+        "video",
+        "animated_gif",
+    )
+
+
+def _get_videos(self, videos):
+    """Resolves the variants of the videos and GIFs provided, caching them
+    by media_key in 'video_media' (in the v1.1 API format used for
+    downloading them)
+
+    The ones Twitter's v2 API returned with their variants are used
+    directly, the rest are retrieved through v1.1 statuses/lookup, up to
+    100 tweets per request
+
+    :param videos: tuples of tweet ID and v2 media object of each video
+    :type videos: list
+    """
+    lookup = {}
+    for tweet_id, media_include in videos:
+        media_key = media_include["media_key"]
+        if media_key in self.video_media:
+            continue
+        if "variants" in media_include:
+            self.video_media[media_key] = [_v1_video(media_include)]
+        else:
+            lookup.setdefault(tweet_id, []).append(media_key)
+    tweet_ids = list(lookup)
+    for idx in range(0, len(tweet_ids), VIDEOS_BATCH_SIZE):
+        batch = tweet_ids[idx:idx + VIDEOS_BATCH_SIZE]
+        response = self.session_pool.get(
+            f"{self.twitter_base_url}/statuses/lookup.json",
+            headers=self.header_twitter,
+            params={"id": ",".join(batch)},
+            auth=self.auth,
+        )
+        if not response.ok:
+            response.raise_for_status()
+        tweets_v1 = {
+            tweet["id_str"]: tweet for tweet in json.loads(response.text)
+        }
+        for tweet_id in batch:
+            try:
+                xmd = tweets_v1[tweet_id]["extended_entities"]["media"]
+            except KeyError:
+                xmd = []
+            by_key = {_media_key(media): media for media in xmd}
+            for media_key in lookup[tweet_id]:
+                if media_key in by_key:
+                    self.video_media[media_key] = [by_key[media_key]]
+                else:
+                    self.video_media[media_key] = list(xmd)
+
+
+def _media_key(media):
+    return f"{MEDIA_KEY_PREFIXES.get(media['type'])}_{media['id_str']}"
+
+
+def _v1_video(media_include):
+    variants = []
+    for variant in media_include["variants"]:
+        v1_variant = {
+            "content_type": variant.get("content_type"),
+            "url": variant["url"],
+        }
+        if "bit_rate" in variant:
+            v1_variant["bitrate"] = variant["bit_rate"]
+        variants.append(v1_variant)
+    video_info = {"variants": variants}
+    if "duration_ms" in media_include:
+        video_info["duration_millis"] = media_include["duration_ms"]
+    return {
+        "type": media_include["type"],
+        "media_key": media_include["media_key"],
+        "video_info": video_info,
+    }
+
+
 def _get_best_bitrate_video(self, item):
     bitrate = 0
     for variant in item["video_info"]["variants"]:
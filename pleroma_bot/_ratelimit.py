@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import threading
+
+from json.decoder import JSONDecodeError
+from urllib.parse import urlsplit
+
+from . import logger
+from .i18n import _
+
+# Twitter rate limit windows last 15 minutes
+TWITTER_WINDOW = 15 * 60
+
+
+class RateLimiter(object):
+    """
+    Tracks the rate limit windows Twitter reports for each endpoint through
+    the 'x-rate-limit-*' headers and holds back calls once a window is
+    exhausted, until it resets.
+
+    The state of the windows can be persisted between runs, so back-to-back
+    runs know how much of the budget is left before doing any request.
+    """
+
+    def __init__(
+        self, state_path: str = None, reserve: int = 0, sleep=time.sleep
+    ):
+        self.state_path = state_path
+        self.reserve = reserve
+        self.windows = {}
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        if self.state_path:
+            self.load()
+
+    @staticmethod
+    def endpoint(method: str, url: str, auth=None) -> str:
+        """Returns the key identifying the rate limit window of a request.
+        IDs and usernames in the path are replaced by placeholders, e.g.
+        'GET api.twitter.com/2/users/:id/tweets'
+
+        :param method: HTTP method of the request
+        :type method: str
+        :param url: URL of the request
+        :type url: str
+        :param auth: OAuth 1.0a auth of the request, if any (user context
+            requests have their own windows)
+        :returns: key of the rate limit window
+        :rtype: str
+        """
+        split_url = urlsplit(url)
+        path = re.sub(
+            r"/by/username/[^/]+", "/by/username/:username", split_url.path
+        )
+        # Skip the first segment, which could be the API version
+        path = re.sub(r"(?<=.)/\d+(?=/|$)", "/:id", path)
+        endpoint = f"{method.upper()} {split_url.netloc}{path}"
+        try:
+            owner = auth.client.resource_owner_key
+            if owner:
+                endpoint = f"{endpoint} ({owner})"
+        except AttributeError:
+            pass
+        return endpoint
+
+    def acquire(self, endpoint: str):
+        """Takes a call from the endpoint's window, waiting for the window to
+        reset first if there are no calls left in it
+
+        :param endpoint: Key of the rate limit window
+        :type endpoint: str
+        """
+        while True:
+            with self._lock:
+                window = self.windows.get(endpoint)
+                if window is None:
+                    return
+                now = time.time()
+                if window["reset"] <= now:
+                    # Assume a fresh window until Twitter tells us otherwise
+                    window["remaining"] = window["limit"]
+                    window["reset"] = now + TWITTER_WINDOW
+                if window["remaining"] > self.reserve:
+                    window["remaining"] -= 1
+                    return
+                wait = window["reset"] - now + 1
+            logger.warning(
+                _(
+                    "Rate limit reached for {endpoint}, waiting {wait}s "
+                    "for it to reset..."
+                ).format(endpoint=endpoint, wait=round(wait))
+            )
+            self._sleep(wait)
+
+    def update(self, endpoint: str, headers) -> bool:
+        """Updates the endpoint's window with the rate limit headers of a
+        response
+
+        :param endpoint: Key of the rate limit window
+        :type endpoint: str
+        :param headers: Headers of the response
+        :returns: True if the response had rate limit headers
+        :rtype: bool
+        """
+        try:
+            window = {
+                "limit": int(headers["x-rate-limit-limit"]),
+                "remaining": int(headers["x-rate-limit-remaining"]),
+                "reset": float(headers["x-rate-limit-reset"]),
+            }
+        except (KeyError, TypeError, ValueError):
+            return False
+        with self._lock:
+            current = self.windows.get(endpoint)
+            # Calls still in flight already took their share of the window
+            if current and current["reset"] == window["reset"]:
+                window["remaining"] = min(
+                    window["remaining"], current["remaining"]
+                )
+            self.windows[endpoint] = window
+        return True
+
+    def exhaust(self, endpoint: str, headers) -> bool:
+        """Marks the endpoint's window as exhausted after a 429 response
+
+        :param endpoint: Key of the rate limit window
+        :type endpoint: str
+        :param headers: Headers of the 429 response
+        :returns: True if we know when the window resets and the request can
+            be retried after waiting for it
+        :rtype: bool
+        """
+        if not self.update(endpoint, headers):
+            return False
+        with self._lock:
+            self.windows[endpoint]["remaining"] = 0
+        return True
+
+    def load(self):
+        """Loads the windows persisted by previous runs"""
+        try:
+            with open(self.state_path, "r") as file:
+                windows = json.load(file)
+        except (OSError, JSONDecodeError):
+            return
+        with self._lock:
+            self.windows.update(windows)
+
+    def save(self):
+        """Persists the windows, merging them with the ones saved by other
+        processes of the same run
+        """
+        if not self.state_path:
+            return
+        try:
+            with open(self.state_path, "r") as file:
+                windows = json.load(file)
+        except (OSError, JSONDecodeError):
+            windows = {}
+        now = time.time()
+        with self._lock:
+            for endpoint, window in self.windows.items():
+                saved = windows.get(endpoint)
+                if (
+                    saved is None
+                    or saved["reset"] < window["reset"]
+                    or (
+                        saved["reset"] == window["reset"]
+                        and saved["remaining"] > window["remaining"]
+                    )
+                ):
+                    windows[endpoint] = window
+        windows = {
+            endpoint: window
+            for endpoint, window in windows.items()
+            if window["reset"] > now
+        }
+        if not windows and not os.path.isfile(self.state_path):
+            return
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(windows, file)
+        os.replace(temp_path, self.state_path)
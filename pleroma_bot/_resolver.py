@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+
+from json.decoder import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+from .i18n import _
+from ._session import SessionPool
+
+# Resolved links are kept for a month, failed ones are retried after an hour
+RESOLVE_TTL = 30 * 24 * 60 * 60
+NEGATIVE_TTL = 60 * 60
+# Most links kept in the cache, the least recently used ones are evicted
+CACHE_SIZE = 10000
+# Links resolved at the same time
+RESOLVE_WORKERS = 8
+# Seconds to wait for each link to answer
+RESOLVE_TIMEOUT = 10
+
+
+class UrlResolver(object):
+    """
+    Resolves shortened links by following their redirects, a few of them at
+    a time, and remembers the URLs they point to so the same link isn't
+    resolved again by other users or the following runs.
+
+    Links that couldn't be resolved are remembered too, for a shorter time.
+    """
+
+    def __init__(
+        self,
+        session_pool: SessionPool,
+        cache_path: str = None,
+        ttl: int = RESOLVE_TTL,
+        negative_ttl: int = NEGATIVE_TTL,
+        cache_size: int = CACHE_SIZE,
+        workers: int = RESOLVE_WORKERS,
+        timeout: float = RESOLVE_TIMEOUT,
+    ):
+        self.session_pool = session_pool
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = {}
+        self._lock = threading.Lock()
+        if self.cache_path:
+            self.load()
+
+    def resolve(self, url: str) -> str:
+        """Returns the URL the link points to
+
+        :param url: Link to resolve
+        :type url: str
+        :returns: URL the link redirects to or None if it couldn't be
+            resolved
+        :rtype: str
+        """
+        return self.resolve_all([url])[url]
+
+    def resolve_all(self, urls: list) -> dict:
+        """Resolves the links provided, following the redirects of the ones
+        not cached concurrently
+
+        :param urls: Links to resolve
+        :type urls: list
+        :returns: mapping of each link to the URL it points to (None if it
+            couldn't be resolved)
+        :rtype: dict
+        """
+        resolved = {}
+        now = time.time()
+        with self._lock:
+            for url in urls:
+                entry = self.cache.get(url)
+                if entry and entry["expires"] > now:
+                    entry["used"] = now
+                    resolved[url] = entry["url"]
+        pending = [url for url in dict.fromkeys(urls) if url not in resolved]
+        if len(pending) == 1:
+            resolved[pending[0]] = self._resolve(pending[0])
+        elif pending:
+            workers = min(self.workers, len(pending))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for url, expanded_url in zip(
+                    pending, executor.map(self._resolve, pending)
+                ):
+                    resolved[url] = expanded_url
+        return resolved
+
+    def _resolve(self, url: str) -> str:
+        try:
+            response = self.session_pool.head(
+                url, allow_redirects=True, timeout=self.timeout
+            )
+            if not response.ok:
+                response.raise_for_status()
+            expanded_url = response.url
+        except Exception as e:
+            logger.warning(
+                _("Unable to resolve {url}, leaving it as is: {error}").format(
+                    url=url, error=e
+                )
+            )
+            expanded_url = None
+        now = time.time()
+        ttl = self.ttl if expanded_url else self.negative_ttl
+        with self._lock:
+            self.cache[url] = {
+                "url": expanded_url,
+                "expires": now + ttl,
+                "used": now,
+            }
+            # Long-running processes (--daemon) keep the same resolver, so
+            # the cache is trimmed once it holds twice what it can keep
+            if len(self.cache) > 2 * self.cache_size:
+                self.cache = self._evict(self.cache, now)
+        return expanded_url
+
+    def load(self):
+        """Loads the links resolved by previous runs"""
+        try:
+            with open(self.cache_path, "r") as file:
+                cache = json.load(file)
+        except (OSError, JSONDecodeError):
+            return
+        with self._lock:
+            self.cache.update(cache)
+
+    def save(self):
+        """Persists the links resolved, merging them with the ones saved by
+        other processes of the same run and evicting the expired and least
+        recently used ones
+        """
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, "r") as file:
+                cache = json.load(file)
+        except (OSError, JSONDecodeError):
+            cache = {}
+        now = time.time()
+        with self._lock:
+            for url, entry in self.cache.items():
+                saved = cache.get(url)
+                if saved is None or saved["used"] < entry["used"]:
+                    cache[url] = entry
+            cache = self._evict(cache, now)
+            self.cache = dict(cache)
+        if not cache and not os.path.isfile(self.cache_path):
+            return
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(cache, file)
+        os.replace(temp_path, self.cache_path)
+
+    def _evict(self, cache: dict, now: float) -> dict:
+        """Returns the links of the cache which haven't expired, only the
+        most recently used ones if there are more than the cache can hold
+        """
+        cache = {
+            url: entry for url, entry in cache.items()
+            if entry["expires"] > now
+        }
+        if len(cache) > self.cache_size:
+            recent = sorted(
+                cache, key=lambda url: cache[url]["used"], reverse=True
+            )
+            cache = {url: cache[url] for url in recent[:self.cache_size]}
+        return cache
@@ -0,0 +1,55 @@
+import time
+import heapq
+import itertools
+
+
+class Scheduler(object):
+    """
+    Min-heap of the next time each user is due to be processed, so the
+    daemon only has to look at the top of the heap to know how long it can
+    sleep and which users to process next.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Breaks ties between users due at the same time, keeping them in
+        # the order they were scheduled
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, key, due: float):
+        """Schedules a user
+
+        :param key: Key of the user
+        :param due: Timestamp when the user is due
+        :type due: float
+        """
+        heapq.heappush(self._heap, (due, next(self._counter), key))
+
+    def next_due(self) -> float:
+        """Returns when the next user is due
+
+        :returns: timestamp when the next user is due or None if no user is
+            scheduled
+        :rtype: float
+        """
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now: float = None) -> list:
+        """Takes the users which are due out of the schedule
+
+        :param now: Timestamp to compare with (the current time by default)
+        :type now: float
+        :returns: keys of the users due, the ones due first at the beginning
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
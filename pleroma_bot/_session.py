@@ -0,0 +1,410 @@
+import re
+import time
+import random
+import threading
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import logger
+from .i18n import _
+from ._ratelimit import RateLimiter
+
+# How many times a request is retried after waiting for its rate limit window
+# to reset
+RATE_LIMIT_RETRIES = 3
+# How many times a request is retried after a transient error
+RETRIES = 3
+# Seconds to wait before the first retry, doubled on every attempt (with
+# jitter) up to BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Longest Retry-After honored, a response asking for more is returned as is
+RETRY_AFTER_MAX = 300
+# Statuses the host (or the proxy in front of it) is expected to recover from
+RETRY_STATUSES = (429, 502, 503, 504)
+# Statuses counted as failures of the host by its circuit breaker
+GATEWAY_STATUSES = (502, 503, 504)
+# Methods which can be sent again without side effects
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Seconds to wait for a connection and for the host to answer
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# Seconds to wait for the endpoints which take longer to answer, e.g. media
+# uploads that the instance processes before answering
+ENDPOINT_TIMEOUTS = ((re.compile(r"/api/v\d/media$"), 300),)
+# Consecutive failures before requests to a host fail fast, and seconds to
+# wait before trying it again
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host which keeps failing"""
+
+
+class CircuitBreaker(object):
+    """
+    Counts the consecutive failures (connection errors, timeouts and gateway
+    errors) of a host. Once they reach the threshold the circuit opens and
+    requests to the host fail fast until the cooldown is over. Then a single
+    request is let through to probe the host: the circuit closes if it
+    succeeds and opens again otherwise.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        threshold: int = CIRCUIT_THRESHOLD,
+        cooldown: float = CIRCUIT_COOLDOWN,
+    ):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Returns whether a request can be sent to the host
+
+        :returns: False if the circuit is open
+        :rtype: bool
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.time() - self.opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, failed: bool):
+        """Records the outcome of a request to the host
+
+        :param failed: Whether the host failed to answer the request
+        :type failed: bool
+        """
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures < self.threshold:
+                return
+            if self.opened_at is None:
+                logger.warning(
+                    _(
+                        "{host} failed {failures} times in a row, failing "
+                        "its requests for {cooldown}s..."
+                    ).format(
+                        host=self.host,
+                        failures=self.failures,
+                        cooldown=self.cooldown,
+                    )
+                )
+            self.opened_at = time.time()
+
+    def release(self):
+        """Lets another request probe the host, when the one probing it
+        didn't get to reach it
+        """
+        with self._lock:
+            self._probing = False
+
+
+class SessionPool(object):
+    """
+    Keeps one keep-alive ``requests.Session`` per host so every User in a run
+    reuses the same TCP/TLS connections instead of handshaking on each call.
+    Every request goes through the RateLimiter, which paces the calls to
+    rate limited endpoints.
+
+    Requests time out instead of hanging, transient errors are retried with
+    exponential backoff and jitter (honoring Retry-After), and each host has
+    a CircuitBreaker so an instance that is down fails fast instead of
+    eating the time of the whole run.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        rate_limiter: RateLimiter = None,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF_BASE,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        circuit_threshold: int = CIRCUIT_THRESHOLD,
+        circuit_cooldown: float = CIRCUIT_COOLDOWN,
+        sleep=time.sleep,
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retries = retries
+        self.backoff = backoff
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.circuit_threshold = circuit_threshold
+        self.circuit_cooldown = circuit_cooldown
+        self.breakers = {}
+        self._sessions = {}
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: dict, rate_limiter: RateLimiter = None):
+        """Builds a SessionPool using the pool sizes, timeouts and retries
+        defined in the config
+
+        :param cfg: Parsed config.yml
+        :type cfg: dict
+        :param rate_limiter: RateLimiter to use for the requests
+        :type rate_limiter: RateLimiter
+        :returns: SessionPool sized as configured (or with the defaults)
+        :rtype: SessionPool
+        """
+        kwargs = {"rate_limiter": rate_limiter}
+        for attribute in (
+            "pool_connections", "pool_maxsize", "circuit_threshold"
+        ):
+            if attribute in cfg:
+                kwargs[attribute] = int(cfg[attribute])
+        if "request_retries" in cfg:
+            kwargs["retries"] = int(cfg["request_retries"])
+        for attribute in (
+            "connect_timeout", "read_timeout", "circuit_cooldown"
+        ):
+            if attribute in cfg:
+                kwargs[attribute] = float(cfg[attribute])
+        # Keep enough connections around for every user in flight
+        if "pool_maxsize" not in kwargs and "concurrency" in cfg:
+            kwargs["pool_maxsize"] = max(10, int(cfg["concurrency"]))
+        return cls(**kwargs)
+
+    def session(self, url: str) -> requests.Session:
+        """Returns the session bound to the host of the URL provided,
+        creating it if it's the first time we talk to that host
+
+        :param url: URL the request will be made to
+        :type url: str
+        :returns: pooled session for the URL's host
+        :rtype: requests.Session
+        """
+        host = _host(url)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = session
+        return session
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        """Returns the circuit breaker of the host of the URL provided
+
+        :param url: URL the request will be made to
+        :type url: str
+        :returns: circuit breaker of the URL's host
+        :rtype: CircuitBreaker
+        """
+        host = _host(url)
+        with self._lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    host, self.circuit_threshold, self.circuit_cooldown
+                )
+                self.breakers[host] = breaker
+        return breaker
+
+    def timeout(self, url: str) -> tuple:
+        """Returns the timeouts of a request to the URL provided
+
+        :param url: URL the request will be made to
+        :type url: str
+        :returns: seconds to wait for the connection and for the answer
+        :rtype: tuple
+        """
+        read_timeout = self.read_timeout
+        path = urlsplit(url).path
+        for pattern, endpoint_timeout in ENDPOINT_TIMEOUTS:
+            if pattern.search(path):
+                read_timeout = max(read_timeout, endpoint_timeout)
+        return self.connect_timeout, read_timeout
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Sends a request through the session of the URL's host, waiting
+        for the endpoint's rate limit window if needed and retrying the
+        request if it still got rate limited (429).
+
+        Connection errors, timeouts and transient statuses (429, 502, 503
+        and 504) are retried with exponential backoff if the request can be
+        sent again safely: idempotent methods, or requests carrying an
+        Idempotency-Key, with a body that can be replayed
+
+        :param method: HTTP method of the request
+        :type method: str
+        :param url: URL to send the request to
+        :type url: str
+        :returns: response of the request
+        :rtype: requests.Response
+        """
+        endpoint = self.rate_limiter.endpoint(
+            method, url, kwargs.get("auth")
+        )
+        session = self.session(url)
+        breaker = self.breaker(url)
+        kwargs.setdefault("timeout", self.timeout(url))
+        replayable = _replayable(method, kwargs)
+        attempt = 0
+        rate_limited = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpen(
+                    _(
+                        "{host} is failing, not sending requests to it for "
+                        "now"
+                    ).format(host=breaker.host)
+                )
+            self.rate_limiter.acquire(endpoint)
+            try:
+                response = session.request(method, url, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                breaker.record(True)
+                if not replayable or attempt >= self.retries:
+                    raise
+                error = e
+                delay = self._backoff(attempt)
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                self.rate_limiter.update(endpoint, response.headers)
+                breaker.record(response.status_code in GATEWAY_STATUSES)
+                if (
+                    response.status_code == 429
+                    and rate_limited < RATE_LIMIT_RETRIES
+                    and self.rate_limiter.exhaust(endpoint, response.headers)
+                ):
+                    # Waits for the window to reset before sending it again
+                    rate_limited += 1
+                    continue
+                if (
+                    response.status_code not in RETRY_STATUSES
+                    or not replayable
+                    or attempt >= self.retries
+                ):
+                    return response
+                delay = _retry_after(response.headers)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif delay > RETRY_AFTER_MAX:
+                    return response
+                error = response.status_code
+                response.close()
+            attempt += 1
+            logger.warning(
+                _(
+                    "Request to {url} failed ({error}), retrying in {delay}s "
+                    "({attempt}/{retries})..."
+                ).format(
+                    url=url,
+                    error=error,
+                    delay=round(delay, 2),
+                    attempt=attempt,
+                    retries=self.retries,
+                )
+            )
+            self._sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, so clients failing at the same time don't retry at
+        # the same time too
+        return random.uniform(
+            0, min(BACKOFF_MAX, self.backoff * 2 ** attempt)
+        )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, data=None, **kwargs) -> requests.Response:
+        return self.request("POST", url, data=data, **kwargs)
+
+    def patch(self, url: str, data=None, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, data=data, **kwargs)
+
+    def close(self):
+        """Closes every pooled session and its connections, persisting the
+        state of the rate limit windows
+        """
+        self.rate_limiter.save()
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def _host(url: str) -> str:
+    split_url = urlsplit(url)
+    return f"{split_url.scheme}://{split_url.netloc}"
+
+
+def _replayable(method: str, kwargs: dict) -> bool:
+    """Returns whether a request can be sent again: its method is idempotent
+    (or it carries an Idempotency-Key) and its body isn't a stream or a file
+    consumed by the first attempt
+    """
+    if kwargs.get("files"):
+        return False
+    data = kwargs.get("data")
+    if data is not None and not isinstance(
+        data, (dict, list, tuple, str, bytes)
+    ):
+        return False
+    headers = kwargs.get("headers") or {}
+    return (
+        method.upper() in IDEMPOTENT_METHODS
+        or "Idempotency-Key" in headers
+    )
+
+
+def _retry_after(headers) -> float:
+    """Returns the seconds to wait asked by the Retry-After header, which
+    can be either seconds or an HTTP date
+
+    :returns: seconds to wait or None if the header is missing or invalid
+    :rtype: float
+    """
+    retry_after = headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    return max(0.0, date.timestamp() - time.time())
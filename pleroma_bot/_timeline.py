@@ -0,0 +1,84 @@
+# Objects expanded in the includes of the tweets and the key identifying them
+INCLUDE_KEYS = {
+    "users": "id",
+    "tweets": "id",
+    "media": "media_key",
+    "polls": "id",
+    "places": "id",
+}
+# Includes always present once pages are merged
+INCLUDES = ("users", "tweets", "media", "polls")
+
+
+class Timeline(dict):
+    """
+    Tweets as returned by Twitter's v2 API (a page of them, or several pages
+    merged) with their includes indexed by ID, so media, users, tweets and
+    polls referenced by a tweet are looked up directly instead of scanning
+    the includes for each tweet.
+
+    It is still the same dict, so it can be used (and dumped) as the raw
+    response.
+    """
+
+    def __init__(self, tweets: dict = None):
+        super().__init__(tweets or {})
+        self._index = {include: {} for include in INCLUDE_KEYS}
+        # Copy the lists, so merging doesn't modify the original response
+        if isinstance(self.get("data"), list):
+            self["data"] = list(self["data"])
+        if "includes" in self:
+            self["includes"] = {
+                include: [
+                    obj for obj in objects
+                    if include not in INCLUDE_KEYS or self._add(include, obj)
+                ]
+                for include, objects in self["includes"].items()
+            }
+
+    def _add(self, include: str, obj: dict) -> bool:
+        index = self._index[include]
+        key = obj.get(INCLUDE_KEYS[include])
+        if key is None:
+            return True
+        if key in index:
+            return False
+        index[key] = obj
+        return True
+
+    def merge(self, tweets: dict):
+        """Adds the tweets and includes of another response (a page of tweets
+        or a single tweet) skipping the includes we already have
+
+        :param tweets: Response of the v2 API to add
+        :type tweets: dict
+        :returns: the Timeline itself
+        :rtype: Timeline
+        """
+        data = tweets.get("data", [])
+        if isinstance(data, dict):
+            data = [data]
+        self.setdefault("data", []).extend(data)
+        includes = self.setdefault("includes", {})
+        for include in INCLUDES:
+            includes.setdefault(include, [])
+        for include, objects in tweets.get("includes", {}).items():
+            if include not in INCLUDE_KEYS:
+                continue
+            target = includes.setdefault(include, [])
+            target.extend(obj for obj in objects if self._add(include, obj))
+        if "meta" in tweets:
+            self["meta"] = tweets["meta"]
+        return self
+
+    def get_media(self, media_key: str) -> dict:
+        return self._index["media"].get(media_key)
+
+    def get_user(self, user_id: str) -> dict:
+        return self._index["users"].get(user_id)
+
+    def get_tweet(self, tweet_id: str) -> dict:
+        return self._index["tweets"].get(tweet_id)
+
+    def get_poll(self, poll_id: str) -> dict:
+        return self._index["polls"].get(poll_id)
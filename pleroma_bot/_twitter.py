@@ -1,12 +1,15 @@
+import os
 import json
-import requests
+import time
 
+from json.decoder import JSONDecodeError
 
 from pleroma_bot.i18n import _
 from pleroma_bot._utils import spinner
+from pleroma_bot._timeline import Timeline
 
 
-def _get_twitter_info(self):
+def _get_twitter_info(self, user_twitter: dict = None):
     """Updates User object attributes with current Twitter info
 
     This includes:
@@ -16,19 +19,23 @@ def _get_twitter_info(self):
     * Banner image url
     * Screen name
 
+    :param user_twitter: Twitter user object already looked up, if any.
+        Otherwise it is retrieved from Twitter
+    :type user_twitter: dict
     :return: None
     """
-    twitter_user_url = (
-        f"{self.twitter_base_url}"
-        f"/users/show.json?screen_name="
-        f"{self.twitter_username}"
-    )
-    response = requests.get(
-        twitter_user_url, headers=self.header_twitter, auth=self.auth
-    )
-    if not response.ok:
-        response.raise_for_status()
-    user_twitter = json.loads(response.text)
+    if user_twitter is None:
+        twitter_user_url = (
+            f"{self.twitter_base_url}"
+            f"/users/show.json?screen_name="
+            f"{self.twitter_username}"
+        )
+        response = self.session_pool.get(
+            twitter_user_url, headers=self.header_twitter, auth=self.auth
+        )
+        if not response.ok:
+            response.raise_for_status()
+        user_twitter = json.loads(response.text)
     self.bio_text = (
         f'{self.bio_text}{user_twitter["description"]}'
         if self.twitter_bio
@@ -45,6 +52,111 @@ def _get_twitter_info(self):
     return
 
 
+def _get_twitter_id(self, refresh=False):
+    """Returns the numeric Twitter ID of the user. It is only resolved
+    through the API when it's not cached in the user folder, the cached one
+    expired ('twitter_id_ttl' seconds) or a refresh is forced
+
+    :param refresh: Ignore the cached ID and resolve it again
+    :type refresh: bool
+    :returns: Twitter ID of the user
+    :rtype: str
+    """
+    if not refresh:
+        if self.twitter_id is None:
+            self.twitter_id = _load_twitter_id(self)
+        if self.twitter_id is not None:
+            return self.twitter_id
+    url = (
+        f"{self.twitter_base_url_v2}/users/by?"
+        f"usernames={self.twitter_username}"
+    )
+    response = self.session_pool.get(
+        url, headers=self.header_twitter, auth=self.auth
+    )
+    if not response.ok:
+        response.raise_for_status()
+    response = json.loads(response.text)
+    _save_twitter_id(self, response["data"][0]["id"])
+    return self.twitter_id
+
+
+def _save_twitter_id(self, twitter_id: str):
+    self.twitter_id = twitter_id
+    twitter_id_cache = {
+        "username": self.twitter_username,
+        "id": twitter_id,
+        "resolved_at": time.time(),
+    }
+    with open(self.twitter_id_path, "w") as file:
+        json.dump(twitter_id_cache, file)
+
+
+def _load_twitter_id(self):
+    try:
+        with open(self.twitter_id_path, "r") as file:
+            twitter_id_cache = json.load(file)
+    except (OSError, JSONDecodeError):
+        return None
+    try:
+        same_user = (
+            twitter_id_cache["username"].lower()
+            == self.twitter_username.lower()
+        )
+        age = time.time() - twitter_id_cache["resolved_at"]
+        if same_user and 0 <= age < self.twitter_id_ttl:
+            return twitter_id_cache["id"]
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return None
+
+
+def _get_last_tweet_id(self):
+    """Returns the ID of the last tweet mirrored for the user, used as the
+    cursor for retrieving only the tweets newer than it
+
+    :returns: ID of the last tweet mirrored or None if there isn't one
+    :rtype: str
+    """
+    if not os.path.isfile(self.last_tweet_id_path):
+        return None
+    with open(self.last_tweet_id_path, "r") as file:
+        last_tweet_id = file.readline().rstrip()
+    if not last_tweet_id.isdigit():
+        return None
+    return last_tweet_id
+
+
+def _save_last_tweet_id(self, tweet_id: str):
+    """Moves the cursor forward to the tweet ID provided (it never goes back
+    to an older tweet)
+
+    :param tweet_id: ID of the tweet mirrored
+    :type tweet_id: str
+    """
+    last_tweet_id = self._get_last_tweet_id()
+    if last_tweet_id and int(last_tweet_id) >= int(tweet_id):
+        return
+    with open(self.last_tweet_id_path, "w") as file:
+        file.write(f"{tweet_id}\n")
+
+
+def _user_not_found(response) -> bool:
+    """Checks if Twitter couldn't find the user we asked tweets for"""
+    if response.status_code == 404:
+        return True
+    if not response.ok:
+        return False
+    try:
+        content = response.json()
+        return "data" not in content and any(
+            error.get("title") == "Not Found Error"
+            for error in content.get("errors", [])
+        )
+    except (ValueError, AttributeError):
+        return False
+
+
 def _get_tweets(self, version: str, tweet_id=None, start_time=None):
     """Gathers last 'max_tweets' tweets from the user and returns them
     as an dict
@@ -62,7 +174,7 @@ def _get_tweets(self, version: str, tweet_id=None, start_time=None):
                 f"{self.twitter_base_url}/statuses/"
                 f"show.json?id={str(tweet_id)}"
             )
-            response = requests.get(
+            response = self.session_pool.get(
                 twitter_status_url, headers=self.header_twitter, auth=self.auth
             )
             if not response.ok:
@@ -76,7 +188,7 @@ def _get_tweets(self, version: str, tweet_id=None, start_time=None):
                 f"{self.twitter_username}"
                 f"&count={str(self.max_tweets)}&include_rts=true"
             )
-            response = requests.get(
+            response = self.session_pool.get(
                 twitter_status_url, headers=self.header_twitter, auth=self.auth
             )
             if not response.ok:
@@ -92,119 +204,148 @@ def _get_tweets(self, version: str, tweet_id=None, start_time=None):
         raise ValueError(_("API version not supported: {}").format(version))
 
 
-def _get_tweets_v2(
-    self,
-    start_time,
-    tweet_id=None,
-    next_token=None,
-    previous_token=None,
-    tweets_v2=None,
-):
+def _get_tweets_v2(self, start_time, tweet_id=None):
+    """Gathers the tweets (or the tweet, if tweet_id is provided) and
+    returns them as a single dict, merging all the pages retrieved
+
+    :param start_time: Oldest date to retrieve tweets from
+    :param tweet_id: Tweet ID to retrieve
+    :returns: tweets retrieved
+    :rtype: dict
+    """
+    tweets_v2 = None
+    for page in self._iter_tweets_v2(start_time, tweet_id=tweet_id):
+        if tweets_v2 is None:
+            tweets_v2 = Timeline(page)
+        else:
+            tweets_v2.merge(page)
+    return tweets_v2
+
+
+def _iter_tweets_v2(self, start_time, tweet_id=None, since_id=None):
+    """Yields the pages of tweets one at a time as they are retrieved
+    (newest first), following the pagination tokens until the last page
+
+    :param start_time: Oldest date to retrieve tweets from
+    :param tweet_id: Tweet ID to retrieve, in which case a single page with
+        the tweet is yielded
+    :param since_id: Only retrieve tweets newer than this tweet ID. Takes
+        precedence over start_time
+    :returns: generator of pages of tweets
+    """
     # Tweet number must be between 10 and 100
     if not (100 >= self.max_tweets > 10):
-        global _
         error_msg = _(
             "max_tweets must be between 10 and 100. max_tweets: {}"
         ).format(self.max_tweets)
         raise ValueError(error_msg)
-    params = {}
-    previous_token = next_token
+    params = {
+        "poll.fields": "duration_minutes,end_datetime,id,options,"
+        "voting_status",
+        "media.fields": "duration_ms,height,media_key,"
+        "preview_image_url,type,url,width,"
+        "public_metrics,variants",
+        "expansions": "attachments.poll_ids,"
+        "attachments.media_keys,author_id,"
+        "entities.mentions.username,geo.place_id,"
+        "in_reply_to_user_id,referenced_tweets.id,"
+        "referenced_tweets.id.author_id",
+        "tweet.fields": "attachments,author_id,"
+        "context_annotations,conversation_id,"
+        "created_at,entities,"
+        "geo,id,in_reply_to_user_id,lang,"
+        "public_metrics,"
+        "possibly_sensitive,referenced_tweets,"
+        "source,text,"
+        "withheld",
+    }
     if tweet_id:
         url = f"{self.twitter_base_url_v2}/tweets/{tweet_id}"
-    else:
-        url = (
-            f"{self.twitter_base_url_v2}/users/by?"
-            f"usernames={self.twitter_username}"
-        )
-        response = requests.get(
-            url, headers=self.header_twitter, auth=self.auth
+        response = self.session_pool.get(
+            url, headers=self.header_twitter, params=params, auth=self.auth
         )
         if not response.ok:
             response.raise_for_status()
-        response = json.loads(response.text)
-        twitter_id = response["data"][0]["id"]
+        yield json.loads(response.text)
+        return
 
-        url = f"{self.twitter_base_url_v2}/users/{twitter_id}/tweets"
+    next_token = None
+    while True:
+        page_params = {}
         if next_token:
-            params.update({"pagination_token": next_token})
-
-        params.update(
-            {
-                "start_time": start_time,
-                "max_results": self.max_tweets,
-            }
+            page_params["pagination_token"] = next_token
+        if since_id:
+            page_params["since_id"] = since_id
+        else:
+            page_params["start_time"] = start_time
+        page_params["max_results"] = self.max_tweets
+        page_params.update(params)
+        twitter_id = self._get_twitter_id()
+        url = f"{self.twitter_base_url_v2}/users/{twitter_id}/tweets"
+        response = self.session_pool.get(
+            url,
+            headers=self.header_twitter,
+            params=page_params,
+            auth=self.auth,
         )
+        if _user_not_found(response):
+            # The cached ID may be stale, resolve it again and retry
+            twitter_id = self._get_twitter_id(refresh=True)
+            url = f"{self.twitter_base_url_v2}/users/{twitter_id}/tweets"
+            response = self.session_pool.get(
+                url,
+                headers=self.header_twitter,
+                params=page_params,
+                auth=self.auth,
+            )
+        if not response.ok:
+            response.raise_for_status()
+        page = json.loads(response.text)
+        previous_token = next_token
+        try:
+            next_token = page["meta"]["next_token"]
+        except KeyError:
+            next_token = None
+        yield page
+        if not next_token or next_token == previous_token:
+            return
 
-    params.update(
-        {
-            "poll.fields": "duration_minutes,end_datetime,id,options,"
-            "voting_status",
-            "media.fields": "duration_ms,height,media_key,"
-            "preview_image_url,type,url,width,"
-            "public_metrics",
-            "expansions": "attachments.poll_ids,"
-            "attachments.media_keys,author_id,"
-            "entities.mentions.username,geo.place_id,"
-            "in_reply_to_user_id,referenced_tweets.id,"
-            "referenced_tweets.id.author_id",
-            "tweet.fields": "attachments,author_id,"
-            "context_annotations,conversation_id,"
-            "created_at,entities,"
-            "geo,id,in_reply_to_user_id,lang,"
-            "public_metrics,"
-            "possibly_sensitive,referenced_tweets,"
-            "source,text,"
-            "withheld",
-        }
-    )
 
-    response = requests.get(
-        url, headers=self.header_twitter, params=params, auth=self.auth
-    )
-    if not response.ok:
-        response.raise_for_status()
+@spinner(_("Gathering tweets... "))
+def spool_tweets(self, start_time, since_id=None) -> list:
+    """Retrieves the tweets page by page, writing each page to the user's
+    temp folder as soon as it arrives instead of keeping all of them in
+    memory
 
-    if tweets_v2:
-        next_tweets = response.json()
-
-        includes = ["users", "tweets", "media", "polls"]
-        for include in includes:
-            try:
-                _ = tweets_v2["includes"][include]
-            except KeyError:
-                tweets_v2["includes"].update({include: []})
-            try:
-                _ = next_tweets["includes"][include]
-            except KeyError:
-                next_tweets["includes"].update({include: []})
-
-        for tweet in next_tweets["data"]:
-            tweets_v2["data"].append(tweet)
-        for user in next_tweets["includes"]["users"]:
-            tweets_v2["includes"]["users"].append(user)
-        for tweet_include in next_tweets["includes"]["tweets"]:
-            tweets_v2["includes"]["tweets"].append(tweet_include)
-        for media in next_tweets["includes"]["media"]:
-            tweets_v2["includes"]["media"].append(media)
-        for poll in next_tweets["includes"]["polls"]:
-            tweets_v2["includes"]["polls"].append(poll)
-        tweets_v2["meta"] = next_tweets["meta"]
-    else:
-        tweets_v2 = json.loads(response.text)
+    :param start_time: Oldest date to retrieve tweets from
+    :param since_id: Only retrieve tweets newer than this tweet ID
+    :returns: paths of the pages written, oldest page first
+    :rtype: list
+    """
+    pages = []
+    for page in self._iter_tweets_v2(start_time, since_id=since_id):
+        page_path = os.path.join(
+            self.tweets_temp_path, f"page_{len(pages)}.json"
+        )
+        with open(page_path, "w") as file:
+            json.dump(page, file)
+        pages.append(page_path)
+    pages.reverse()
+    return pages
 
-    try:
-        next_token = response.json()["meta"]["next_token"]
-        if next_token and next_token != previous_token:
-            self._get_tweets_v2(
-                start_time=start_time,
-                tweets_v2=tweets_v2,
-                next_token=next_token,
-                previous_token=previous_token,
-            )
-    except KeyError:
-        pass
 
-    return tweets_v2
+def iter_spooled_tweets(self, pages: list):
+    """Loads the pages written by spool_tweets one at a time
+
+    :param pages: paths of the pages to load
+    :type pages: list
+    :returns: generator of pages of tweets
+    """
+    for page_path in pages:
+        with open(page_path, "r") as file:
+            page = Timeline(json.load(file))
+        os.remove(page_path)
+        yield page
 
 
 @spinner(_("Gathering tweets... "))
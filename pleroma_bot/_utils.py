@@ -4,7 +4,7 @@ import time
 import json
 import string
 import random
-import requests
+import hashlib
 import threading
 import functools
 import mimetypes
@@ -24,6 +24,9 @@ except ImportError:
 from .i18n import _
 from . import logger
 
+# Serializes interactive prompts when users are processed concurrently
+input_lock = threading.Lock()
+
 
 class PropagatingThread(threading.Thread):
     """
@@ -61,9 +64,8 @@ def spinner(message, spinner_symbols: list = None):
     """
     spinner_symbols = spinner_symbols or list("|/-\\")
     spinner_symbols = cycle(spinner_symbols)
-    global input_thread
 
-    def start():
+    def start(input_thread):
         while input_thread.is_alive():
             symbol = next(spinner_symbols)
             print(
@@ -78,15 +80,20 @@ def spinner(message, spinner_symbols: list = None):
     def external(fct):
         @functools.wraps(fct)
         def wrapper(*args, **kwargs):
+            # Only the main thread owns the terminal, users being processed
+            # concurrently run without a spinner
+            if threading.current_thread() is not threading.main_thread():
+                return fct(*args, **kwargs)
             return_que = Queue()
-            global input_thread
             input_thread = PropagatingThread(
                 target=lambda q, *arg1, **kwarg1: q.put(fct(*arg1, **kwarg1)),
                 args=(return_que, *args),
                 kwargs=dict(**kwargs),
             )
             input_thread.start()
-            spinner_thread = threading.Thread(target=start)
+            spinner_thread = threading.Thread(
+                target=start, args=(input_thread,)
+            )
             spinner_thread.start()
 
             spinner_thread.join()
@@ -206,6 +213,53 @@ def guess_type(media_file: str) -> str:
     return mime_type
 
 
+def guess_type_buffer(buffer: bytes, default: str = None) -> str:
+    """Try to guess what MIME type the given bytes are, looking at the first
+    bytes of a file when it isn't on disk.
+
+    :param buffer: The first bytes of the file
+    :param default: MIME type to return if it can't be guessed
+    :returns: the MIME type result of guessing
+    :rtype: str
+    """
+    mime_type = None
+    try:
+        mime_type = magic.from_buffer(buffer, mime=True)
+    except AttributeError:
+        pass
+    return mime_type or default
+
+
+def file_sha256(file_path: str) -> str:
+    """Returns the SHA-256 hex digest of the contents of a file
+
+    :param file_path: Path of the file to hash
+    :type file_path: str
+    :returns: hex digest of the file contents
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def parse_size(size):
+    units = {
+        "B": 1,
+        "KB": 2 ** 10,
+        "MB": 2 ** 20,
+        "GB": 2 ** 30,
+        "TB": 2 ** 40,
+    }
+    size = size.upper()
+    if not re.match(r" ", size):
+        size = re.sub(r"([KMGT]?B)", r" \1", size)
+    number, unit = [string.strip() for string in size.split()]
+    return int(float(number) * units[unit])
+
+
 def random_string(length: int) -> str:
     """Returns a string of random characters of length 'length'
     :param length: How long the string to return must be
@@ -220,18 +274,19 @@ def random_string(length: int) -> str:
     )
 
 
-def _get_instance_info(self):
-    instance_url = f"{self.pleroma_base_url}/api/v1/instance"
-    response = requests.get(instance_url)
-    if not response.ok:
-        response.raise_for_status()
-    try:
-        instance_info = json.loads(response.text)
-    except JSONDecodeError:
-        msg = _(
-            "Instance response was not understood {}"
-        ).format(response.text)
-        raise ValueError(msg)
+def _get_instance_info(self, instance_info: dict = None):
+    if instance_info is None:
+        instance_url = f"{self.pleroma_base_url}/api/v1/instance"
+        response = self.session_pool.get(instance_url)
+        if not response.ok:
+            response.raise_for_status()
+        try:
+            instance_info = json.loads(response.text)
+        except JSONDecodeError:
+            msg = _(
+                "Instance response was not understood {}"
+            ).format(response.text)
+            raise ValueError(msg)
     if "Pleroma" not in instance_info["version"]:
         logger.debug(_("Assuming target instance is Mastodon..."))
         if len(self.display_name) > 30:
@@ -249,7 +304,12 @@ def _get_instance_info(self):
                 )
 
 
-def force_date(self):
+def ask_date() -> str:
+    """Asks how far back the tweets of a Twitter account should be retrieved
+
+    :returns: the answer, as expected by force_date
+    :rtype: str
+    """
     logger.info(
         _("How far back should we retrieve tweets from the Twitter account?")
     )
@@ -259,8 +319,21 @@ def force_date(self):
         "\nif you want the bot to execute as normal (checking date of "
         "\nlast post in the Fediverse account)] "
     )
-    logger.info(date_msg)
-    input_date = input()
+    # Prompts of users processed concurrently shouldn't interleave
+    with input_lock:
+        logger.info(date_msg)
+        return input()
+
+
+def force_date(self, input_date: str = None):
+    """Returns the date to start retrieving tweets from
+
+    :param input_date: Answer already given to ask_date. If not provided,
+        it's asked now
+    :type input_date: str
+    """
+    if input_date is None:
+        input_date = ask_date()
     if input_date == "continue":
         if self.posts != "none_found":
             date = self.get_date_last_pleroma_post()
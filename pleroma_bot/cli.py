@@ -30,31 +30,69 @@
 
 import os
 import sys
+import copy
 import time
 import yaml
 import shutil
+import asyncio
 import logging
+import signal
 import argparse
+import threading
+import multiprocessing
 
+from urllib.parse import urlsplit
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
 from requests_oauthlib import OAuth1
 
 from .i18n import _
 from . import logger
 from .__init__ import __version__
+from ._lookup import UserLookup
+from ._session import SessionPool
+from ._download import DownloadPool
+from ._media_cache import MediaCache
+from ._utils import ask_date
+from ._utils import parse_size
+from ._timeline import Timeline
+from ._resolver import UrlResolver
+from ._ratelimit import RateLimiter
+from ._pacer import Pacer
+from ._ledger import Ledger
+from ._scheduler import Scheduler
+from ._polling import PollState
+
+# Users in flight when running with --async and no concurrency is configured
+DEFAULT_CONCURRENCY = 4
+# How often the daemon looks up the Twitter profiles and pinned tweets again
+DEFAULT_PROFILE_INTERVAL = 60 * 60
 
 
 class User(object):
     from ._twitter import get_tweets
     from ._twitter import _get_tweets
+    from ._twitter import spool_tweets
     from ._twitter import _get_tweets_v2
+    from ._twitter import _iter_tweets_v2
+    from ._twitter import iter_spooled_tweets
+    from ._twitter import _get_twitter_id
+    from ._twitter import _save_twitter_id
     from ._twitter import _get_twitter_info
+    from ._twitter import _get_last_tweet_id
+    from ._twitter import _save_last_tweet_id
 
     from ._pin import pin_pleroma
     from ._pin import unpin_pleroma
     from ._pin import get_pinned_tweet
     from ._pin import _get_pinned_tweet_id
 
+    from ._pipeline import post_pipeline
+
     from ._pleroma import post_pleroma
+    from ._pleroma import _upload_tweet_media
+    from ._pleroma import _stream_media
+    from ._pleroma import _upload_media
     from ._pleroma import update_pleroma
     from ._pleroma import get_date_last_pleroma_post
 
@@ -72,11 +110,42 @@ class User(object):
     from ._processing import _process_polls
     from ._processing import _replace_nitter
     from ._processing import _download_media
+    from ._processing import _download_tweets_media
+    from ._processing import _stream_tweets_media
+    from ._processing import _fetch_tweets_media
     from ._processing import _replace_mentions
     from ._processing import _get_best_bitrate_video
 
-    def __init__(self, user_cfg: dict, cfg: dict, base_path: str):
+    def __init__(
+        self,
+        user_cfg: dict,
+        cfg: dict,
+        base_path: str,
+        session_pool: SessionPool = None,
+        lookup: UserLookup = None,
+        url_resolver: UrlResolver = None,
+        download_pool: DownloadPool = None,
+    ):
         self.twitter_token = cfg["twitter_token"]
+        # HTTP sessions, resolved links and the limits of the downloads are
+        # shared across all users of the run when provided
+        if session_pool is None:
+            session_pool = SessionPool.from_config(cfg)
+        self.session_pool = session_pool
+        if url_resolver is None:
+            url_resolver = UrlResolver(session_pool)
+        self.url_resolver = url_resolver
+        if download_pool is None:
+            download_pool = DownloadPool.from_config(cfg, session_pool)
+        self.download_pool = download_pool
+        # Attachments downloaded are kept for every user and the following
+        # runs only if the cache is enabled
+        self.media_cache = None
+        if "media_cache_size" in cfg:
+            self.media_cache = MediaCache(
+                os.path.join(base_path, "media_cache"),
+                parse_size(str(cfg["media_cache_size"])),
+            )
         self.signature = ""
         self.media_upload = False
         self.support_account = None
@@ -115,8 +184,27 @@ class User(object):
             if not hasattr(self, "delay_post"):
                 self.delay_post = cfg["delay_post"]
         except (KeyError, AttributeError):
-            self.delay_post = 0.5
+            self.delay_post = None
+            pass
+        # Posts go as fast as the rate limits of the instance allow,
+        # delay_post is the minimum time between them
+        self.pacer = Pacer(self.delay_post)
+        try:
+            if not hasattr(self, "upload_workers"):
+                self.upload_workers = cfg["upload_workers"]
+        except (KeyError, AttributeError):
+            self.upload_workers = 2
+            pass
+        try:
+            if not hasattr(self, "stream_media"):
+                self.stream_media = cfg["stream_media"]
+        except (KeyError, AttributeError):
+            self.stream_media = False
             pass
+        # Attachments to stream to the instance for each tweet to post
+        self.media_streams = {}
+        # Attachments of each tweet processed but not downloaded yet
+        self.pending_media = {}
         try:
             if not hasattr(self, "hashtags"):
                 self.hashtags = cfg["hashtags"]
@@ -132,6 +220,9 @@ class User(object):
         if hasattr(self, "rich_text"):
             if self.rich_text:
                 self.content_type = "text/markdown"
+        # Parse the size limit of the attachments once
+        if hasattr(self, "file_max_size"):
+            self.file_max_size_bytes = parse_size(str(self.file_max_size))
         try:
             if not hasattr(self, "pleroma_base_url"):
                 self.pleroma_base_url = cfg["pleroma_base_url"]
@@ -149,7 +240,7 @@ class User(object):
             pass
         try:
             if not hasattr(self, "twitter_base_url_v2"):
-                self.twitter_base_url = cfg["twitter_base_url_v2"]
+                self.twitter_base_url_v2 = cfg["twitter_base_url_v2"]
         except KeyError:
             self.twitter_base_url_v2 = "https://api.twitter.com/2"
             pass
@@ -200,6 +291,11 @@ class User(object):
         except KeyError:
             self.fields = []
         self.bio_text = self.replace_vars_in_str(str(user_cfg["bio_text"]))
+        # Tweets already posted, shared by every user and the following runs
+        self.ledger = Ledger(os.path.join(base_path, "ledger.db"))
+        self.ledger_account = (
+            f"{self.pleroma_base_url}/{self.pleroma_username}"
+        )
         # Auth
         self.header_pleroma = {"Authorization": f"Bearer {self.pleroma_token}"}
         self.header_twitter = {"Authorization": f"Bearer {self.twitter_token}"}
@@ -226,23 +322,65 @@ class User(object):
             self.auth = None
 
         self.tweets = None
-        self.pinned_tweet_id = self._get_pinned_tweet_id()
         self.last_post_pleroma = None
+        # Variants of the videos already resolved, by media_key
+        self.video_media = {}
         # Filesystem
         # self.base_path = os.getcwd()
         self.base_path = base_path
         self.users_path = os.path.join(self.base_path, "users")
         self.users_path = os.path.join(self.base_path, "users")
         self.user_path = os.path.join(self.users_path, self.twitter_username)
-        self.tweets_temp_path = os.path.join(self.user_path, "tweets")
+        # Entries mirroring the same Twitter account to different Fediverse
+        # accounts can run at the same time, so each of them keeps its own
+        # temporary files
+        self.pleroma_account = (
+            f"{self.pleroma_username}@"
+            f"{urlsplit(self.pleroma_base_url).netloc.replace(':', '_')}"
+        )
+        self.tweets_temp_path = os.path.join(
+            self.user_path, "tweets", self.pleroma_account
+        )
         self.avatar_path = os.path.join(self.user_path, "profile.jpg")
         self.header_path = os.path.join(self.user_path, "banner.jpg")
+        # The profile sent and the last tweet mirrored are kept for each
+        # Fediverse account, as the same Twitter account may be mirrored to
+        # several of them
+        self.profile_fingerprint_path = os.path.join(
+            self.user_path, f"profile_{self.pleroma_account}.json"
+        )
+        self.last_tweet_id_path = os.path.join(
+            self.user_path, f"last_tweet_id_{self.pleroma_account}.txt"
+        )
         os.makedirs(self.users_path, exist_ok=True)
         os.makedirs(self.user_path, exist_ok=True)
         os.makedirs(self.tweets_temp_path, exist_ok=True)
-        # Get Twitter info on instance creation
-        self._get_twitter_info()
-        self._get_instance_info()
+        # How often the user tweets, only kept track of in daemon mode
+        self.poll_state = None
+        # Twitter ID cache
+        self.twitter_id = None
+        self.twitter_id_path = os.path.join(self.user_path, "twitter_id.json")
+        try:
+            if not hasattr(self, "twitter_id_ttl"):
+                self.twitter_id_ttl = cfg["twitter_id_ttl"]
+        except KeyError:
+            # A week
+            self.twitter_id_ttl = 7 * 24 * 60 * 60
+            pass
+        # Get Twitter info on instance creation, unless it was already
+        # looked up for every user at startup
+        twitter_user = {}
+        instance_info = None
+        if lookup is not None:
+            twitter_user = lookup.get_twitter_user(self.twitter_username)
+            instance_info = lookup.get_instance(self.pleroma_base_url)
+        if "id" in twitter_user:
+            self._save_twitter_id(twitter_user["id"])
+            self.pinned_tweet_id = twitter_user["pinned_tweet_id"]
+        else:
+            self.pinned_tweet_id = self._get_pinned_tweet_id()
+        self._get_twitter_info(twitter_user.get("info"))
+        self._get_instance_info(instance_info)
         self.posts = None
         return
 
@@ -324,8 +462,51 @@ def get_args(sysargs):
         help=(_("skips first run checks")),
     )
 
+    parser.add_argument(
+        "--async",
+        dest="run_async",
+        required=False,
+        action="store_true",
+        help=(
+            _(
+                "processes multiple users concurrently. The number of users "
+                "in flight can be set with 'concurrency' in the config"
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        required=False,
+        action="store",
+        type=int,
+        default=0,
+        help=(
+            _(
+                "spreads the users across WORKERS processes, each of them "
+                "with its own connection pool"
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--daemon",
+        required=False,
+        action="store_true",
+        help=(
+            _(
+                "keeps running and processes each user again every "
+                "'poll_interval' seconds, until it's stopped (SIGTERM or "
+                "SIGINT)"
+            )
+        ),
+    )
+
     parser.add_argument("--verbose", "-v", action="count", default=0)
 
+    # Dates to start from asked before processing the users (see ask_dates)
+    parser.set_defaults(input_dates=None)
+
     parser.add_argument(
         "--version", action="version", version=f"{__version__}"
     )
@@ -334,6 +515,752 @@ def get_args(sysargs):
     return args
 
 
+def expand_users(user_dict: list) -> list:
+    """Breaks apart users with multiple Twitter usernames into one user
+    per Twitter account
+
+    :param user_dict: List of users as defined in the config
+    :type user_dict: list
+    :returns: list of users with a single Twitter username each
+    :rtype: list
+    """
+    # TODO: Merge tweets of multiple accounts and order them by date
+    for user_item in user_dict[:]:
+        user_item["skip_pin"] = False
+        if isinstance(user_item["twitter_username"], list):
+            warn_msg = _(
+                "Multiple twitter users for one Fediverse account, "
+                "skipping profile and pinned tweet."
+            )
+            logger.warning(warn_msg)
+            user_item["skip_pin"] = True
+            for twitter_user in user_item["twitter_username"]:
+                new_user = dict(user_item)
+                new_user["twitter_username"] = twitter_user
+                user_dict.append(new_user)
+            user_dict.remove(user_item)
+    return user_dict
+
+
+def process_user(
+    user_item: dict,
+    config: dict,
+    base_path: str,
+    args,
+    session_pool: SessionPool,
+    lookup: UserLookup = None,
+    url_resolver: UrlResolver = None,
+    download_pool: DownloadPool = None,
+):
+    """Runs the whole mirroring pipeline for a single user of the config:
+    fetch, process and post tweets, check the pinned tweet and update the
+    Fediverse profile
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :param config: Parsed config.yml
+    :type config: dict
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :param args: Parsed command-line arguments
+    :param session_pool: HTTP sessions shared by every user in the run
+    :type session_pool: SessionPool
+    :param lookup: Twitter users and instances looked up at startup
+    :type lookup: UserLookup
+    :param url_resolver: Resolved links shared by every user in the run
+    :type url_resolver: UrlResolver
+    :param download_pool: Downloads of attachments shared by every user in
+        the run
+    :type download_pool: DownloadPool
+    """
+    first_time = False
+    logger.info("======================================")
+    logger.info(
+        _('Processing user:\t{}').format(user_item["pleroma_username"])
+    )
+
+    if is_first_time(user_item, base_path):
+        first_time_msg = _(
+            "It seems like pleroma-bot is running for the "
+            "first time for this user"
+        )
+        logger.info(first_time_msg)
+        first_time = True
+    user = User(
+        user_item,
+        config,
+        base_path,
+        session_pool,
+        lookup,
+        url_resolver,
+        download_pool,
+    )
+    try:
+        if args.daemon and not user.tweet_ids:
+            user.poll_state = get_poll_state(user_item, config, base_path)
+        if first_time and not args.skipChecks:
+            user.first_time = True
+        since_id = None
+        if needs_date(user_item, base_path, args, user.first_time):
+            input_dates = args.input_dates or {}
+            date_pleroma = user.force_date(
+                input_dates.get(get_date_key(user_item))
+            )
+        else:
+            # Only ask the Fediverse instance for the date of the last post
+            # when we don't know the last tweet mirrored
+            since_id = user._get_last_tweet_id()
+            if since_id:
+                date_pleroma = None
+            else:
+                date_pleroma = user.get_date_last_pleroma_post()
+
+        if user.tweet_ids:
+            tweets = Timeline({"meta": {"result_count": len(user.tweet_ids)}})
+            for tweet_id in user.tweet_ids:
+                tweets.merge(user._get_tweets("v2", tweet_id=tweet_id))
+            pages = [tweets]
+        else:
+            # Pages are written to disk as they arrive and posted oldest first,
+            # so only one page of tweets is held in memory at a time
+            pages = user.iter_spooled_tweets(
+                user.spool_tweets(start_time=date_pleroma, since_id=since_id)
+            )
+
+        # Tweets are processed, their attachments downloaded and uploaded in
+        # stages that overlap, and they are posted in order as soon as they're
+        # ready
+        tweet_counter = 0
+        for item in user.post_pipeline(pages):
+            if item[0] == "page":
+                tweet_counter = 0
+                meta = item[1]
+                # Tweets filtered out are also behind the cursor now
+                if not user.tweet_ids and "newest_id" in meta:
+                    user._save_last_tweet_id(meta["newest_id"])
+                continue
+            _kind, tweet, tweet_count, upload = item
+            tweet_counter += 1
+            logger.info(f"({tweet_counter}/{tweet_count})")
+            user.post_pleroma(
+                (tweet["id"], tweet["text"]),
+                tweet["polls"],
+                tweet["possibly_sensitive"],
+                media_ids=upload.result(),
+            )
+            if not user.tweet_ids:
+                user._save_last_tweet_id(tweet["id"])
+        if user.poll_state is not None:
+            user.poll_state.update()
+        if not user.skip_pin:
+            user.check_pinned()
+
+        if not args.noProfile:
+            if user.skip_pin:
+                logger.warning(
+                    _("Multiple twitter users, not updating profile")
+                )
+            else:
+                user.update_pleroma()
+        # Clean-up
+        shutil.rmtree(user.tweets_temp_path)
+    finally:
+        # Failed runs in daemon mode would otherwise leak the connection
+        user.ledger.close()
+
+
+def is_first_time(user_item: dict, base_path: str) -> bool:
+    """Returns whether pleroma-bot runs for the first time for the user
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :rtype: bool
+    """
+    user_path = os.path.join(
+        base_path, "users", user_item["twitter_username"]
+    )
+    return not os.path.exists(user_path)
+
+
+def needs_date(
+    user_item: dict, base_path: str, args, first_time: bool = None
+) -> bool:
+    """Returns whether the date to start retrieving tweets from has to be
+    asked for the user: on its first run or when forced with --forceDate,
+    unless --skipChecks is used
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :param args: Parsed command-line arguments
+    :param first_time: Whether it's the first run for the user. If not
+        provided, it's checked in base_path
+    :type first_time: bool
+    :rtype: bool
+    """
+    if args.skipChecks:
+        return False
+    if first_time is None:
+        first_time = is_first_time(user_item, base_path)
+    return (
+        first_time
+        or args.forceDate == "all"
+        or args.forceDate == user_item["twitter_username"]
+    )
+
+
+def get_date_key(user_item: dict) -> str:
+    """Returns the key of the user in the dates asked by ask_dates
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :rtype: str
+    """
+    return "/".join(
+        str(user_item.get(key))
+        for key in ("pleroma_base_url", "pleroma_username", "twitter_username")
+    )
+
+
+def ask_dates(user_dict: list, base_path: str, args):
+    """Asks for the date to start from of every user that needs it before
+    any of them is processed. Worker processes can't prompt (their stdin is
+    /dev/null) and neither can a daemon run by systemd or Docker
+
+    :param user_dict: Expanded list of users from the config
+    :type user_dict: list
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :param args: Parsed command-line arguments
+    :returns: copy of args with the answers in 'input_dates'
+    """
+    input_dates = {}
+    for user_item in user_dict:
+        if not needs_date(user_item, base_path, args):
+            continue
+        logger.info(
+            _("Date to start from for user:\t{}").format(
+                user_item["pleroma_username"]
+            )
+        )
+        try:
+            input_dates[get_date_key(user_item)] = ask_date()
+        except EOFError:
+            raise ValueError(
+                _(
+                    "Can't ask how far back to retrieve the tweets of {} "
+                    "without a terminal. Run pleroma-bot interactively "
+                    "once or use --skipChecks"
+                ).format(user_item["twitter_username"])
+            )
+    args = copy.copy(args)
+    args.input_dates = input_dates
+    return args
+
+
+def run_user(
+    user_item: dict,
+    config: dict,
+    base_path: str,
+    args,
+    session_pool: SessionPool,
+    lookup: UserLookup = None,
+    url_resolver: UrlResolver = None,
+    download_pool: DownloadPool = None,
+) -> dict:
+    """Runs process_user, logging any exception instead of raising it so the
+    rest of the users can still be processed
+
+    :returns: result of processing the user, to be used in the run summary
+    :rtype: dict
+    """
+    result = {
+        "pleroma_username": user_item["pleroma_username"],
+        "twitter_username": user_item["twitter_username"],
+        "ok": True,
+        "error": None,
+    }
+    try:
+        process_user(
+            user_item,
+            config,
+            base_path,
+            args,
+            session_pool,
+            lookup,
+            url_resolver,
+            download_pool,
+        )
+    except Exception as e:
+        logger.error(
+            _("Exception occurred for user:\t{}").format(
+                user_item["pleroma_username"]
+            ),
+            exc_info=True,
+        )
+        result.update({"ok": False, "error": repr(e)})
+    return result
+
+
+async def _process_users_async(
+    user_dict: list,
+    config: dict,
+    base_path: str,
+    args,
+    session_pool: SessionPool,
+    concurrency: int,
+    lookup: UserLookup = None,
+    url_resolver: UrlResolver = None,
+    download_pool: DownloadPool = None,
+) -> list:
+    """Runs the pipelines of multiple users concurrently, with at most
+    'concurrency' users in flight at the same time. Each pipeline runs in
+    order on its own, so posts within an account keep their order.
+
+    :returns: results of every user processed
+    :rtype: list
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def run_user_async(user_item):
+        async with semaphore:
+            return await loop.run_in_executor(
+                executor,
+                run_user,
+                user_item,
+                config,
+                base_path,
+                args,
+                session_pool,
+                lookup,
+                url_resolver,
+                download_pool,
+            )
+
+    try:
+        results = await asyncio.gather(
+            *[run_user_async(user_item) for user_item in user_dict]
+        )
+    finally:
+        executor.shutdown(wait=True)
+    return list(results)
+
+
+def run_async(
+    user_dict: list,
+    config: dict,
+    base_path: str,
+    args,
+    session_pool: SessionPool,
+    concurrency: int,
+    lookup: UserLookup = None,
+    url_resolver: UrlResolver = None,
+    download_pool: DownloadPool = None,
+) -> list:
+    """Sync entry point for the asyncio execution mode
+
+    :returns: results of every user processed
+    :rtype: list
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(
+            _process_users_async(
+                user_dict,
+                config,
+                base_path,
+                args,
+                session_pool,
+                concurrency,
+                lookup,
+                url_resolver,
+                download_pool,
+            )
+        )
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def partition_users(user_dict: list, workers: int) -> list:
+    """Splits the users in (at most) 'workers' chunks of similar size
+
+    :param user_dict: Expanded list of users from the config
+    :type user_dict: list
+    :param workers: How many chunks to create
+    :type workers: int
+    :returns: list of lists of users
+    :rtype: list
+    """
+    chunks = [user_dict[idx::workers] for idx in range(workers)]
+    return [chunk for chunk in chunks if chunk]
+
+
+def _init_worker(log_queue, log_level: int):
+    """Sends the logs of a worker process to the parent process, so the
+    output of every worker ends up in the same handlers
+    """
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logging.getLogger().setLevel(log_level)
+
+
+def _run_worker(
+    user_items: list,
+    config: dict,
+    base_path: str,
+    args,
+    lookup: UserLookup = None,
+) -> list:
+    """Processes a chunk of users inside a worker process, which keeps its
+    own pool of HTTP sessions
+
+    :returns: results of every user processed by the worker
+    :rtype: list
+    """
+    session_pool = SessionPool.from_config(
+        config, get_rate_limiter(base_path)
+    )
+    url_resolver = get_url_resolver(base_path, session_pool)
+    download_pool = DownloadPool.from_config(config, session_pool)
+    try:
+        concurrency = get_concurrency(args, config)
+        if concurrency > 1:
+            return run_async(
+                user_items,
+                config,
+                base_path,
+                args,
+                session_pool,
+                concurrency,
+                lookup,
+                url_resolver,
+                download_pool,
+            )
+        return [
+            run_user(
+                user_item,
+                config,
+                base_path,
+                args,
+                session_pool,
+                lookup,
+                url_resolver,
+                download_pool,
+            )
+            for user_item in user_items
+        ]
+    finally:
+        url_resolver.save()
+        session_pool.close()
+
+
+def run_workers(
+    user_dict: list,
+    config: dict,
+    base_path: str,
+    args,
+    workers: int,
+    lookup: UserLookup = None,
+) -> list:
+    """Spreads the users across a pool of 'workers' processes
+
+    :returns: results of every user processed
+    :rtype: list
+    """
+    chunks = partition_users(user_dict, workers)
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(
+        log_queue, *logger.handlers, respect_handler_level=True
+    )
+    listener.start()
+    try:
+        with multiprocessing.Pool(
+            processes=len(chunks),
+            initializer=_init_worker,
+            initargs=(log_queue, logging.getLogger().level),
+        ) as pool:
+            chunk_results = pool.starmap(
+                _run_worker,
+                [
+                    (chunk, config, base_path, args, lookup)
+                    for chunk in chunks
+                ],
+            )
+    finally:
+        listener.stop()
+    return [result for results in chunk_results for result in results]
+
+
+def get_poll_state(
+    user_item: dict, config: dict, base_path: str
+) -> PollState:
+    """Returns the adaptive polling state kept in the user folder
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :param config: Parsed config.yml
+    :type config: dict
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :returns: polling state of the user
+    :rtype: PollState
+    """
+    state_path = os.path.join(
+        base_path, "users", user_item["twitter_username"], "poll_state.json"
+    )
+    return PollState.from_config(state_path, user_item, config)
+
+
+def get_poll_interval(user_item: dict, config: dict, base_path: str) -> float:
+    """Returns how often the user should be processed in daemon mode:
+    'poll_interval' if it's configured, otherwise the interval adapted to how
+    often the user tweets
+
+    :param user_item: User mapping from the config
+    :type user_item: dict
+    :param config: Parsed config.yml
+    :type config: dict
+    :param base_path: Directory where the users' state is stored
+    :type base_path: str
+    :returns: seconds between the runs of the user
+    :rtype: float
+    """
+    poll_interval = user_item.get(
+        "poll_interval", config.get("poll_interval")
+    )
+    if poll_interval is None:
+        return get_poll_state(user_item, config, base_path).interval
+    poll_interval = float(poll_interval)
+    if poll_interval <= 0:
+        raise ValueError(
+            _(
+                "poll_interval must be a positive number. poll_interval: {}"
+            ).format(poll_interval)
+        )
+    return poll_interval
+
+
+def get_profile_interval(config: dict) -> float:
+    """Returns how often the daemon looks up the Twitter profiles and pinned
+    tweets of the users again
+
+    :param config: Parsed config.yml
+    :type config: dict
+    :returns: seconds between the lookups
+    :rtype: float
+    """
+    profile_interval = float(
+        config.get("profile_interval", DEFAULT_PROFILE_INTERVAL)
+    )
+    if profile_interval <= 0:
+        raise ValueError(
+            _(
+                "profile_interval must be a positive number. "
+                "profile_interval: {}"
+            ).format(profile_interval)
+        )
+    return profile_interval
+
+
+def run_daemon(
+    user_dict: list,
+    config: dict,
+    base_path: str,
+    args,
+    session_pool: SessionPool,
+    concurrency: int,
+    url_resolver: UrlResolver = None,
+    download_pool: DownloadPool = None,
+    stop: threading.Event = None,
+):
+    """Keeps processing the users until it's stopped, each of them every
+    'poll_interval' seconds (or as often as it tweets, if it's not set). The
+    process, the config and the connection pools stay warm between runs,
+    and the users due next are kept in a min-heap so it sleeps until then.
+    The instances are looked up once, and the Twitter profiles and pinned
+    tweets every 'profile_interval' seconds for every user at once.
+    SIGTERM and SIGINT stop it once the users being processed are done
+
+    :param stop: Event stopping the daemon when set
+    :type stop: threading.Event
+    """
+    stop = stop or threading.Event()
+    profile_interval = get_profile_interval(config)
+    scheduler = Scheduler()
+    now = time.time()
+    for idx, user_item in enumerate(user_dict):
+        poll_interval = get_poll_interval(user_item, config, base_path)
+        # Carry on with the schedule of the previous runs
+        polled_at = get_poll_state(user_item, config, base_path).polled_at
+        if polled_at is None or args.forceDate:
+            scheduler.schedule(idx, now)
+        else:
+            scheduler.schedule(idx, min(now, polled_at) + poll_interval)
+
+    def handle_signal(signum, frame):
+        logger.info(_("Stopping after the users being processed..."))
+        stop.set()
+
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(signum, handle_signal)
+    try:
+        lookup = UserLookup.resolve(user_dict, config, session_pool)
+        looked_up_at = time.time()
+        while not stop.is_set():
+            wait = scheduler.next_due() - time.time()
+            if wait > 0:
+                logger.debug(
+                    _("Waiting {}s for the next user...").format(
+                        round(wait)
+                    )
+                )
+                stop.wait(wait)
+                continue
+            due = scheduler.pop_due()
+            due_items = [user_dict[idx] for idx in due]
+            try:
+                if time.time() - looked_up_at >= profile_interval:
+                    # Profiles and pinned tweets may have changed since then
+                    lookup.refresh(user_dict, config, session_pool)
+                    looked_up_at = time.time()
+                if concurrency > 1:
+                    results = run_async(
+                        due_items,
+                        config,
+                        base_path,
+                        args,
+                        session_pool,
+                        concurrency,
+                        lookup,
+                        url_resolver,
+                        download_pool,
+                    )
+                else:
+                    results = []
+                    for user_item in due_items:
+                        if stop.is_set():
+                            break
+                        results.append(
+                            run_user(
+                                user_item,
+                                config,
+                                base_path,
+                                args,
+                                session_pool,
+                                lookup,
+                                url_resolver,
+                                download_pool,
+                            )
+                        )
+                log_summary(results)
+            except Exception:
+                logger.error(_("Exception occurred"), exc_info=True)
+            finally:
+                # Keep the state on disk in case the process gets killed
+                if url_resolver is not None:
+                    url_resolver.save()
+                session_pool.rate_limiter.save()
+            if args.forceDate or args.input_dates:
+                # Only the first run of each user starts from a forced date
+                args = copy.copy(args)
+                args.forceDate = None
+                args.input_dates = None
+            now = time.time()
+            for idx in due:
+                poll_interval = get_poll_interval(
+                    user_dict[idx], config, base_path
+                )
+                scheduler.schedule(idx, now + poll_interval)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    logger.info(_("Daemon stopped"))
+
+
+def log_summary(results: list) -> int:
+    """Logs a summary of the run
+
+    :param results: Results of every user processed
+    :type results: list
+    :returns: how many users failed
+    :rtype: int
+    """
+    failed = [result for result in results if not result["ok"]]
+    logger.info("======================================")
+    logger.info(
+        _("Run summary: {ok} users processed, {failed} failed").format(
+            ok=len(results) - len(failed), failed=len(failed)
+        )
+    )
+    for result in failed:
+        logger.error(
+            _("Failed user:\t{user} ({twitter}) - {error}").format(
+                user=result["pleroma_username"],
+                twitter=result["twitter_username"],
+                error=result["error"],
+            )
+        )
+    return len(failed)
+
+
+def get_rate_limiter(base_path: str) -> RateLimiter:
+    """Returns a RateLimiter which persists its state in base_path, so the
+    following runs know what's left of the Twitter rate limit windows
+
+    :param base_path: Directory where the state of the run is stored
+    :type base_path: str
+    :rtype: RateLimiter
+    """
+    return RateLimiter(os.path.join(base_path, "rate_limits.json"))
+
+
+def get_url_resolver(base_path: str, session_pool: SessionPool):
+    """Returns a UrlResolver which persists the links resolved in base_path,
+    so they aren't resolved again in the following runs
+
+    :param base_path: Directory where the state of the run is stored
+    :type base_path: str
+    :param session_pool: HTTP sessions used to resolve the links
+    :type session_pool: SessionPool
+    :rtype: UrlResolver
+    """
+    return UrlResolver(
+        session_pool, os.path.join(base_path, "url_cache.json")
+    )
+
+
+def get_concurrency(args, config: dict) -> int:
+    """Returns how many users should be processed concurrently.
+    1 means the users are processed sequentially.
+
+    :param args: Parsed command-line arguments
+    :param config: Parsed config.yml
+    :type config: dict
+    :returns: number of users allowed in flight
+    :rtype: int
+    """
+    concurrency = int(config.get("concurrency", 1))
+    if args.run_async and concurrency <= 1:
+        concurrency = DEFAULT_CONCURRENCY
+    if concurrency < 1:
+        raise ValueError(
+            _("concurrency must be at least 1. concurrency: {}").format(
+                concurrency
+            )
+        )
+    return concurrency
+
+
 def main():
     # Convert legacy flag to proper flag format
     mangle_args = "noProfile"
@@ -346,6 +1273,8 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug(_("Debug logging enabled"))
 
+    session_pool = None
+    url_resolver = None
     try:
         base_path = os.getcwd()
         if args.config:
@@ -357,130 +1286,93 @@ def main():
         with open(config_path, "r") as stream:
             config = yaml.safe_load(stream)
         user_dict = config["users"]
-        users_path = os.path.join(base_path, "users")
-        # TODO: Merge tweets of multiple accounts and order them by date
-        for user_item in user_dict[:]:
-            user_item["skip_pin"] = False
-            if isinstance(user_item["twitter_username"], list):
-                warn_msg = _(
-                    "Multiple twitter users for one Fediverse account, "
-                    "skipping profile and pinned tweet."
+        session_pool = SessionPool.from_config(
+            config, get_rate_limiter(base_path)
+        )
+        user_dict = expand_users(user_dict)
+        url_resolver = get_url_resolver(base_path, session_pool)
+        download_pool = DownloadPool.from_config(config, session_pool)
+
+        concurrency = get_concurrency(args, config)
+        if args.workers < 0:
+            raise ValueError(
+                _("workers must be a positive number. workers: {}").format(
+                    args.workers
                 )
-                logger.warning(warn_msg)
-                user_item["skip_pin"] = True
-                for twitter_user in user_item["twitter_username"]:
-                    new_user = dict(user_item)
-                    new_user["twitter_username"] = twitter_user
-                    user_dict.append(new_user)
-                user_dict.remove(user_item)
-
-        for user_item in user_dict:
-            first_time = False
-            logger.info("======================================")
-            logger.info(
-                _('Processing user:\t{}').format(user_item["pleroma_username"])
             )
-            user_path = os.path.join(users_path, user_item["twitter_username"])
-
-            if not os.path.exists(user_path):
-                first_time_msg = _(
-                    "It seems like pleroma-bot is running for the "
-                    "first time for this user"
+        if args.daemon and args.workers > 1:
+            raise ValueError(
+                _("--daemon can't be used along with --workers")
+            )
+        args = ask_dates(user_dict, base_path, args)
+        if args.daemon:
+            run_daemon(
+                user_dict,
+                config,
+                base_path,
+                args,
+                session_pool,
+                concurrency,
+                url_resolver,
+                download_pool,
+            )
+            return 0
+        lookup = UserLookup.resolve(user_dict, config, session_pool)
+        if args.workers > 1:
+            logger.info(
+                _("Spreading users across {} worker processes").format(
+                    args.workers
                 )
-                logger.info(first_time_msg)
-                first_time = True
-            user = User(user_item, config, base_path)
-            if first_time and not args.skipChecks:
-                user.first_time = True
-            if (
-                (args.forceDate and args.forceDate == user.twitter_username)
-                or args.forceDate == "all"
-                or user.first_time
-            ) and not args.skipChecks:
-                date_pleroma = user.force_date()
-            else:
-                date_pleroma = user.get_date_last_pleroma_post()
-
-            if user.tweet_ids:
-                tweets = {
-                    "data": [],
-                    "includes": {},
-                    "meta": {"result_count": len(user.tweet_ids)}
-                }
-                includes = ["users", "tweets", "media", "polls"]
-                for include in includes:
-                    try:
-                        _include = tweets["includes"][include]
-                    except KeyError:
-                        tweets["includes"].update({include: []})
-                for tweet_id in user.tweet_ids:
-                    next_tweet = user._get_tweets("v2", tweet_id=tweet_id)
-                    includes = ["users", "tweets", "media", "polls"]
-                    for include in includes:
-                        try:
-                            _include = next_tweet["includes"][include]
-                            _include = _include
-                        except KeyError:
-                            next_tweet["includes"].update({include: []})
-                    tweets["data"].append(next_tweet["data"])
-                    for user_tweet in next_tweet["includes"]["users"]:
-                        tweets["includes"]["users"].append(user_tweet)
-                    for tweet_include in next_tweet["includes"]["tweets"]:
-                        tweets["includes"]["tweets"].append(tweet_include)
-                    for media in next_tweet["includes"]["media"]:
-                        tweets["includes"]["media"].append(media)
-                    for poll in next_tweet["includes"]["polls"]:
-                        tweets["includes"]["polls"].append(poll)
-            else:
-                tweets = user.get_tweets(start_time=date_pleroma)
-            logger.debug(f"tweets: \t {tweets}")
-
-            if 'meta' not in tweets:
-                error_msg = _(
-                    "Unable to retrieve tweets. Is the account protected?"
-                    " If so, you need to provide the following OAuth 1.0a"
-                    " fields in the user config:\n - consumer_key \n "
-                    "- consumer_secret \n - access_token_key \n "
-                    "- access_token_secret"
+            )
+            results = run_workers(
+                user_dict, config, base_path, args, args.workers, lookup
+            )
+            if log_summary(results):
+                return 1
+        elif concurrency > 1:
+            logger.info(
+                _("Processing up to {} users concurrently").format(
+                    concurrency
                 )
-                logger.error(error_msg)
-
-            if tweets["meta"]["result_count"] > 0:
-                logger.info(
-                    _("tweet count: \t {}").format(len(tweets['data']))
+            )
+            results = run_async(
+                user_dict,
+                config,
+                base_path,
+                args,
+                session_pool,
+                concurrency,
+                lookup,
+                url_resolver,
+                download_pool,
+            )
+            if log_summary(results):
+                return 1
+        else:
+            # A failing user doesn't stop the rest
+            results = [
+                run_user(
+                    user_item,
+                    config,
+                    base_path,
+                    args,
+                    session_pool,
+                    lookup,
+                    url_resolver,
+                    download_pool,
                 )
-                # Put oldest first to iterate them and post them in order
-                tweets["data"].reverse()
-                tweets_to_post = user.process_tweets(tweets)
-                logger.debug(f"tweets_processed: \t {tweets_to_post['data']}")
-                tweet_counter = 0
-                for tweet in tweets_to_post["data"]:
-                    tweet_counter += 1
-                    logger.info(
-                        f"({tweet_counter}/{len(tweets_to_post['data'])})"
-                    )
-                    user.post_pleroma(
-                        (tweet["id"], tweet["text"]),
-                        tweet["polls"],
-                        tweet["possibly_sensitive"],
-                    )
-
-                    time.sleep(user.delay_post)
-            if not user.skip_pin:
-                user.check_pinned()
-
-            if not args.noProfile:
-                if user.skip_pin:
-                    logger.warning(
-                        _("Multiple twitter users, not updating profile")
-                    )
-                else:
-                    user.update_pleroma()
-            # Clean-up
-            shutil.rmtree(user.tweets_temp_path)
+                for user_item in user_dict
+            ]
+            if log_summary(results):
+                return 1
     except Exception:
         logger.error(_("Exception occurred"), exc_info=True)
         return 1
+    finally:
+        if url_resolver is not None:
+            url_resolver.save()
+        if session_pool is not None:
+            session_pool.close()
 
     return 0
 
@@ -39,6 +39,12 @@ def mock_request(rootdir):
         mock.get(f"{twitter_base_url}/users/show.json",
                  json=sample_data['twitter_info'],
                  status_code=200)
+        mock.get(f"{twitter_base_url}/users/lookup.json",
+                 json=users_lookup(sample_data),
+                 status_code=200)
+        mock.get(f"{twitter_base_url_v2}/users/by",
+                 json=users_by(sample_data, test_user.pinned),
+                 status_code=200)
         mock.get(f"{pleroma_base_url}/api/v1/instance",
                  json={'version': '2.7.2 (compatible; Pleroma 2.2.1)'},
                  status_code=200)
@@ -57,6 +63,9 @@ def mock_request(rootdir):
         mock.get(f"{twitter_base_url}/statuses/show.json",
                  json=sample_data['tweet'],
                  status_code=200)
+        mock.get(f"{twitter_base_url}/statuses/lookup.json",
+                 json=statuses_lookup(sample_data),
+                 status_code=200)
         mock_return['mock'] = mock
         mock_return['sample_data'] = sample_data
         return mock_return
@@ -76,7 +85,8 @@ def _sample_users(mock_request, rootdir):
                      f"?poll.fields=duration_minutes%2Cend_datetime%2Cid%2C"
                      f"options%2Cvoting_status&media.fields=duration_ms%2C"
                      f"height%2Cmedia_key%2Cpreview_image_url%2Ctype%2Curl%2C"
-                     f"width%2Cpublic_metrics&expansions=attachments.poll_ids"
+                     f"width%2Cpublic_metrics%2Cvariants&expansions="
+                     f"attachments.poll_ids"
                      f"%2Cattachments.media_keys%2Cauthor_id%2C"
                      f"entities.mentions.username%2Cgeo.place_id%2C"
                      f"in_reply_to_user_id%2Creferenced_tweets.id%2C"
@@ -91,7 +101,8 @@ def _sample_users(mock_request, rootdir):
                      f"?poll.fields=duration_minutes%2Cend_datetime%2Cid%2C"
                      f"options%2Cvoting_status&media.fields=duration_ms%2C"
                      f"height%2Cmedia_key%2Cpreview_image_url%2Ctype%2Curl%2C"
-                     f"width%2Cpublic_metrics&expansions=attachments.poll_ids"
+                     f"width%2Cpublic_metrics%2Cvariants&expansions="
+                     f"attachments.poll_ids"
                      f"%2Cattachments.media_keys%2Cauthor_id%2C"
                      f"entities.mentions.username%2Cgeo.place_id%2C"
                      f"in_reply_to_user_id%2Creferenced_tweets.id%2C"
@@ -211,11 +222,13 @@ def _sample_users(mock_request, rootdir):
 
             mock.get("https://video.twimg.com/tweet_video/ElxpatpX0AAFCLC.mp4",
                      content=gif_content,
-                     headers={'Content-Type': 'image/gif'},
+                     headers={'Content-Type': 'image/gif',
+                              'Content-Length': str(len(gif_content))},
                      status_code=200)
             mock.get("https://pbs.twimg.com/media/ElxpP0hXEAI9X-H.jpg",
                      content=png_content,
-                     headers={'Content-Type': 'image/png'},
+                     headers={'Content-Type': 'image/png',
+                              'Content-Length': str(len(png_content))},
                      status_code=200)
             mock.get(f"{test_user.twitter_base_url}/statuses/show.json?"
                      f"id=1323049214134407171",
@@ -224,7 +237,8 @@ def _sample_users(mock_request, rootdir):
             mock.get("https://video.twimg.com/ext_tw_video/1323049175848833033"
                      "/pu/vid/1280x720/de6uahiosn3VXMZO.mp4?tag=10",
                      content=mp4_content,
-                     headers={'Content-Type': 'video/mp4'},
+                     headers={'Content-Type': 'video/mp4',
+                              'Content-Length': str(len(mp4_content))},
                      status_code=200)
 
             twitter_info = mock_request['sample_data']['twitter_info']
@@ -263,7 +277,19 @@ def _sample_users(mock_request, rootdir):
                     'config': config_users['config']}
             )
         sample_users = {'users': users, 'global_mock': mock}
-        return sample_users
+    yield sample_users
+    # The tweets posted by a test aren't skipped by the following ones
+    for user in users:
+        user['user_obj'].ledger.close()
+    for base_path in (
+        os.getcwd(),
+        os.path.join(os.getcwd(), os.pardir),
+        os.path.join(rootdir, 'test_files'),
+    ):
+        for ledger_file in ('ledger.db', 'ledger.db-wal', 'ledger.db-shm'):
+            ledger_path = os.path.join(base_path, ledger_file)
+            if os.path.isfile(ledger_path):
+                os.remove(ledger_path)
 
 
 @pytest.fixture
@@ -276,6 +302,43 @@ def global_mock(_sample_users):
     return _sample_users['global_mock']
 
 
+def users_lookup(sample_data):
+    def callback(request, context):
+        usernames = request.qs['screen_name'][0].split(',')
+        return [
+            dict(sample_data['twitter_info'], screen_name=username)
+            for username in usernames
+        ]
+    return callback
+
+
+def users_by(sample_data, pinned):
+    def callback(request, context):
+        usernames = request.qs['usernames'][0].split(',')
+        user_id = sample_data['user_id']['data'][0]['id']
+        return {
+            'data': [
+                {'id': user_id, 'username': username,
+                 'pinned_tweet_id': pinned}
+                for username in usernames
+            ],
+            'includes': {'tweets': [{'id': pinned, 'text': 'Poll'}]}
+        }
+    return callback
+
+
+def statuses_lookup(sample_data):
+    def callback(request, context):
+        tweet_ids = request.qs['id'][0].split(',')
+        video = sample_data['tweet_video']
+        return [
+            video if tweet_id == video['id_str']
+            else dict(sample_data['tweet'], id_str=tweet_id)
+            for tweet_id in tweet_ids
+        ]
+    return callback
+
+
 def get_config_users(config):
     rootdir = os.path.dirname(os.path.abspath(__file__))
     configs_dir = os.path.join(rootdir, 'test_files')
@@ -133,7 +133,8 @@ def test_check_pinned_exception_user(sample_users, mock_request):
         f"?poll.fields=duration_minutes%2Cend_datetime%2Cid"
         f"%2Coptions%2Cvoting_status&media.fields=duration_ms"
         f"%2Cheight%2Cmedia_key%2Cpreview_image_url%2Ctype"
-        f"%2Curl%2Cwidth%2Cpublic_metrics&expansions="
+        f"%2Curl%2Cwidth%2Cpublic_metrics%2Cvariants"
+        f"&expansions="
         f"attachments.poll_ids%2Cattachments.media_keys"
         f"%2Cauthor_id%2Centities.mentions.username"
         f"%2Cgeo.place_id%2Cin_reply_to_user_id%2C"
@@ -186,10 +187,21 @@ def test_check_pinned_exception_tweet(sample_users, mock_request):
             f"&expansions=attachments.poll_ids"
             f"&poll.fields=duration_minutes%2Coptions"
         )
+        # Polls missing from the includes are retrieved separately
+        pinned_tweet = dict(mock_request['sample_data']['pinned_tweet'])
+        pinned_tweet['includes'] = {
+            include: objects
+            for include, objects in pinned_tweet['includes'].items()
+            if include != 'polls'
+        }
         # Test exception
         for sample_user in sample_users:
             with sample_user['mock'] as mock:
                 sample_user_obj = sample_user['user_obj']
+                mock.get(f"{test_user.twitter_base_url_v2}/tweets/"
+                         f"{test_user.pinned}",
+                         json=pinned_tweet,
+                         status_code=200)
                 mock.get(url_tweet,
                          json=mock_request['sample_data']['poll'],
                          status_code=500)
@@ -374,6 +386,10 @@ def test_update_pleroma_exception(rootdir, mock_request, sample_users, caplog):
     for sample_user in sample_users:
         with sample_user['mock'] as mock:
             sample_user_obj = sample_user['user_obj']
+            # Force the images to be downloaded again
+            fingerprint = sample_user_obj.profile_fingerprint_path
+            if os.path.isfile(fingerprint):
+                os.remove(fingerprint)
             mock.get(profile_url,
                      content=profile_image_content,
                      status_code=500)
@@ -482,6 +498,10 @@ def test__get_tweets_v2_exception(sample_users):
                 f"usernames={sample_user_obj.twitter_username}"
             )
             mock.get(tweets_url, status_code=500)
+            # Make sure the ID isn't cached
+            sample_user_obj.twitter_id = None
+            if os.path.isfile(sample_user_obj.twitter_id_path):
+                os.remove(sample_user_obj.twitter_id_path)
             start_time = sample_user_obj.get_date_last_pleroma_post()
             with pytest.raises(requests.exceptions.HTTPError) as error_info:
                 sample_user_obj._get_tweets(
@@ -609,14 +629,20 @@ def test__download_media_exception(sample_users, caplog):
             assert warn_msg2 in caplog.text
 
 
-def test__expand_urls(sample_users, mock_request):
+def test__expand_urls(sample_users, mock_request, caplog):
     for sample_user in sample_users:
         with sample_user['mock'] as mock:
             sample_user_obj = sample_user['user_obj']
             fake_url = "https://cutt.ly/xg3TuY0"
             mock.head(fake_url, status_code=500)
             tweet = mock_request['sample_data']['pinned_tweet']['data']
-            with pytest.raises(requests.exceptions.HTTPError) as error_info:
-                sample_user_obj._expand_urls(tweet)
+            with caplog.at_level(logging.WARNING):
+                text = sample_user_obj._expand_urls(tweet)
+            # Links that can't be resolved are left as they are
+            assert text == tweet["text"]
             exception_value = f"500 Server Error: None for url: {fake_url}"
-            assert str(error_info.value) == exception_value
+            assert exception_value in caplog.text
+            # and aren't retried right away
+            history_len = len(mock.request_history)
+            sample_user_obj._expand_urls(tweet)
+            assert len(mock.request_history) == history_len
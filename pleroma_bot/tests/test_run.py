@@ -1,10 +1,16 @@
 import os
 import sys
+import time
 import shutil
+import signal
+import sqlite3
 import hashlib
 import logging
+import threading
+import requests
 import urllib.parse
 from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from urllib import parse
 from test_user import UserTemplate
@@ -13,6 +19,20 @@ from conftest import get_config_users
 from pleroma_bot import cli, User
 from pleroma_bot._utils import random_string
 from pleroma_bot._utils import guess_type
+from pleroma_bot._lookup import UserLookup
+from pleroma_bot._session import SessionPool
+from pleroma_bot._session import CircuitOpen
+from pleroma_bot._download import DownloadPool
+from pleroma_bot._download import AttachmentTooLarge
+from pleroma_bot._media_cache import MediaCache
+from pleroma_bot._timeline import Timeline
+from pleroma_bot._resolver import UrlResolver
+from pleroma_bot._ratelimit import RateLimiter
+from pleroma_bot._pacer import Pacer
+from pleroma_bot._pipeline import Pipeline
+from pleroma_bot._ledger import Ledger
+from pleroma_bot._scheduler import Scheduler
+from pleroma_bot._polling import PollState
 
 
 def test_random_string():
@@ -23,6 +43,303 @@ def test_random_string():
     assert len(random_10) == 10
 
 
+def test_session_pool():
+    """
+    Check that sessions are reused per host and sized as configured
+    """
+    test_user = UserTemplate()
+    session_pool = SessionPool.from_config(
+        {"pool_connections": 2, "pool_maxsize": 20}
+    )
+    assert session_pool.pool_connections == 2
+    assert session_pool.pool_maxsize == 20
+    twitter = session_pool.session(f"{test_user.twitter_base_url}/users")
+    twitter_v2 = session_pool.session(f"{test_user.twitter_base_url_v2}/t")
+    pleroma = session_pool.session(test_user.pleroma_base_url)
+    assert twitter is twitter_v2
+    assert twitter is not pleroma
+    adapter = twitter.get_adapter(test_user.twitter_base_url)
+    assert adapter._pool_maxsize == 20
+    session_pool.close()
+    assert session_pool.session(test_user.pleroma_base_url) is not pleroma
+
+
+def test_rate_limiter_endpoint():
+    test_user = UserTemplate()
+    v2 = test_user.twitter_base_url_v2
+    endpoint = RateLimiter.endpoint("get", f"{v2}/users/2244994945/tweets")
+    assert endpoint == "GET api.twitter.com/2/users/:id/tweets"
+    endpoint = RateLimiter.endpoint("GET", f"{v2}/users/by/username/Test")
+    assert endpoint == "GET api.twitter.com/2/users/by/username/:username"
+    endpoint = RateLimiter.endpoint(
+        "GET", f"{test_user.twitter_base_url}/statuses/show.json?id=1"
+    )
+    assert endpoint == "GET api.twitter.com/1.1/statuses/show.json"
+
+
+def test_rate_limiter_acquire(tmp_path):
+    waits = []
+    state_path = os.path.join(str(tmp_path), "rate_limits.json")
+    rate_limiter = RateLimiter(state_path, sleep=waits.append)
+    endpoint = "GET api.twitter.com/2/tweets"
+    # Unknown windows don't hold calls back
+    rate_limiter.acquire(endpoint)
+    reset = time.time() + 60
+    headers = {
+        "x-rate-limit-limit": "2",
+        "x-rate-limit-remaining": "1",
+        "x-rate-limit-reset": str(reset),
+    }
+    assert rate_limiter.update(endpoint, headers)
+    rate_limiter.acquire(endpoint)
+    assert waits == []
+    assert rate_limiter.windows[endpoint]["remaining"] == 0
+    # The window is persisted for the next run
+    rate_limiter.save()
+    rate_limiter_next = RateLimiter(state_path, sleep=waits.append)
+    assert rate_limiter_next.windows[endpoint]["remaining"] == 0
+
+    def reset_window(wait):
+        waits.append(wait)
+        rate_limiter_next.windows[endpoint]["reset"] = time.time()
+
+    rate_limiter_next._sleep = reset_window
+    rate_limiter_next.acquire(endpoint)
+    assert len(waits) == 1
+    assert 0 < waits[0] <= 61
+    assert rate_limiter_next.windows[endpoint]["remaining"] == 1
+
+
+def test_pacer():
+    """
+    Check that posts go as fast as the budget of the instance allows, are
+    spread until the reset once it runs low and wait for the reset once
+    it's exhausted
+    """
+    waits = []
+    # Unknown budget, the default delay is kept between posts
+    pacer = Pacer(sleep=waits.append)
+    pacer.wait("statuses")
+    pacer.wait("statuses")
+    assert len(waits) == 1
+    assert 0 < waits[0] <= 0.5
+    # Plenty of budget, the floor is the only delay
+    waits.clear()
+    pacer = Pacer(floor=0, sleep=waits.append)
+    reset = datetime.utcnow() + timedelta(seconds=100)
+    headers = {
+        "X-RateLimit-Limit": "300",
+        "X-RateLimit-Remaining": "200",
+        "X-RateLimit-Reset": reset.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+    }
+    assert pacer.update("statuses", headers)
+    assert 99 < pacer.windows["statuses"]["reset"] - time.time() <= 100
+    pacer.wait("statuses")
+    pacer.wait("statuses")
+    assert waits == []
+    # Low budget, the rest is spread until the reset
+    headers["X-RateLimit-Remaining"] = "10"
+    pacer.update("statuses", headers)
+    pacer.wait("statuses")
+    pacer.wait("statuses")
+    assert len(waits) == 1
+    assert 9 < waits[0] <= 10
+    # Nothing left, wait for the reset
+    waits.clear()
+    pacer = Pacer(floor=0, sleep=waits.append)
+    headers["X-RateLimit-Remaining"] = "0"
+    pacer.update("media", headers)
+    pacer.wait("media", use_floor=False)
+    assert len(waits) == 1
+    assert 99 < waits[0] <= 100
+
+
+def test_session_pool_rate_limited(global_mock):
+    waits = []
+    endpoint = "GET api.twitter.com/2/tweets/:id"
+    test_user = UserTemplate()
+    url = f"{test_user.twitter_base_url_v2}/tweets/{test_user.pinned}"
+    headers = {
+        "x-rate-limit-limit": "300",
+        "x-rate-limit-remaining": "0",
+        "x-rate-limit-reset": str(time.time() + 30),
+    }
+    with global_mock as mock:
+        mock.get(url, [
+            {"status_code": 429, "headers": headers},
+            {"status_code": 200, "json": {}},
+        ])
+        rate_limiter = RateLimiter()
+
+        def reset_window(wait):
+            waits.append(wait)
+            rate_limiter.windows[endpoint]["reset"] = time.time()
+
+        rate_limiter._sleep = reset_window
+        session_pool = SessionPool(rate_limiter=rate_limiter)
+        response = session_pool.get(url)
+        assert response.status_code == 200
+        assert len(waits) == 1
+        history = [req for req in mock.request_history if req.url == url]
+        assert len(history) == 2
+    return mock
+
+
+def test_session_pool_retries(global_mock):
+    """
+    Check that transient errors are retried with backoff when the request
+    can be sent again, honoring Retry-After
+    """
+    waits = []
+    test_user = UserTemplate()
+    url = f"{test_user.pleroma_base_url}/api/v1/retry_test"
+    with global_mock as mock:
+        session_pool = SessionPool(
+            retries=2, circuit_threshold=100, sleep=waits.append
+        )
+        mock.get(url, [
+            {"status_code": 503},
+            {"status_code": 502, "headers": {"Retry-After": "7"}},
+            {"status_code": 200, "json": {}},
+        ])
+        response = session_pool.get(url)
+        assert response.status_code == 200
+        assert len(waits) == 2
+        assert 0 <= waits[0] <= session_pool.backoff
+        assert waits[1] == 7
+        assert mock.last_request.timeout == (
+            session_pool.connect_timeout, session_pool.read_timeout
+        )
+        media_url = f"{test_user.pleroma_base_url}/api/v1/media"
+        assert session_pool.timeout(media_url)[1] > session_pool.read_timeout
+
+        # Give up after the retries
+        waits.clear()
+        mock.get(url, status_code=504)
+        assert session_pool.get(url).status_code == 504
+        assert len(waits) == 2
+
+        # Requests which can't be sent again safely aren't retried
+        waits.clear()
+        mock.post(url, status_code=503)
+        assert session_pool.post(url, {"status": "a"}).status_code == 503
+        assert len(waits) == 0
+        response = session_pool.post(
+            url, {"status": "a"}, headers={"Idempotency-Key": "1"}
+        )
+        assert response.status_code == 503
+        assert len(waits) == 2
+
+        # Connection errors too
+        waits.clear()
+        mock.get(url, exc=requests.exceptions.ConnectTimeout)
+        try:
+            session_pool.get(url)
+            assert False
+        except requests.exceptions.ConnectTimeout:
+            pass
+        assert len(waits) == 2
+        session_pool.close()
+    return mock
+
+
+def test_session_pool_circuit_breaker(global_mock):
+    """
+    Check that a host failing over and over fails fast until the cooldown
+    is over, and recovers once a request goes through
+    """
+    waits = []
+    test_user = UserTemplate()
+    url = f"{test_user.pleroma_base_url}/api/v1/circuit_test"
+    with global_mock as mock:
+        session_pool = SessionPool(
+            retries=0,
+            circuit_threshold=2,
+            circuit_cooldown=60,
+            sleep=waits.append,
+        )
+        mock.get(url, exc=requests.exceptions.ConnectionError)
+        for _attempt in range(2):
+            try:
+                session_pool.get(url)
+                assert False
+            except CircuitOpen:
+                assert False
+            except requests.exceptions.ConnectionError:
+                pass
+        calls = len(mock.request_history)
+        try:
+            session_pool.get(url)
+            assert False
+        except CircuitOpen:
+            pass
+        assert len(mock.request_history) == calls
+        # Other hosts aren't affected
+        assert session_pool.breaker(test_user.twitter_base_url_v2).allow()
+
+        # A request probes the host after the cooldown
+        breaker = session_pool.breaker(url)
+        breaker.opened_at -= 60
+        mock.get(url, status_code=200, json={})
+        assert session_pool.get(url).status_code == 200
+        assert breaker.opened_at is None
+        assert breaker.failures == 0
+        session_pool.close()
+    return mock
+
+
+def test_user_shared_session_pool(global_mock):
+    """
+    Check that users created with the same SessionPool and DownloadPool
+    share them
+    """
+    with global_mock:
+        config_users = get_config_users('config.yml')
+        session_pool = SessionPool.from_config(config_users['config'])
+        download_pool = DownloadPool(session_pool)
+        users = []
+        for user_item in config_users['user_dict']:
+            users.append(
+                User(
+                    user_item,
+                    config_users['config'],
+                    os.getcwd(),
+                    session_pool,
+                    download_pool=download_pool,
+                )
+            )
+        for user in users:
+            assert user.session_pool is session_pool
+            assert user.download_pool is download_pool
+            user.ledger.close()
+
+
+def test_user_tweets_temp_path(global_mock):
+    """
+    Check that entries mirroring the same Twitter account to different
+    Fediverse accounts don't share their temporary files
+    """
+    with global_mock:
+        config_users = get_config_users('config.yml')
+        user_item = config_users['user_dict'][0]
+        other_item = dict(user_item, pleroma_username="other")
+        users = [
+            User(item, config_users['config'], os.getcwd())
+            for item in (user_item, other_item)
+        ]
+        assert users[0].user_path == users[1].user_path
+        assert users[0].tweets_temp_path != users[1].tweets_temp_path
+        # Nor the fingerprint of the profile they were sent last
+        assert (
+            users[0].profile_fingerprint_path
+            != users[1].profile_fingerprint_path
+        )
+        for user in users:
+            assert os.path.isdir(user.tweets_temp_path)
+            user.ledger.close()
+        shutil.rmtree(users[1].tweets_temp_path)
+
+
 def test_user_replace_vars_in_str(sample_users):
     """
     Check that replace_vars_in_str replaces the var_name with the var_value
@@ -127,7 +444,8 @@ def test_check_pinned_tweet(sample_users, mock_request):
                      f"?poll.fields=duration_minutes%2Cend_datetime%2Cid%2C"
                      f"options%2Cvoting_status&media.fields=duration_ms%2C"
                      f"height%2Cmedia_key%2Cpreview_image_url%2Ctype%2Curl%2C"
-                     f"width%2Cpublic_metrics&expansions=attachments.poll_ids"
+                     f"width%2Cpublic_metrics%2Cvariants&expansions="
+                     f"attachments.poll_ids"
                      f"%2Cattachments.media_keys%2Cauthor_id%2C"
                      f"entities.mentions.username%2Cgeo.place_id%2C"
                      f"in_reply_to_user_id%2Creferenced_tweets.id%2C"
@@ -178,7 +496,8 @@ def test_check_pinned_tweet(sample_users, mock_request):
                      f"?poll.fields=duration_minutes%2Cend_datetime%2Cid%2C"
                      f"options%2Cvoting_status&media.fields=duration_ms%2C"
                      f"height%2Cmedia_key%2Cpreview_image_url%2Ctype%2Curl%2C"
-                     f"width%2Cpublic_metrics&expansions=attachments.poll_ids"
+                     f"width%2Cpublic_metrics%2Cvariants&expansions="
+                     f"attachments.poll_ids"
                      f"%2Cattachments.media_keys%2Cauthor_id%2C"
                      f"entities.mentions.username%2Cgeo.place_id%2C"
                      f"in_reply_to_user_id%2Creferenced_tweets.id%2C"
@@ -242,7 +561,8 @@ def test_check_pinned_tweet(sample_users, mock_request):
                      f"?poll.fields=duration_minutes%2Cend_datetime%2Cid%2C"
                      f"options%2Cvoting_status&media.fields=duration_ms%2C"
                      f"height%2Cmedia_key%2Cpreview_image_url%2Ctype%2Curl%2C"
-                     f"width%2Cpublic_metrics&expansions=attachments.poll_ids"
+                     f"width%2Cpublic_metrics%2Cvariants&expansions="
+                     f"attachments.poll_ids"
                      f"%2Cattachments.media_keys%2Cauthor_id%2C"
                      f"entities.mentions.username%2Cgeo.place_id%2C"
                      f"in_reply_to_user_id%2Creferenced_tweets.id%2C"
@@ -378,6 +698,43 @@ def test_update_pleroma(sample_users, rootdir):
     return mock
 
 
+def test_update_pleroma_unchanged(sample_users):
+    """
+    Check that update_pleroma only sends what changed since the last update
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            cred_url = (
+                f"{sample_user_obj.pleroma_base_url}/api/v1/accounts/"
+                f"update_credentials"
+            )
+            fingerprint = sample_user_obj.profile_fingerprint_path
+            if os.path.isfile(fingerprint):
+                os.remove(fingerprint)
+            sample_user_obj.update_pleroma()
+            assert os.path.isfile(fingerprint)
+            assert mock.request_history[-1].url == cred_url
+            request_count = len(mock.request_history)
+
+            # Nothing changed: no downloads and no update
+            sample_user_obj.update_pleroma()
+            assert len(mock.request_history) == request_count
+
+            # Only the bio changed: no downloads and only the note is sent
+            sample_user_obj.bio_text = f"{sample_user_obj.bio_text} new"
+            sample_user_obj.update_pleroma()
+            assert len(mock.request_history) == request_count + 1
+            last_request = mock.request_history[-1]
+            assert last_request.url == cred_url
+            body = last_request.body
+            if isinstance(body, bytes):
+                body = body.decode()
+            body = urllib.parse.parse_qs(body)
+            assert list(body.keys()) == ["note"]
+    return mock
+
+
 def test_post_pleroma_media(rootdir, sample_users, mock_request):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -432,6 +789,207 @@ def test_post_pleroma_media(rootdir, sample_users, mock_request):
                     os.remove(os.path.join(tweet_folder, media_file))
 
 
+def test_post_pleroma_stream_media(rootdir, sample_users, mock_request):
+    """
+    Check that attachments are streamed from Twitter to the instance without
+    being written to disk, and downloaded to disk only to retry an upload
+    """
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.media_upload = True
+            sample_user_obj.stream_media = True
+            media_url = f"{sample_user_obj.pleroma_base_url}/api/v1/media"
+            media_id = mock_request['sample_data']['pleroma_post_media']['id']
+            png_url = "https://pbs.twimg.com/media/ElxpP0hXEAI9X-H.jpg"
+            tweet_folder = os.path.join(
+                sample_user_obj.tweets_temp_path, test_user.pinned
+            )
+            os.makedirs(tweet_folder, exist_ok=True)
+            uploads = []
+
+            def upload(request, context):
+                uploads.append(b"".join(request.body))
+                context.status_code = 200
+                return mock_request['sample_data']['pleroma_post_media']
+
+            mock.post(media_url, json=upload)
+            tweet = {"id": test_user.pinned}
+            media = [{"url": png_url, "type": "photo"}]
+            sample_user_obj._stream_tweets_media([(media, tweet)])
+            sample_user_obj.post_pleroma(
+                (test_user.pinned, ""), None, False
+            )
+            assert os.listdir(tweet_folder) == []
+            assert len(uploads) == 1
+            png = os.path.join(
+                rootdir, 'test_files', 'sample_data', 'media', 'image.png'
+            )
+            with open(png, 'rb') as png_file:
+                assert png_file.read() in uploads[0]
+            assert b"Content-Type: image/png" in uploads[0]
+            history = mock.request_history
+            dict_history = urllib.parse.parse_qs(history[-1].text)
+            assert dict_history['media_ids[]'] == [media_id]
+
+            # The upload is retried from disk if streaming it fails
+            responses = [
+                {"status_code": 503},
+                {
+                    "status_code": 200,
+                    "json": mock_request['sample_data']['pleroma_post_media'],
+                },
+            ]
+            mock.post(media_url, responses)
+            sample_user_obj._stream_tweets_media([(media, tweet)])
+            sample_user_obj.post_pleroma(
+                (test_user.pinned, ""), None, False
+            )
+            history = mock.request_history
+            assert [req.url for req in history[-5:]] == [
+                png_url, media_url, png_url, media_url,
+                f"{sample_user_obj.pleroma_base_url}/api/v1/statuses",
+            ]
+            dict_history = urllib.parse.parse_qs(history[-1].text)
+            assert dict_history['media_ids[]'] == [media_id]
+            assert os.listdir(tweet_folder) == []
+
+
+def test_pipeline():
+    """
+    Check that the stages of a pipeline overlap, keep the order of the items
+    and raise errors once the items before them are consumed
+    """
+    started = []
+
+    def double(item):
+        started.append(item)
+        yield item * 2
+
+    def split(item):
+        if item == 6:
+            raise ValueError(item)
+        yield item
+        yield item + 1
+
+    pipeline = Pipeline(iter(range(10)), [double, split], maxsize=1)
+    outputs = []
+    try:
+        for output in pipeline:
+            outputs.append(output)
+            if output == 0:
+                # Later items go through the first stage meanwhile
+                for _ in range(50):
+                    if len(started) > 1:
+                        break
+                    time.sleep(0.01)
+                assert len(started) > 1
+    except ValueError as e:
+        assert str(e) == "6"
+    assert outputs == [0, 1, 2, 3, 4, 5]
+    # The queues are bounded, so the source isn't read ahead indefinitely
+    assert len(started) < 10
+
+    outputs = list(Pipeline(iter(range(3)), [double]))
+    assert outputs == [0, 2, 4]
+
+
+def test_post_pipeline(sample_users, mock_request, tmp_path):
+    """
+    Check that the pipeline yields the tweets of each page ready to be posted
+    and in order, followed by the end of the page
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.ledger = Ledger(str(tmp_path / "ledger.db"))
+            tweets_v2 = Timeline(mock_request['sample_data']['tweets_v2'])
+            expected = [tweet["id"] for tweet in reversed(tweets_v2["data"])]
+            items = list(sample_user_obj.post_pipeline([tweets_v2]))
+            assert items[-1] == ("page", tweets_v2["meta"])
+            tweets = items[:-1]
+            assert [item[1]["id"] for item in tweets] == expected
+            for _kind, tweet, tweet_count, upload in tweets:
+                assert tweet_count == len(expected)
+                assert isinstance(upload.result(), list)
+                if sample_user_obj.media_upload:
+                    tweet_folder = os.path.join(
+                        sample_user_obj.tweets_temp_path, tweet["id"]
+                    )
+                    for file in os.listdir(tweet_folder):
+                        os.remove(os.path.join(tweet_folder, file))
+            assert sample_user_obj.pending_media == {}
+            sample_user_obj.ledger.close()
+            os.remove(str(tmp_path / "ledger.db"))
+    return mock
+
+
+def test_ledger(sample_users, mock_request, tmp_path):
+    """
+    Check that posted tweets are recorded in the ledger with an idempotency
+    key, and skipped by the following runs
+    """
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            ledger_path = str(tmp_path / "ledger.db")
+            sample_user_obj.ledger = Ledger(ledger_path)
+            account = sample_user_obj.ledger_account
+            assert sample_user_obj.ledger.get(account, "1") is None
+            tweet_folder = os.path.join(
+                sample_user_obj.tweets_temp_path, test_user.pinned
+            )
+            os.makedirs(tweet_folder, exist_ok=True)
+            post_id = sample_user_obj.post_pleroma(
+                (test_user.pinned, ""), None, False
+            )
+            headers = mock.request_history[-1].headers
+            key = hashlib.sha256(
+                f"{account}/{test_user.pinned}".encode()
+            ).hexdigest()
+            assert headers["Idempotency-Key"] == f"pleroma-bot-{key}"
+            # Another process of the next run finds it
+            ledger = Ledger(ledger_path)
+            assert ledger.get(account, test_user.pinned) == post_id
+            assert ledger.get("https://other/bot", test_user.pinned) is None
+            ledger.close()
+            # The same tweet posted to another account gets another key
+            ledger_account = sample_user_obj.ledger_account
+            sample_user_obj.ledger_account = "https://other/bot"
+            sample_user_obj.post_pleroma(
+                (test_user.pinned, ""), None, False
+            )
+            other_headers = mock.request_history[-1].headers
+            assert other_headers["Idempotency-Key"] != (
+                headers["Idempotency-Key"]
+            )
+            sample_user_obj.ledger_account = ledger_account
+
+            tweets_v2 = Timeline(mock_request['sample_data']['tweets_v2'])
+            posted = tweets_v2["data"][0]["id"]
+            sample_user_obj.ledger.add(account, posted, post_id)
+            items = list(sample_user_obj.post_pipeline([tweets_v2]))
+            tweet_ids = [item[1]["id"] for item in items[:-1]]
+            assert posted not in tweet_ids
+            assert len(tweet_ids) == len(tweets_v2["data"])
+            for tweet_id in tweet_ids:
+                tweet_folder = os.path.join(
+                    sample_user_obj.tweets_temp_path, tweet_id
+                )
+                for file in os.listdir(tweet_folder):
+                    os.remove(os.path.join(tweet_folder, file))
+            sample_user_obj.ledger.close()
+            with sqlite3.connect(ledger_path) as connection:
+                journal_mode = connection.execute(
+                    "PRAGMA journal_mode"
+                ).fetchone()[0]
+            assert journal_mode == "wal"
+            os.remove(ledger_path)
+    return mock
+
+
 def test_get_tweets(sample_users, mock_request):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -469,6 +1027,330 @@ def test_get_tweets_next_token(sample_users, mock_request):
     return mock
 
 
+def test_spool_tweets(sample_users, mock_request):
+    """
+    Check that pages are followed iteratively, written to disk as they
+    arrive and read back oldest page first
+    """
+    test_user = UserTemplate()
+    sample_data = mock_request['sample_data']
+    pages = [
+        dict(sample_data['tweets_v2_next_token'], meta={'next_token': 'A'}),
+        dict(sample_data['tweets_v2_next_token'], meta={'next_token': 'B'}),
+        sample_data['tweets_v2'],
+    ]
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
+                     f"/tweets",
+                     [{'json': page, 'status_code': 200} for page in pages])
+            page_paths = sample_user_obj.spool_tweets(None)
+            assert len(page_paths) == 3
+            assert all(os.path.isfile(path) for path in page_paths)
+            tokens = [
+                parse.parse_qs(req.query).get('pagination_token')
+                for req in mock.request_history[-3:]
+            ]
+            assert tokens == [None, ['a'], ['b']]
+
+            spooled = list(sample_user_obj.iter_spooled_tweets(page_paths))
+            assert spooled == list(reversed(pages))
+            assert not any(os.path.isfile(path) for path in page_paths)
+    return mock
+
+
+def test_timeline(mock_request):
+    """
+    Check that includes are indexed and deduplicated when merging pages
+    """
+    page = mock_request['sample_data']['tweets_v2']
+    includes_len = {
+        include: len(objects) for include, objects in page['includes'].items()
+    }
+    timeline = Timeline(page)
+    assert timeline == page
+    media = page['includes']['media'][0]
+    assert timeline.get_media(media['media_key']) is media
+    user = page['includes']['users'][0]
+    assert timeline.get_user(user['id']) is user
+    assert timeline.get_media("nonexistent") is None
+
+    timeline.merge(page)
+    assert len(timeline['data']) == 2 * len(page['data'])
+    for include, objects in page['includes'].items():
+        assert len(timeline['includes'][include]) == includes_len[include]
+    # The original response is left untouched
+    assert len(page['data']) == len(timeline['data']) // 2
+
+    pinned = mock_request['sample_data']['pinned_tweet']
+    timeline.merge(pinned)
+    assert timeline['data'][-1] == pinned['data']
+    assert timeline['meta'] == page['meta']
+
+
+def test_last_tweet_id_cursor(global_mock, sample_users, mock_request):
+    """
+    Check that once the last mirrored tweet is known, tweets are retrieved
+    with since_id and the Fediverse account isn't asked for its last post
+    """
+    tweets_v2 = mock_request['sample_data']['tweets_v2']
+    newest_id = max(
+        [tweets_v2['meta']['newest_id']]
+        + [tweet['id'] for tweet in tweets_v2['data']],
+        key=int
+    )
+    config_users = get_config_users('config.yml')
+    user_item = cli.expand_users(config_users['user_dict'])[0]
+    args = cli.get_args(['--noProfile'])
+    with global_mock as mock:
+        session_pool = SessionPool.from_config(config_users['config'])
+        user_obj = User(
+            user_item, config_users['config'], os.getcwd(), session_pool
+        )
+        user_obj._save_last_tweet_id("1323048139251658753")
+        # The cursor never goes back
+        user_obj._save_last_tweet_id("1")
+        assert user_obj._get_last_tweet_id() == "1323048139251658753"
+        # Other Fediverse accounts mirroring the same Twitter account keep
+        # their own cursor
+        other_obj = User(
+            dict(user_item, pleroma_username="other"),
+            config_users['config'],
+            os.getcwd(),
+            session_pool
+        )
+        assert other_obj.last_tweet_id_path != user_obj.last_tweet_id_path
+        assert other_obj._get_last_tweet_id() is None
+        other_obj.ledger.close()
+        shutil.rmtree(other_obj.tweets_temp_path)
+
+        history_len = len(mock.request_history)
+        with patch.object(User, 'get_date_last_pleroma_post') as last_post:
+            cli.process_user(
+                user_item,
+                config_users['config'],
+                os.getcwd(),
+                args,
+                session_pool
+            )
+            last_post.assert_not_called()
+        requests_made = mock.request_history[history_len:]
+        timeline = [
+            req for req in requests_made if req.path.endswith("/tweets")
+        ]
+        assert parse.parse_qs(timeline[0].query)['since_id'] == [
+            "1323048139251658753"
+        ]
+        assert 'start_time' not in parse.parse_qs(timeline[0].query)
+        assert user_obj._get_last_tweet_id() == newest_id
+        os.remove(user_obj.last_tweet_id_path)
+    _clean_pinned(sample_users)
+    return mock
+
+
+def test_get_twitter_id_cache(sample_users, mock_request):
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            lookup_url = (
+                f"{test_user.twitter_base_url_v2}/users/by?"
+                f"usernames={sample_user_obj.twitter_username}"
+            )
+            sample_user_obj.twitter_id = None
+            if os.path.isfile(sample_user_obj.twitter_id_path):
+                os.remove(sample_user_obj.twitter_id_path)
+
+            def lookups():
+                return len([
+                    req for req in mock.request_history
+                    if req.url == lookup_url
+                ])
+
+            # Paginated fetch only resolves the ID once
+            mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
+                     f"/tweets",
+                     json=mock_request['sample_data']['tweets_v2_next_token'],
+                     status_code=200)
+            sample_user_obj._get_tweets("v2")
+            assert lookups() == 1
+            assert os.path.isfile(sample_user_obj.twitter_id_path)
+
+            # Persisted for the next runs
+            sample_user_obj.twitter_id = None
+            assert sample_user_obj._get_twitter_id() == "2244994945"
+            assert lookups() == 1
+
+            # Expired
+            sample_user_obj.twitter_id = None
+            sample_user_obj.twitter_id_ttl = 0
+            assert sample_user_obj._get_twitter_id() == "2244994945"
+            assert lookups() == 2
+            sample_user_obj.twitter_id_ttl = 3600
+
+            # Stale ID is resolved again
+            sample_user_obj.twitter_id = "1234"
+            mock.get(f"{test_user.twitter_base_url_v2}/users/1234/tweets",
+                     status_code=404)
+            mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
+                     f"/tweets",
+                     json=mock_request['sample_data']['tweets_v2'],
+                     status_code=200)
+            tweets = sample_user_obj._get_tweets("v2")
+            assert tweets == mock_request['sample_data']['tweets_v2']
+            assert sample_user_obj.twitter_id == "2244994945"
+            assert lookups() == 3
+    return mock
+
+
+def test_user_lookup(global_mock, mock_request):
+    """
+    Check that users are looked up in batches at startup and that creating
+    them doesn't need any other request to Twitter or the instance
+    """
+    test_user = UserTemplate()
+    config_users = get_config_users('config.yml')
+    user_dict = cli.expand_users(config_users['user_dict'])
+    config = config_users['config']
+    session_pool = SessionPool.from_config(config)
+    with global_mock as mock:
+        lookup = UserLookup.resolve(user_dict, config, session_pool)
+        batched = [
+            req for req in mock.request_history
+            if req.path.endswith(("/users/lookup.json", "/users/by"))
+        ]
+        assert len(batched) == 2
+        # Users with their own OAuth 1.0a tokens are looked up on their own
+        assert "hackernews" not in lookup.twitter_users
+        kyle = lookup.get_twitter_user("KyleBosman")
+        assert kyle["id"] == "2244994945"
+        assert kyle["pinned_tweet_id"] == test_user.pinned
+        assert lookup.get_instance(config['pleroma_base_url'])
+
+        for user_item in user_dict:
+            if user_item['twitter_username'] == "HackerNews":
+                continue
+            history_len = len(mock.request_history)
+            user_obj = User(
+                user_item, config, os.getcwd(), session_pool, lookup
+            )
+            assert len(mock.request_history) == history_len
+            assert user_obj.pinned_tweet_id == test_user.pinned
+            assert user_obj.twitter_id == "2244994945"
+            assert user_obj.display_name == "test-pleroma-bot"
+
+        # Failed batches fall back to looking up each user
+        mock.get(f"{test_user.twitter_base_url}/users/lookup.json",
+                 status_code=500)
+        lookup = UserLookup.resolve(user_dict, config, session_pool)
+        assert lookup.twitter_users == {}
+        user_obj = User(
+            user_dict[0], config, os.getcwd(), session_pool, lookup
+        )
+        assert user_obj.display_name == "test-pleroma-bot"
+        assert any(
+            req.path.endswith("/users/show.json")
+            for req in mock.request_history
+        )
+
+
+def test_expand_urls(sample_users):
+    """
+    Check that URLs are spliced in at the entity offsets, looking for them
+    when the offsets don't match the text
+    """
+    text = "\U0001F916 a https://t.co/a?b+c and https://t.co/d"
+    tweet = {
+        "text": text,
+        "entities": {
+            "urls": [
+                {
+                    "start": text.index("https://t.co/d"),
+                    "end": text.index("https://t.co/d") + 14,
+                    "url": "https://t.co/d",
+                    "expanded_url": "https://example.com/d",
+                },
+                # Offsets off by one
+                {
+                    "start": 3,
+                    "end": 22,
+                    "url": "https://t.co/a?b+c",
+                    "expanded_url": "https://example.com/?a=1",
+                },
+            ]
+        },
+    }
+    for sample_user in sample_users:
+        sample_user_obj = sample_user['user_obj']
+        assert sample_user_obj._expand_urls(tweet) == (
+            "\U0001F916 a https://example.com/?a=1 and https://example.com/d"
+        )
+
+
+def test_url_resolver(global_mock, tmp_path):
+    """
+    Check that links are resolved once, shared through the cache on disk
+    and evicted when expired or least recently used
+    """
+    short_urls = [f"https://cutt.ly/{idx}" for idx in range(4)]
+    cache_path = str(tmp_path / "url_cache.json")
+    with global_mock as mock:
+        for idx, short_url in enumerate(short_urls):
+            mock.head(short_url, status_code=301,
+                      headers={'Location': f'http://github.com/{idx}'})
+            mock.head(f'http://github.com/{idx}', status_code=200)
+        mock.head("https://cutt.ly/broken", status_code=404)
+        session_pool = SessionPool()
+        resolver = UrlResolver(session_pool, cache_path, cache_size=3)
+
+        def heads():
+            return len([
+                req for req in mock.request_history
+                if req.method == "HEAD" and "cutt.ly" in req.url
+            ])
+
+        resolved = resolver.resolve_all(
+            short_urls + ["https://cutt.ly/broken"]
+        )
+        assert resolved["https://cutt.ly/0"] == "http://github.com/0"
+        assert resolved["https://cutt.ly/broken"] is None
+        assert heads() == 5
+        # The links are resolved concurrently, so use them again one after
+        # the other to know which ones are the least recently used
+        assert resolver.resolve("https://cutt.ly/1") == "http://github.com/1"
+        assert resolver.resolve("https://cutt.ly/3") == "http://github.com/3"
+        assert resolver.resolve("https://cutt.ly/broken") is None
+        assert heads() == 5
+        resolver.save()
+        # Also evicted from the links kept in memory
+        assert len(resolver.cache) == 3
+        assert "https://cutt.ly/0" not in resolver.cache
+        assert "https://cutt.ly/2" not in resolver.cache
+
+        # Next run, only the 3 most recently used links were kept
+        resolver = UrlResolver(session_pool, cache_path)
+        assert len(resolver.cache) == 3
+        assert "https://cutt.ly/0" not in resolver.cache
+        assert resolver.resolve("https://cutt.ly/3") == "http://github.com/3"
+        assert heads() == 5
+
+        # Expired entries are resolved again
+        resolver = UrlResolver(session_pool, cache_path, ttl=-1)
+        resolver.cache = {}
+        resolver.resolve("https://cutt.ly/3")
+        assert heads() == 6
+        resolver.save()
+        assert "https://cutt.ly/3" not in resolver.cache
+        resolver = UrlResolver(session_pool, cache_path)
+        assert "https://cutt.ly/3" not in resolver.cache
+
+        # Without saving it, the cache never grows over twice its size
+        resolver = UrlResolver(session_pool, cache_size=1)
+        resolver.resolve_all(short_urls)
+        assert len(resolver.cache) <= 2
+
+
 def test_process_tweets(rootdir, sample_users, mock_request):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -756,6 +1638,309 @@ def test_nitter_instances(sample_users, mock_request, global_mock):
     return mock, sample_user
 
 
+def test_process_polls_includes(sample_users, mock_request):
+    """
+    Check that polls are taken from the includes and the missing ones are
+    retrieved with a single request
+    """
+    test_user = UserTemplate()
+    poll = mock_request['sample_data']['poll']
+    tweet = poll['data'][0]
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            poll_url = f"{test_user.twitter_base_url_v2}/tweets"
+            mock.get(poll_url, json=poll, status_code=200)
+
+            def poll_requests():
+                return [
+                    req for req in mock.request_history
+                    if req.url.startswith(f"{poll_url}?")
+                ]
+
+            polls_before = len(poll_requests())
+            tweets = Timeline({
+                "data": [dict(tweet)],
+                "includes": {"polls": poll['includes']['polls']},
+            })
+            sample_user_obj.process_tweets(tweets)
+            assert len(poll_requests()) == polls_before
+            assert len(tweets["data"][0]["polls"]["options"]) == 3
+
+            tweets = {
+                "data": [dict(tweet), dict(tweet, id="1323049466837032962")],
+                "includes": {},
+            }
+            sample_user_obj.process_tweets(tweets)
+            assert len(poll_requests()) == polls_before + 1
+            ids = parse.parse_qs(poll_requests()[-1].query)['ids']
+            assert ids == [f"{tweet['id']},1323049466837032962"]
+            for processed in tweets["data"]:
+                assert processed["polls"]["expires_in"] == 10080 * 60
+
+
+def test_get_videos(sample_users, mock_request):
+    """
+    Check that the variants of the videos in a page are retrieved with a
+    single request and cached by media_key
+    """
+    test_user = UserTemplate()
+    tweets_v2 = mock_request['sample_data']['tweets_v2']
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.media_upload = False
+            sample_user_obj.video_media = {}
+
+            def lookups(endpoint):
+                return [
+                    req for req in mock.request_history
+                    if req.url.startswith(
+                        f"{test_user.twitter_base_url}/statuses/{endpoint}"
+                    )
+                ]
+
+            shows = len(lookups("show.json"))
+            batches = len(lookups("lookup.json"))
+            sample_user_obj.process_tweets(Timeline(tweets_v2))
+            assert len(lookups("show.json")) == shows
+            assert len(lookups("lookup.json")) == batches + 1
+            ids = parse.parse_qs(lookups("lookup.json")[-1].query)['id']
+            assert ids == ["1323049214134407171,1323048312161947650"]
+            video = sample_user_obj.video_media["7_1323049175848833033"]
+            assert video[0]["id_str"] == "1323049175848833033"
+            gif = sample_user_obj.video_media["16_1323048298190721024"]
+            assert gif[0]["type"] == "animated_gif"
+
+            # Already resolved
+            sample_user_obj.process_tweets(Timeline(tweets_v2))
+            assert len(lookups("lookup.json")) == batches + 1
+
+            # Variants returned by the v2 API are used directly
+            media = {
+                "type": "video",
+                "media_key": "7_1",
+                "variants": [
+                    {"content_type": "application/x-mpegURL",
+                     "url": "https://video.twimg.com/1.m3u8"},
+                    {"bit_rate": 832000, "content_type": "video/mp4",
+                     "url": "https://video.twimg.com/1.mp4"},
+                ],
+            }
+            media_urls = sample_user_obj._get_media_url(
+                "7_1", media, {"id": "1"}
+            )
+            assert len(lookups("lookup.json")) == batches + 1
+            assert sample_user_obj._get_best_bitrate_video(
+                media_urls[0]
+            ) == "https://video.twimg.com/1.mp4"
+
+
+def test_download_media_pool(sample_users, tmp_path):
+    """
+    Check that attachments are downloaded concurrently keeping their names,
+    and that a missing one skips the rest of the attachments of its tweet
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.tweets_temp_path = str(tmp_path)
+            sample_user_obj.download_pool = DownloadPool.from_config(
+                {
+                    "download_workers": 3,
+                    "download_max_files": 2,
+                    "download_max_bytes": "1KB",
+                },
+                sample_user_obj.session_pool,
+            )
+            assert sample_user_obj.download_pool.max_bytes == 1024
+            assert sample_user_obj.download_pool.max_files == 2
+            tweets_media = []
+            for tweet_id in ("1", "2"):
+                os.makedirs(os.path.join(str(tmp_path), tweet_id))
+                media = []
+                for idx in range(3):
+                    url = f"https://mymock.media/{tweet_id}_{idx}.png"
+                    mock.get(
+                        url,
+                        content=bytes(600),
+                        headers={
+                            "Content-Type": "image/png",
+                            "Content-Length": "600",
+                        },
+                    )
+                    media.append({"url": url, "type": "photo"})
+                tweets_media.append((media, {"id": tweet_id}))
+            mock.get("https://mymock.media/2_1.png", status_code=404)
+
+            sample_user_obj._download_tweets_media(tweets_media)
+            assert sorted(os.listdir(tmp_path / "1")) == [
+                "0.png", "1.png", "2.png"
+            ]
+            assert os.listdir(tmp_path / "2") == ["0.png"]
+            assert os.stat(tmp_path / "1" / "2.png").st_size == 600
+            assert sample_user_obj.download_pool._bytes_in_flight == 0
+            for tweet_id in ("1", "2"):
+                shutil.rmtree(str(tmp_path / tweet_id))
+                os.makedirs(os.path.join(str(tmp_path), tweet_id))
+
+            # The downloads can run in an executor shared with other tweets
+            executor = ThreadPoolExecutor(max_workers=2)
+            with patch.object(
+                    executor, "submit", wraps=executor.submit
+            ) as submit:
+                sample_user_obj._download_tweets_media(
+                    tweets_media, executor
+                )
+            assert submit.call_count == 6
+            assert sorted(os.listdir(tmp_path / "1")) == [
+                "0.png", "1.png", "2.png"
+            ]
+            assert os.listdir(tmp_path / "2") == ["0.png"]
+            # And it's left running for them
+            assert executor.submit(lambda: 1).result() == 1
+            executor.shutdown()
+            shutil.rmtree(str(tmp_path / "1"))
+            shutil.rmtree(str(tmp_path / "2"))
+
+
+def test_download_media_size_limit(sample_users, tmp_path, caplog):
+    """
+    Check that attachments over the size limit are rejected before being
+    downloaded when their size is known, or aborted while streaming them
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.tweets_temp_path = str(tmp_path)
+            sample_user_obj.file_max_size = "1MB"
+            sample_user_obj.file_max_size_bytes = 2 ** 20
+            os.makedirs(os.path.join(str(tmp_path), "1"))
+            video_url = "https://mymock.media/video.mp4"
+            big_url = "https://mymock.media/big.png"
+            small_url = "https://mymock.media/small.png"
+            mock.get(
+                video_url,
+                content=bytes(100),
+                headers={"Content-Type": "video/mp4"},
+            )
+            mock.get(
+                big_url,
+                content=bytes(3 * 2 ** 19),
+                headers={"Content-Type": "image/png"},
+            )
+            mock.get(
+                small_url,
+                content=bytes(512),
+                headers={"Content-Type": "image/png"},
+            )
+            video = {
+                "type": "video",
+                "video_info": {
+                    "duration_millis": 2000,
+                    "variants": [{"bitrate": 2 ** 23, "url": video_url}],
+                },
+            }
+            media = [
+                video,
+                {"url": big_url, "type": "photo"},
+                {"url": small_url, "type": "photo"},
+            ]
+            with caplog.at_level(logging.ERROR):
+                sample_user_obj._download_media(media, {"id": "1"})
+            assert "File size: 2.0MB (estimated)" in caplog.text
+            assert "File size: over 1.0MB" in caplog.text
+            assert os.listdir(tmp_path / "1") == ["2.png"]
+            shutil.rmtree(str(tmp_path / "1"))
+
+
+def test_media_cache(sample_users, tmp_path):
+    """
+    Check that attachments in the media cache aren't downloaded again, that
+    the same content is stored once and that the least recently used
+    attachments are evicted once the cache goes over its size limit
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.tweets_temp_path = str(tmp_path / "tweets")
+            media_cache = MediaCache(str(tmp_path / "media_cache"), 2048)
+            sample_user_obj.media_cache = media_cache
+            urls = [f"https://mymock.media/{idx}.png" for idx in range(3)]
+            for idx, url in enumerate(urls):
+                mock.get(
+                    url,
+                    content=bytes([idx]) * 1000,
+                    headers={"Content-Type": "image/png"},
+                )
+            media = [
+                {"url": urls[0], "type": "photo", "media_key": "3_0"},
+                {"url": urls[0], "type": "photo", "media_key": "3_1"},
+            ]
+            tweet_folder = os.path.join(str(tmp_path / "tweets"), "1")
+            os.makedirs(tweet_folder)
+            sample_user_obj._download_media(media, {"id": "1"})
+            assert sorted(os.listdir(tweet_folder)) == ["0.png", "1.png"]
+            assert len(os.listdir(media_cache.objects_path)) == 1
+            shutil.rmtree(tweet_folder)
+
+            # Another user finds them in the cache
+            os.makedirs(tweet_folder)
+            downloads = len(mock.request_history)
+            sample_user_obj._download_media(media, {"id": "1"})
+            assert len(mock.request_history) == downloads
+            with open(os.path.join(tweet_folder, "1.png"), "rb") as file:
+                assert file.read() == bytes([0]) * 1000
+            shutil.rmtree(tweet_folder)
+
+            # The least recently used attachment is evicted
+            os.makedirs(tweet_folder)
+            for object_name in os.listdir(media_cache.objects_path):
+                object_path = os.path.join(
+                    media_cache.objects_path, object_name
+                )
+                os.utime(object_path, (0, 0))
+            for idx in (1, 2):
+                sample_user_obj._download_media(
+                    [{"url": urls[idx], "type": "photo"}], {"id": "1"}
+                )
+                os.remove(os.path.join(tweet_folder, "0.png"))
+            assert len(os.listdir(media_cache.objects_path)) == 2
+            assert media_cache.get("3_0", str(tmp_path / "0")) is None
+            file_path = media_cache.get(urls[2], str(tmp_path / "2"))
+            assert file_path == str(tmp_path / "2.png")
+            # A file left behind by a crashed run doesn't turn into a miss
+            assert media_cache.get(urls[2], str(tmp_path / "2")) == file_path
+            # and downloads over it, aborted halfway or not, don't touch the
+            # cached copy
+            mock.get(
+                urls[2],
+                content=bytes([3]) * 1000,
+                headers={"Content-Type": "image/png"},
+            )
+            try:
+                sample_user_obj.download_pool.download(
+                    urls[2], str(tmp_path / "2"), max_size=500
+                )
+                assert False
+            except AttachmentTooLarge:
+                pass
+            sample_user_obj.download_pool.download(
+                urls[2], str(tmp_path / "2")
+            )
+            os.remove(file_path)
+            file_path = media_cache.get(urls[2], str(tmp_path / "2"))
+            with open(file_path, "rb") as file:
+                assert file.read() == bytes([2]) * 1000
+            assert not [
+                name for name in os.listdir(str(tmp_path))
+                if name.endswith(".part")
+            ]
+            os.remove(file_path)
+            shutil.rmtree(str(tmp_path / "tweets"))
+            shutil.rmtree(media_cache.path)
+
+
 def test__process_polls_with_media(sample_users):
     for sample_user in sample_users:
         with sample_user['mock'] as mock:
@@ -873,3 +2058,414 @@ def test_main(rootdir, global_mock, sample_users, monkeypatch):
             if os.path.isfile(pinned_pleroma):
                 os.remove(pinned_pleroma)
     return g_mock
+
+
+def test_main_async(rootdir, global_mock, sample_users, monkeypatch):
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = os.path.join(test_files_dir, 'config_multiple_users.yml')
+        monkeypatch.setattr('builtins.input', lambda: "2020-12-30")
+        with patch.object(
+                sys, 'argv', ['', '--config', config_test, '--async']
+        ):
+            assert cli.main() == 0
+        history = g_mock.request_history
+        post_url = f"{sample_users[0]['config']['pleroma_base_url']}" \
+                   f"/api/v1/statuses"
+        assert post_url in [request.url for request in history]
+
+        # A failing user doesn't stop the rest, but is reported
+        g_mock.get(f"{UserTemplate().twitter_base_url_v2}/users/2244994945"
+                   f"/tweets",
+                   json={},
+                   status_code=200)
+        with patch.object(
+                sys, 'argv', ['', '--config', config_test, '--async']
+        ):
+            assert cli.main() == 1
+        # Same without --async
+        with patch.object(cli, "process_user") as mock_process_user:
+            mock_process_user.side_effect = ValueError("failed")
+            with patch.object(sys, 'argv', ['', '--config', config_test]):
+                assert cli.main() == 1
+            assert mock_process_user.call_count > 1
+        _clean_pinned(sample_users)
+    return g_mock
+
+
+def test_get_concurrency():
+    args = cli.get_args(sysargs=[])
+    assert cli.get_concurrency(args, {}) == 1
+    assert cli.get_concurrency(args, {"concurrency": 3}) == 3
+    args = cli.get_args(sysargs=["--async"])
+    assert cli.get_concurrency(args, {}) == cli.DEFAULT_CONCURRENCY
+    assert cli.get_concurrency(args, {"concurrency": 8}) == 8
+
+
+def test_scheduler():
+    scheduler = Scheduler()
+    assert scheduler.next_due() is None
+    scheduler.schedule("b", 20)
+    scheduler.schedule("a", 10)
+    scheduler.schedule("c", 20)
+    scheduler.schedule("d", 30)
+    assert len(scheduler) == 4
+    assert scheduler.next_due() == 10
+    assert scheduler.pop_due(5) == []
+    # Users due at the same time keep the order they were scheduled in
+    assert scheduler.pop_due(25) == ["a", "b", "c"]
+    assert scheduler.next_due() == 30
+    assert len(scheduler) == 1
+
+
+def test_run_daemon(global_mock, monkeypatch):
+    with global_mock as g_mock:
+        config_users = get_config_users('config.yml')
+        config = dict(config_users['config'])
+        config["poll_interval"] = 0.01
+        user_dict = cli.expand_users(config_users['user_dict'])
+        user_dict[0]["poll_interval"] = 3600
+        args = cli.get_args(sysargs=["--daemon", "--forceDate"])
+        stop = threading.Event()
+        processed = []
+
+        def run_user(user_item, config, base_path, args, *fargs):
+            processed.append((user_item["twitter_username"], args.forceDate))
+            if len(processed) == len(user_dict) + 2:
+                stop.set()
+            return {
+                "pleroma_username": user_item["pleroma_username"],
+                "twitter_username": user_item["twitter_username"],
+                "ok": True,
+                "error": None,
+            }
+
+        def lookups(start):
+            requests_made = g_mock.request_history[start:]
+            return (
+                len([
+                    req for req in requests_made
+                    if req.path.endswith("/users/by")
+                ]),
+                len([
+                    req for req in requests_made
+                    if req.path.endswith("/api/v1/instance")
+                ]),
+            )
+
+        history_len = len(g_mock.request_history)
+        with patch.object(cli, "run_user", side_effect=run_user):
+            cli.run_daemon(
+                user_dict,
+                config,
+                os.getcwd(),
+                args,
+                SessionPool.from_config(config),
+                1,
+                stop=stop,
+            )
+        # Users and instances are looked up once for the whole daemon, not
+        # on every poll
+        assert lookups(history_len) == (1, 1)
+        first_run = processed[:len(user_dict)]
+        assert [user for user, _date in first_run] == [
+            user_item["twitter_username"] for user_item in user_dict
+        ]
+        assert all(date == "all" for _user, date in first_run)
+        # The first user isn't due again yet, the rest are right away
+        for user, date in processed[len(user_dict):]:
+            assert user != user_dict[0]["twitter_username"]
+            assert date is None
+
+        # Profiles and pinned tweets are looked up again every
+        # profile_interval, the instances never
+        config["profile_interval"] = 0.001
+        processed.clear()
+        stop.clear()
+        history_len = len(g_mock.request_history)
+        with patch.object(cli, "run_user", side_effect=run_user):
+            cli.run_daemon(
+                user_dict,
+                config,
+                os.getcwd(),
+                args,
+                SessionPool.from_config(config),
+                1,
+                stop=stop,
+            )
+        profile_lookups, instance_lookups = lookups(history_len)
+        assert profile_lookups > 1
+        assert instance_lookups == 1
+        config["profile_interval"] = 0
+        try:
+            cli.run_daemon(
+                user_dict, config, os.getcwd(), args,
+                SessionPool.from_config(config), 1, stop=threading.Event()
+            )
+            assert False
+        except ValueError as e:
+            assert "profile_interval" in str(e)
+        del config["profile_interval"]
+
+        # An interval of 0 would keep polling the user without a break
+        for poll_interval in (0, -1):
+            user_dict[0]["poll_interval"] = poll_interval
+            try:
+                cli.run_daemon(
+                    user_dict, config, os.getcwd(), args,
+                    SessionPool.from_config(config), 1,
+                    stop=threading.Event()
+                )
+                assert False
+            except ValueError as e:
+                assert "poll_interval" in str(e)
+    return g_mock
+
+
+def test_main_daemon_sigterm(rootdir, global_mock, monkeypatch, tmp_path):
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = str(tmp_path / "config.yml")
+        shutil.copy(
+            os.path.join(test_files_dir, 'config_multiple_users.yml'),
+            config_test
+        )
+        processed = []
+
+        # Run by systemd or Docker there's no terminal to ask the first run
+        # dates, so it fails before processing any user
+        def no_input():
+            raise EOFError("EOF when reading a line")
+
+        monkeypatch.setattr('builtins.input', no_input)
+        with patch.object(
+                sys, 'argv', ['', '--config', config_test, '--daemon']
+        ):
+            assert cli.main() == 1
+        assert not (tmp_path / "users").exists()
+        monkeypatch.setattr('builtins.input', lambda: "2020-12-30")
+
+        def run_user(user_item, *fargs):
+            processed.append(user_item["twitter_username"])
+            os.kill(os.getpid(), signal.SIGTERM)
+            return {"ok": True}
+
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        with patch.object(cli, "run_user", side_effect=run_user):
+            with patch.object(
+                    sys, 'argv', ['', '--config', config_test, '--daemon']
+            ):
+                assert cli.main() == 0
+        # Stops once the user being processed is done
+        assert len(processed) == 1
+        assert signal.getsignal(signal.SIGTERM) == previous_handler
+        with patch.object(
+                sys,
+                'argv',
+                ['', '--config', config_test, '--daemon', '--workers', '2']
+        ):
+            assert cli.main() == 1
+    return g_mock
+
+
+def test_poll_state(tmp_path):
+    state_path = os.path.join(str(tmp_path), "poll_state.json")
+    poll_state = PollState(state_path, min_interval=60, max_interval=3600)
+    assert poll_state.next_poll() is None
+
+    def tweets(*minutes):
+        start = datetime(2021, 1, 1)
+        return [
+            {"created_at": (start + timedelta(minutes=minute)).strftime(
+                "%Y-%m-%dT%H:%M:%S.000Z"
+            )}
+            for minute in minutes
+        ]
+
+    # A tweet every 10 minutes, poll every 5
+    poll_state.observe(tweets(0, 10, 20, 30))
+    assert poll_state.update(now=1000) == 5 * 60
+    assert poll_state.next_poll() == 1000 + 5 * 60
+    # Tweets already seen don't count again
+    poll_state.observe(tweets(30))
+    # Idle accounts back off exponentially, up to the limit
+    assert poll_state.update() == 10 * 60
+    assert poll_state.update() == 20 * 60
+    for _poll in range(5):
+        poll_state.update()
+    assert poll_state.interval == 3600
+
+    # Busy accounts are polled often, but not more than the limit
+    poll_state.observe(tweets(*range(31, 60)))
+    poll_state.update()
+    assert poll_state.interval < 3600
+    for _poll in range(5):
+        poll_state.observe(tweets(*range(60 + _poll * 10, 70 + _poll * 10)))
+        poll_state.update()
+    assert poll_state.interval == 60
+
+    # The state survives restarts
+    poll_state_next = PollState(state_path, 60, 3600)
+    assert poll_state_next.interval == 60
+    assert poll_state_next.last_tweet_at == poll_state.last_tweet_at
+    assert poll_state_next.polled_at == poll_state.polled_at
+    # Narrower bounds apply to the saved interval
+    assert PollState(state_path, 120, 3600).interval == 120
+    assert PollState.from_config(
+        state_path, {"poll_interval_min": 300}, {"poll_interval_min": 10}
+    ).interval == 300
+    try:
+        PollState(state_path, 3600, 60)
+        assert False
+    except ValueError as e:
+        assert "poll_interval_min" in str(e)
+
+
+def test_adaptive_poll_interval(global_mock, tmp_path):
+    with global_mock:
+        config_users = get_config_users('config.yml')
+        config = dict(config_users['config'])
+        user_item = dict(config_users['user_dict'][0])
+        user_item["skip_pin"] = False
+        base_path = str(tmp_path)
+        state_path = os.path.join(
+            base_path, "users", user_item["twitter_username"],
+            "poll_state.json"
+        )
+        assert cli.get_poll_interval(user_item, config, base_path) == 300
+        config["poll_interval"] = 30
+        assert cli.get_poll_interval(user_item, config, base_path) == 30
+        user_item["poll_interval"] = 40
+        assert cli.get_poll_interval(user_item, config, base_path) == 40
+        del config["poll_interval"]
+        del user_item["poll_interval"]
+
+        # Only the daemon keeps track of how often the user tweets
+        args = cli.get_args(sysargs=["--skipChecks", "--noProfile"])
+        cli.process_user(
+            user_item, config, base_path, args, SessionPool()
+        )
+        assert not os.path.isfile(state_path)
+        user_path = os.path.join(
+            base_path, "users", user_item["twitter_username"]
+        )
+        for file_name in os.listdir(user_path):
+            if file_name.startswith("last_tweet_id"):
+                os.remove(os.path.join(user_path, file_name))
+        config["poll_interval_min"] = 1
+        args = cli.get_args(
+            sysargs=["--skipChecks", "--noProfile", "--daemon"]
+        )
+        cli.process_user(
+            user_item, config, base_path, args, SessionPool()
+        )
+        assert os.path.isfile(state_path)
+        interval = cli.get_poll_interval(user_item, config, base_path)
+        assert interval != 300
+        assert cli.get_poll_state(
+            user_item, config, base_path
+        ).interval == interval
+
+
+def test_partition_users():
+    user_dict = [{"pleroma_username": str(idx)} for idx in range(5)]
+    chunks = cli.partition_users(user_dict, 2)
+    assert len(chunks) == 2
+    assert [len(chunk) for chunk in chunks] == [3, 2]
+    chunks = cli.partition_users(user_dict, 10)
+    assert len(chunks) == 5
+    flat = [user for chunk in chunks for user in chunk]
+    assert sorted(flat, key=lambda u: u["pleroma_username"]) == user_dict
+
+
+def test_run_worker_summary(
+        rootdir, global_mock, sample_users, monkeypatch, caplog
+):
+    with global_mock as g_mock:
+        config_users = get_config_users('config.yml')
+        args = cli.get_args(sysargs=["--workers", "2"])
+        user_dict = cli.expand_users(config_users['user_dict'])
+        results = cli._run_worker(
+            user_dict,
+            config_users['config'],
+            os.getcwd(),
+            args
+        )
+        assert len(results) == len(user_dict)
+        assert all(result["ok"] for result in results)
+        g_mock.get(f"{UserTemplate().twitter_base_url_v2}/users/2244994945"
+                   f"/tweets",
+                   json={},
+                   status_code=200)
+        results = cli._run_worker(
+            user_dict,
+            config_users['config'],
+            os.getcwd(),
+            args
+        )
+        assert not any(result["ok"] for result in results)
+        with caplog.at_level(logging.INFO):
+            failed = cli.log_summary(results)
+        assert failed == len(results)
+        assert "Run summary" in caplog.text
+        assert "Failed user" in caplog.text
+        _clean_pinned(sample_users)
+    return g_mock
+
+
+def test_main_workers_ask_dates(rootdir, global_mock, monkeypatch, tmp_path):
+    """
+    Check that the dates to start from are asked by the parent process, as
+    the stdin of the worker processes is /dev/null
+    """
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = os.path.join(test_files_dir, 'config_multiple_users.yml')
+        config_path = str(tmp_path / "config.yml")
+        shutil.copy(config_test, config_path)
+        config_users = get_config_users(config_path)
+        user_dict = cli.expand_users(config_users['user_dict'])
+        parent_pid = os.getpid()
+        asked = []
+
+        def fake_input():
+            if os.getpid() != parent_pid:
+                raise EOFError("EOF when reading a line")
+            asked.append(True)
+            return "2020-12-30"
+
+        monkeypatch.setattr('builtins.input', fake_input)
+        argv = ['', '--config', config_path, '--workers', '2', '--noProfile']
+        with patch.object(sys, 'argv', argv):
+            assert cli.main() == 0
+        # Every new user is asked once, before being processed
+        assert len(asked) == len(user_dict)
+        for user_item in user_dict:
+            user_path = tmp_path / "users" / user_item["twitter_username"]
+            assert user_path.is_dir()
+
+        # Without a terminal it fails before any user is processed, so they
+        # are still new on the next run
+        shutil.rmtree(str(tmp_path / "users"))
+        parent_pid = None
+        with patch.object(sys, 'argv', argv):
+            assert cli.main() == 1
+        assert not (tmp_path / "users").exists()
+        with patch.object(sys, 'argv', argv + ['--skipChecks']):
+            assert cli.main() == 0
+        assert (tmp_path / "users").exists()
+    return g_mock
+
+
+def _clean_pinned(sample_users):
+    for sample_user in sample_users:
+        sample_user_obj = sample_user['user_obj']
+        for pinned_file in ('pinned_id.txt', 'pinned_id_pleroma.txt'):
+            pinned_path = os.path.join(
+                os.getcwd(),
+                'users',
+                sample_user_obj.twitter_username,
+                pinned_file
+            )
+            if os.path.isfile(pinned_path):
+                os.remove(pinned_path)